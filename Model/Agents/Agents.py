@@ -1,12 +1,19 @@
 # Imports
-from typing import List, Dict, Union, Tuple
+from time import perf_counter
+from typing import List, Dict, Union, Tuple, Iterator, Optional
 
-from tenacity import retry, stop_after_attempt
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, stop_any, wait_random_exponential
 
+from Model.Cache.ResponseCache import response_cache
+from Model.CallPolicy.CallPolicy import CallPolicyError, deadline_passed
 from Model.Chain.Chain import Chain
 from Model.Config.Config import config
+from Model.Memory.Memory import BaseMemory
+from Model.Metrics.Metrics import metrics
 from Model.Parsers.Parsers import GuidanceChainParser
 from Model.Persona.Persona import Persona
+from Model.Tiering.Tiering import ModelTier, model_tiering
+from Model.Tokens.Tokens import count_tokens
 
 
 class BaseAgent:
@@ -94,6 +101,147 @@ class BaseAgent:
         # Change last run chain
         self._last_run_chain = self._chains[chain_name]
 
+        parameters = chain_params["parameters"] if "parameters" in chain_params else {}
+        parameters, tier = self._select_model(chain_name=chain_name, parameters=parameters)
+
+        # Answer of the same conversation state may be cached
+        cache_key = self._response_cache_key(chain_name=chain_name, parameters=parameters)
+        if cache_key is not None:
+            answer = response_cache.get(cache_key)
+            if answer is not None:
+                return answer
+
+        with metrics.span("prompt", chain=chain_name):
+            inputs, prompt_tokens = self._chain_inputs(chain_name=chain_name, chain_params=chain_params)
+
+        # Return answer from LLM
+        start = perf_counter()
+        answer = self._last_run_chain.run(inputs=inputs, prompt_tokens=prompt_tokens, **parameters)[0]  # type: ignore
+        seconds = perf_counter() - start
+        if cache_key is not None:
+            response_cache.set(cache_key, answer, seconds)
+        if tier is not None:
+            self._record_tier(chain_name, tier, seconds, prompt_tokens, answer)
+
+        return answer
+
+    async def arun_chain(
+            self, chain_name: str, chain_params: Dict[str, Union[str, float, bool]]
+    ) -> str:
+        """Async version of run_chain
+
+        Args:
+            chain_name (str): Name of the chain we would like to run
+            chain_params (Dict[str, Union[str, float, bool]]): Parameters for given chain
+
+        Returns:
+            str: Answer of the chosen chain
+        """
+
+        # Change last run chain
+        self._last_run_chain = self._chains[chain_name]
+
+        parameters = chain_params["parameters"] if "parameters" in chain_params else {}
+        parameters, tier = self._select_model(chain_name=chain_name, parameters=parameters)
+
+        cache_key = self._response_cache_key(chain_name=chain_name, parameters=parameters)
+        if cache_key is not None:
+            answer = response_cache.get(cache_key)
+            if answer is not None:
+                return answer
+
+        with metrics.span("prompt", chain=chain_name):
+            inputs, prompt_tokens = self._chain_inputs(chain_name=chain_name, chain_params=chain_params)
+
+        # Return answer from LLM
+        start = perf_counter()
+        answer = (await self._last_run_chain.arun(
+            inputs=inputs, prompt_tokens=prompt_tokens, **parameters
+        ))[0]  # type: ignore
+        seconds = perf_counter() - start
+        if cache_key is not None:
+            response_cache.set(cache_key, answer, seconds)
+        if tier is not None:
+            self._record_tier(chain_name, tier, seconds, prompt_tokens, answer)
+
+        return answer
+
+    def _select_model(
+            self, chain_name: str, parameters: Dict[str, Union[str, float, bool]]
+    ) -> Tuple[Dict[str, Union[str, float, bool]], Optional[Tuple[ModelTier, float]]]:
+        """Chooses the model of a tiered chain from the complexity of the turn. Model given in
+        parameters is kept
+
+        Args:
+            chain_name (str): Name of the chain
+            parameters (Dict[str, Union[str, float, bool]]): Parameters of the chain call
+
+        Returns:
+            (Dict[str, Union[str, float, bool]], Optional[Tuple[ModelTier, float]]): Parameters with
+            model and answer token limit of the tier, chosen tier and score of the turn. Tier is None if
+            chain is not tiered
+        """
+        if "model_name" in parameters or not model_tiering.enabled(chain_name):
+            return parameters, None
+
+        with metrics.span("model_select", chain=chain_name):
+            tier, score = model_tiering.select(chain_name, self._text, self._memory)
+        parameters = {**parameters, "model_name": tier.model_name}
+        if tier.max_output_tokens is not None and "max_tokens" not in parameters:
+            parameters["max_tokens"] = tier.max_output_tokens
+        return parameters, (tier, score)
+
+    @staticmethod
+    def _record_tier(
+            chain_name: str, tier: Tuple[ModelTier, float], seconds: float, prompt_tokens: Optional[int], answer
+    ):
+        model_tier, score = tier
+        model_tiering.record(
+            chain_name=chain_name,
+            tier=model_tier,
+            score=score,
+            seconds=seconds,
+            prompt_tokens=prompt_tokens or 0,
+            completion_tokens=count_tokens(answer) if isinstance(answer, str) else 0,
+        )
+
+    def _response_cache_key(self, chain_name: str, parameters: Dict[str, Union[str, float, bool]]) -> Optional[str]:
+        """Returns response cache key of the chain call
+
+        Args:
+            chain_name (str): Name of the chain
+            parameters (Dict[str, Union[str, float, bool]]): Parameters of the chain call
+
+        Returns:
+            Optional[str]: Cache key. None if answer of the call must not be cached
+        """
+        chain = self._chains[chain_name]
+        temperature = parameters.get("temperature", chain.temperature)
+        if not isinstance(self._memory, BaseMemory) or not response_cache.is_cacheable(chain_name, temperature):
+            return None
+
+        return response_cache.key(
+            chain_name=chain_name,
+            model_name=parameters.get("model_name", chain.model_name),
+            temperature=temperature,
+            memories=self._memory.memory_array,
+            text=self._text,
+        )
+
+    def _chain_inputs(
+            self, chain_name: str, chain_params: Dict[str, Union[str, float, bool]]
+    ) -> Tuple[Dict[str, str], Optional[int]]:
+        """Creates prompt inputs of a chain. Chat history is trimmed from the oldest side to fit
+        into the input token budget of the chain.
+
+        Args:
+            chain_name (str): Name of the chain
+            chain_params (Dict[str, Union[str, float, bool]]): Parameters for given chain
+
+        Returns:
+            (Dict[str, str], Optional[int]): Inputs' dictionary to feed to LLM, number of prompt
+            tokens. Tokens are None if they are not counted yet
+        """
         inputs = {}
         inputs.update()
         if config["chains"][chain_name]["use_persona"]:
@@ -108,11 +256,87 @@ class BaseAgent:
             for input_name in config["chains"][chain_name]["prompt_inputs"] if input_name not in inputs
         })
 
-        # Return answer from LLM
-        return self._last_run_chain.run(
-            inputs=inputs,
-            **(chain_params["parameters"] if "parameters" in chain_params else {}),  # type: ignore
-        )[0]
+        # Chat history is rendered according to memory and token budgets of the chain
+        if not isinstance(inputs.get("memory"), BaseMemory):
+            return inputs, None
+
+        chain = self._chains[chain_name]
+        memory = inputs["memory"]
+        inputs["memory"] = ""
+        fixed_tokens = chain.count_input_tokens(inputs)
+
+        max_tokens = None
+        if chain.max_input_tokens is not None:
+            max_tokens = chain.max_input_tokens - fixed_tokens
+            if max_tokens < 0:
+                print(f"Prompt of {chain_name} is over its token budget without chat history: {fixed_tokens}")
+
+        inputs["memory"], memory_tokens = self._render_memory(
+            chain_name=chain_name, memory=memory, max_tokens=max_tokens
+        )
+        return inputs, fixed_tokens + memory_tokens
+
+    @staticmethod
+    def _render_memory(chain_name: str, memory: BaseMemory, max_tokens: Optional[int] = None) -> Tuple[str, int]:
+        """Renders chat history with window and summary settings of the chain
+
+        Args:
+            chain_name (str): Name of the chain
+            memory (BaseMemory): Memory of the AI
+            max_tokens (Optional[int], optional): Token budget of chat history. Defaults to None.
+
+        Returns:
+            (str, int): Chat history text, number of tokens
+        """
+        chain_config = config["chains"][chain_name]
+        window_size = chain_config.get("memory_window") or config["LONG_TERM_MEMORY_WINDOW_SIZE"]
+        return memory.render_with_tokens(
+            window_size=window_size, use_summary=chain_config.get("memory_summary", True), max_tokens=max_tokens
+        )
+
+    def stream_chain(
+            self, chain_name: str, chain_params: Dict[str, Union[str, float, bool]]
+    ) -> Iterator[str]:
+        """Runs a chain with given name and yields its answer while it is generated
+
+        Args:
+            chain_name (str): Name of the chain we would like to run
+            chain_params (Dict[str, Union[str, float, bool]]): Parameters for given chain
+
+        Yields:
+            str: Parts of the answer of the chosen chain
+        """
+
+        # Change last run chain
+        self._last_run_chain = self._chains[chain_name]
+
+        parameters = chain_params["parameters"] if "parameters" in chain_params else {}
+        parameters, tier = self._select_model(chain_name=chain_name, parameters=parameters)
+
+        cache_key = self._response_cache_key(chain_name=chain_name, parameters=parameters)
+        if cache_key is not None:
+            answer = response_cache.get(cache_key)
+            if answer is not None:
+                yield answer
+                return
+
+        with metrics.span("prompt", chain=chain_name):
+            inputs, prompt_tokens = self._chain_inputs(chain_name=chain_name, chain_params=chain_params)
+
+        start = perf_counter()
+        parts = []
+        for part in self._last_run_chain.stream(
+                inputs=inputs, prompt_tokens=prompt_tokens, **parameters
+        ):  # type: ignore
+            parts.append(part)
+            yield part
+
+        # Only complete answers are cached and recorded
+        seconds = perf_counter() - start
+        if cache_key is not None:
+            response_cache.set(cache_key, "".join(parts), seconds)
+        if tier is not None:
+            self._record_tier(chain_name, tier, seconds, prompt_tokens, "".join(parts))
 
     def run_chains(
             self,
@@ -172,6 +396,58 @@ class BaseAgent:
         return answers, responses, chains
 
 
+    async def arun_chains(
+            self,
+            chains_params=None,
+    ) -> Tuple[List[str], List[Union[str, GuidanceChainParser]], List[str]]:
+        """Async version of run_chains. Chains still run in order.
+
+        Args:
+            chains_params(Dict[str, Dict[str, Dict[str, Union[str, float, bool]]]], optional): Dictionary of all chains
+            inputs and parameters. See run_chains
+
+        Returns:
+            (List[str], List[str], List[str]): List of all answers with in order, List of answers of chains, List of
+            all chains
+        """
+        if chains_params is None:
+            chains_params = {}
+        answers = []
+
+        for chain_name in self._chains:
+            answers.append(chain_name)
+            answer = await self.arun_chain(
+                chain_name=chain_name,
+                chain_params=chains_params[chain_name] if chain_name in chains_params else {},
+            )
+            answers.append(answer)
+
+        return answers, answers[1::2], answers[::2]
+
+    def stream_chains(self, chains_params=None) -> Iterator[str]:
+        """Streaming version of run_chains. Yields answer parts of all chains in the agent,
+        answers of different chains are separated with a new line.
+
+        Args:
+            chains_params(Dict[str, Dict[str, Dict[str, Union[str, float, bool]]]], optional): Dictionary of all chains
+            inputs and parameters. See run_chains
+
+        Yields:
+            str: Parts of the answers
+        """
+        if chains_params is None:
+            chains_params = {}
+
+        for index, chain_name in enumerate(self._chains):
+            if index > 0:
+                yield "\n"
+
+            yield from self.stream_chain(
+                chain_name=chain_name,
+                chain_params=chains_params[chain_name] if chain_name in chains_params else {},
+            )
+
+
 class GuidanceAgent(BaseAgent):
     """Guidance Agent for AI teacher.
     Responsible for selecting other agents in AI teacher
@@ -180,32 +456,72 @@ class GuidanceAgent(BaseAgent):
     def __init__(self, chain_names=config["agents"]["GuidanceAgent"]["chains"]):
         super().__init__(chain_names=chain_names)
 
-    @retry(stop=stop_after_attempt(3))
+    # Unusable answers are asked again with jittered backoff, within the turn deadline. Provider
+    # errors are retried by the call policy and are not retried here
+    @retry(
+        stop=stop_any(stop_after_attempt(3), deadline_passed),
+        wait=wait_random_exponential(multiplier=0.2, max=2),
+        retry=retry_if_exception_type(ValueError),
+        before_sleep=metrics.count_retry,
+    )
     def chooseNextAgent(self) -> (int, str):
         """Chooses next agent to run for AI teacher
 
         Raises:
-            Exception: _description_
+            ValueError: Answer of GuidanceChain could not be used
+            CallPolicyError: LLM call was given up
 
         Returns:
             (int, str): agent index, agent name
         """
-        parameters = {"temperature": 0.5}
-
         try:
-            _, responses, _ = self.run_chains(
-                chains_params={"GuidanceChain": {"parameters": parameters}}
-            )
-            agent_index = responses[0].agent_index
-            agent_name = responses[0].agent_name
+            _, responses, _ = self.run_chains(chains_params=self._guidance_params())
+            return self._next_agent(responses[0])
+        except CallPolicyError:
+            raise
+        except Exception as e:
+            print(e)
+            raise ValueError
+
+    @retry(
+        stop=stop_any(stop_after_attempt(3), deadline_passed),
+        wait=wait_random_exponential(multiplier=0.2, max=2),
+        retry=retry_if_exception_type(ValueError),
+        before_sleep=metrics.count_retry,
+    )
+    async def achooseNextAgent(self) -> (int, str):
+        """Async version of chooseNextAgent
 
-            # Check if the agent name has blank or not (we do not want blank)
-            if not agent_name.isspace():
-                agent_name = config["AGENTS_NAMES"][agent_index]
+        Raises:
+            ValueError: Answer of GuidanceChain could not be used
+            CallPolicyError: LLM call was given up
+
+        Returns:
+            (int, str): agent index, agent name
+        """
+        try:
+            _, responses, _ = await self.arun_chains(chains_params=self._guidance_params())
+            return self._next_agent(responses[0])
+        except CallPolicyError:
+            raise
         except Exception as e:
             print(e)
             raise ValueError
 
+    @staticmethod
+    def _guidance_params() -> Dict[str, Dict[str, Dict[str, float]]]:
+        parameters = {"temperature": 0.5}
+        return {"GuidanceChain": {"parameters": parameters}}
+
+    @staticmethod
+    def _next_agent(response: GuidanceChainParser) -> (int, str):
+        agent_index = response.agent_index
+        agent_name = response.agent_name
+
+        # Check if the agent name has blank or not (we do not want blank)
+        if not agent_name.isspace():
+            agent_name = config["AGENTS_NAMES"][agent_index]
+
         return agent_index, agent_name
 
 
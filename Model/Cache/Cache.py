@@ -0,0 +1,215 @@
+import hashlib
+import re
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import ujson
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s.!?,;:]+$")
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes user input for cache keys. Case, repeated spaces and trailing punctuation
+    are ignored, so "Hi!" and "hi" share a key.
+
+    Args:
+        text (str): User input
+
+    Returns:
+        str: Normalized text
+    """
+    return _TRAILING_PUNCTUATION.sub("", _SPACES.sub(" ", (text or "").strip().lower()))
+
+
+def fingerprint(value) -> str:
+    """Returns a stable hash of a JSON serializable value
+
+    Args:
+        value: Value to hash
+
+    Returns:
+        str: Hex digest
+    """
+    return hashlib.sha256(ujson.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe cache with least recently used eviction and idle time-to-live.
+    Entries are evicted when the cache is full or when they are not used for ttl seconds.
+    """
+
+    def __init__(
+            self,
+            max_size: Optional[int] = None,
+            ttl: Optional[float] = None,
+            on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        """Constructor of LRUCache class
+
+        Args:
+            max_size (Optional[int], optional): Maximum number of entries. Defaults to None, unbounded
+            ttl (Optional[float], optional): Seconds an unused entry lives. Defaults to None, no expiry
+            on_evict (Optional[Callable[[Hashable, Any], None]], optional): Called with key and value of
+        every evicted entry. Defaults to None.
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._on_evict = on_evict
+
+        # Oldest used entry first. Values are (value, last used time)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._lock = RLock()
+
+        # Counters
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return self.get(key, touch=False) is not None
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    def get(self, key: Hashable, default: Any = None, touch: bool = True) -> Any:
+        """Returns value of the key
+
+        Args:
+            key (Hashable): Key
+            default (Any, optional): Returned if key is missing or expired. Defaults to None.
+            touch (bool, optional): Mark entry as used and count hit/miss. Defaults to True.
+
+        Returns:
+            Any: Value of the key
+        """
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            now = monotonic()
+            if entry is not None and self._ttl is not None and now - entry[1] > self._ttl:
+                del self._entries[key]
+                self._expirations += 1
+                evicted.append((key, entry[0]))
+                entry = None
+
+            if entry is None:
+                if touch:
+                    self._misses += 1
+                value = default
+            else:
+                if touch:
+                    self._hits += 1
+                    self._entries[key] = (entry[0], now)
+                    self._entries.move_to_end(key)
+                value = entry[0]
+
+        self._notify(evicted)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """Sets value of the key. Evicts least recently used entries if cache is full
+
+        Args:
+            key (Hashable): Key
+            value (Any): Value
+        """
+        evicted = []
+        with self._lock:
+            self._entries[key] = (value, monotonic())
+            self._entries.move_to_end(key)
+            while self._max_size is not None and len(self._entries) > self._max_size:
+                evicted.append(self._pop_oldest())
+                self._evictions += 1
+
+        self._notify(evicted)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Removes the key without calling eviction hook
+
+        Args:
+            key (Hashable): Key
+            default (Any, optional): Returned if key is missing. Defaults to None.
+
+        Returns:
+            Any: Removed value
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def expire(self) -> int:
+        """Evicts every entry not used for ttl seconds
+
+        Returns:
+            int: Number of evicted entries
+        """
+        if self._ttl is None:
+            return 0
+
+        evicted = []
+        with self._lock:
+            deadline = monotonic() - self._ttl
+            # Entries are in usage order, so the scan stops at the first fresh one
+            while self._entries and next(iter(self._entries.values()))[1] < deadline:
+                evicted.append(self._pop_oldest())
+                self._expirations += 1
+
+        self._notify(evicted)
+        return len(evicted)
+
+    def values(self) -> List[Any]:
+        """Returns all values without touching them
+
+        Returns:
+            List[Any]: Values
+        """
+        with self._lock:
+            return [entry[0] for entry in self._entries.values()]
+
+    def clear(self):
+        """Removes all entries without calling eviction hook"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """Returns cache counters
+
+        Returns:
+            Dict[str, float]: size, hits, misses, hit rate, evictions and expirations
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
+
+    def _pop_oldest(self) -> Tuple[Hashable, Any]:
+        key, (value, _) = self._entries.popitem(last=False)
+        return key, value
+
+    def _notify(self, evicted: List[Tuple[Hashable, Any]]):
+        # Hook runs outside the lock, it may be slow (for example persisting a session)
+        if self._on_evict is None:
+            return
+        for key, value in evicted:
+            try:
+                self._on_evict(key, value)
+            except Exception as e:
+                print(f"Cache eviction hook failed: {str(e)}")
@@ -0,0 +1,143 @@
+from threading import Lock
+from typing import Dict, List, Optional
+
+from Model.Cache.Cache import LRUCache, fingerprint, normalize_text
+from Model.Config.Config import config
+from Model.Memory.Memory import MemoryVariable
+from Model.Persona.Persona import Persona
+
+
+class ResponseCache:
+    """Cache of chain answers in front of Chain.run. Key combines chain config, persona, a hash of
+    the recent conversation and the normalized user input. Chains with high temperature are
+    never cached, their answers are expected to vary.
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor of ResponseCache class
+
+        Args:
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                enabled (bool): Use the cache. Defaults to config file
+                chains (List[str]): Names of cached chains. Defaults to config file
+                max_size (int): Maximum number of answers. Defaults to config file
+                ttl (float): Seconds an unused answer lives. Defaults to config file
+                context_window (int): Number of messages before the user input in the key. Defaults to config file
+                max_temperature (float): Chains with higher temperature are not cached. Defaults to config file
+        """
+        cache_config = config["RESPONSE_CACHE"]
+        self._enabled = kwargs.get("enabled", cache_config["enabled"])
+        self._chains = set(kwargs.get("chains", cache_config["chains"]))
+        self._context_window = kwargs.get("context_window", cache_config["context_window"])
+        self._max_temperature = kwargs.get("max_temperature", cache_config["max_temperature"])
+        self._cache = LRUCache(
+            max_size=kwargs.get("max_size", cache_config["max_size"]),
+            ttl=kwargs.get("ttl", cache_config["ttl"]),
+        )
+
+        # Static parts of keys are hashed once
+        self._chain_fingerprints: Dict[str, str] = {}
+        persona = Persona()
+        self._persona_fingerprint = fingerprint([persona.description, persona.attributes])
+
+        # Counters
+        self._lock = Lock()
+        self._bypassed = 0
+        self._saved_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def is_cacheable(self, chain_name: str, temperature: float) -> bool:
+        """Returns whether answers of the chain can be cached
+
+        Args:
+            chain_name (str): Name of the chain
+            temperature (float): Temperature of the chain call
+
+        Returns:
+            bool: True if cache is used
+        """
+        if not self._enabled or chain_name not in self._chains:
+            return False
+        if temperature > self._max_temperature:
+            with self._lock:
+                self._bypassed += 1
+            return False
+        return True
+
+    def key(self, chain_name: str, model_name: str, temperature: float, memories: List[MemoryVariable], text: str) -> str:
+        """Returns cache key of a chain call
+
+        Args:
+            chain_name (str): Name of the chain
+            model_name (str): Model of the chain call
+            temperature (float): Temperature of the chain call
+            memories (List[MemoryVariable]): Memories of the session. Last one is the user input
+            text (str): User input
+
+        Returns:
+            str: Cache key
+        """
+        chain_fingerprint = self._chain_fingerprints.get(chain_name)
+        if chain_fingerprint is None:
+            chain_config = config["chains"][chain_name]
+            chain_fingerprint = fingerprint([
+                chain_config["prompt_template"],
+                chain_config.get("prefix_stable_prompt_template"),
+                chain_config.get("prompt_layout", config["PROMPT_LAYOUT"]),
+            ])
+            self._chain_fingerprints[chain_name] = chain_fingerprint
+
+        # Messages before the current user input
+        context = memories[-(self._context_window + 1):-1] if self._context_window > 0 else []
+        context_fingerprint = fingerprint([[memory.by, memory.message] for memory in context])
+
+        return fingerprint([
+            chain_name, chain_fingerprint, model_name, temperature,
+            self._persona_fingerprint, context_fingerprint, normalize_text(text),
+        ])
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns cached answer
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            Optional[str]: Answer. None if not cached
+        """
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+
+        answer, seconds = entry
+        with self._lock:
+            self._saved_seconds += seconds
+        return answer
+
+    def set(self, key: str, answer: str, seconds: float):
+        """Caches an answer
+
+        Args:
+            key (str): Cache key
+            answer (str): Answer of the chain
+            seconds (float): Latency of the chain call. Reported as saved on every hit
+        """
+        self._cache.set(key, (answer, seconds))
+
+    def stats(self) -> Dict[str, float]:
+        """Returns cache counters
+
+        Returns:
+            Dict[str, float]: LRU counters, calls bypassed for temperature and saved latency in seconds
+        """
+        with self._lock:
+            return {**self._cache.stats(), "bypassed": self._bypassed, "saved_seconds": self._saved_seconds}
+
+
+# Shared response cache of the process
+response_cache = ResponseCache()
@@ -0,0 +1,82 @@
+from typing import Dict, List, Optional, Tuple
+
+from Model.Cache.Cache import LRUCache, fingerprint, normalize_text
+from Model.Config.Config import config
+from Model.Memory.Memory import MemoryVariable
+
+
+class RoutingCache:
+    """Cache of GuidanceAgent decisions keyed on the tail of the conversation. Routing mostly
+    depends on the last few messages, so the same short exchange is routed by LLM only once.
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor of RoutingCache class
+
+        Args:
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                enabled (bool): Use the cache. Defaults to config file
+                tail_size (int): Number of last messages in the key, including user input. Defaults to config file
+                max_size (int): Maximum number of decisions. Defaults to config file
+                ttl (float): Seconds an unused decision lives. Defaults to config file
+        """
+        cache_config = config["ROUTING_CACHE"]
+        self._enabled = kwargs.get("enabled", cache_config["enabled"])
+        self._tail_size = kwargs.get("tail_size", cache_config["tail_size"])
+        self._cache = LRUCache(
+            max_size=kwargs.get("max_size", cache_config["max_size"]),
+            ttl=kwargs.get("ttl", cache_config["ttl"]),
+        )
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def key(self, memories: List[MemoryVariable]) -> str:
+        """Returns canonical fingerprint of the conversation tail
+
+        Args:
+            memories (List[MemoryVariable]): Memories of the session. Last one is the user input
+
+        Returns:
+            str: Cache key
+        """
+        tail = memories[-self._tail_size:]
+        return fingerprint([[memory.by, memory.agent_name, normalize_text(memory.message)] for memory in tail])
+
+    def get(self, memories: List[MemoryVariable]) -> Optional[Tuple[int, str]]:
+        """Returns cached decision for the conversation tail
+
+        Args:
+            memories (List[MemoryVariable]): Memories of the session
+
+        Returns:
+            Optional[Tuple[int, str]]: agent index, agent name. None if not cached
+        """
+        if not self._enabled:
+            return None
+        return self._cache.get(self.key(memories))
+
+    def set(self, memories: List[MemoryVariable], decision: Tuple[int, str]):
+        """Caches decision for the conversation tail
+
+        Args:
+            memories (List[MemoryVariable]): Memories of the session
+            decision (Tuple[int, str]): agent index, agent name
+        """
+        if self._enabled:
+            self._cache.set(self.key(memories), tuple(decision))
+
+    def stats(self) -> Dict[str, float]:
+        """Returns cache counters
+
+        Returns:
+            Dict[str, float]: LRU counters
+        """
+        return self._cache.stats()
+
+
+# Shared routing cache of the process
+routing_cache = RoutingCache()
@@ -0,0 +1,513 @@
+import asyncio
+import contextvars
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import monotonic, perf_counter
+from typing import Awaitable, Callable, Dict, Iterator, Optional, TypeVar
+
+import httpx
+import openai
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from Model.Config.Config import config
+from Model.Metrics.Metrics import metrics
+
+T = TypeVar("T")
+
+# Monotonic time the running chat turn must finish by. None outside of turns
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+# Provider errors worth another attempt
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    httpx.TimeoutException,
+    TimeoutError,
+)
+
+
+class CallPolicyError(RuntimeError):
+    """LLM call was given up by the call policy"""
+
+
+class DeadlineExceededError(CallPolicyError):
+    """Deadline of the chat turn passed"""
+
+
+class CircuitOpenError(CallPolicyError):
+    """Provider is failing, calls fail fast until the circuit closes"""
+
+
+class LLMUnavailableError(CallPolicyError):
+    """LLM call failed on every attempt"""
+
+
+@contextmanager
+def turn_deadline(seconds: Optional[float] = None) -> Iterator[None]:
+    """Sets the deadline of a chat turn. Every LLM call of the turn gets at most the time left.
+    Nested deadlines can only shorten the outer one.
+
+    Args:
+        seconds (Optional[float], optional): Seconds the turn may take. Defaults to config file
+    """
+    seconds = seconds if seconds is not None else config["CALL_POLICY"]["turn_deadline"]
+    deadline = monotonic() + seconds if seconds is not None else None
+    outer = _deadline.get()
+    if outer is not None and (deadline is None or outer < deadline):
+        deadline = outer
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    """Returns seconds left until the deadline of the running chat turn
+
+    Returns:
+        Optional[float]: Seconds. None if the turn has no deadline
+    """
+    deadline = _deadline.get()
+    return deadline - monotonic() if deadline is not None else None
+
+
+def deadline_passed(retry_state=None) -> bool:
+    """Returns whether the deadline of the running chat turn passed. Usable as tenacity stop
+
+    Returns:
+        bool: True if the turn has a deadline and it passed
+    """
+    remaining = remaining_time()
+    return remaining is not None and remaining <= 0
+
+
+def is_retryable(error: BaseException) -> bool:
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class CircuitBreaker:
+    """Counts consecutive provider failures. After too many the circuit opens and calls fail
+    fast. After the reset timeout one trial call is let through, its result closes or reopens
+    the circuit.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        """Constructor of CircuitBreaker class
+
+        Args:
+            name (str): Name of the protected provider or model
+            failure_threshold (int): Consecutive failures opening the circuit
+            reset_timeout (float): Seconds the circuit stays open before a trial call
+        """
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = Lock()
+
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._opened = 0
+        self._rejected = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self) -> bool:
+        """Returns whether a call may be made now"""
+        with self._lock:
+            if self._state == "open" and monotonic() - self._opened_at >= self._reset_timeout:
+                self._state = "half_open"
+                self._trial_running = False
+            if self._state == "closed":
+                return True
+            if self._state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            self._rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._trial_running = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self._failure_threshold:
+                if self._state != "open":
+                    self._opened += 1
+                    print(f"Circuit of {self._name} is open after {self._failures} failures")
+                self._state = "open"
+                self._opened_at = monotonic()
+                self._trial_running = False
+
+    def release(self):
+        """Ends a call which tells nothing about the provider, like a passed deadline or a closed
+        stream. A half-open circuit lets the next call try again.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def stats(self) -> Dict[str, int]:
+        """Returns breaker counters
+
+        Returns:
+            Dict[str, int]: Whether the circuit is open, consecutive failures, times opened and
+            calls rejected while open
+        """
+        with self._lock:
+            return {
+                "open": int(self._state != "closed"),
+                "failures": self._failures,
+                "opened": self._opened,
+                "rejected": self._rejected,
+            }
+
+
+# Circuit breakers of the process. Keys are model names
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = Lock()
+
+
+def circuit_breaker(name: str) -> CircuitBreaker:
+    """Returns the shared circuit breaker of a model. Creates it on the first call
+
+    Args:
+        name (str): Model name
+
+    Returns:
+        CircuitBreaker: Circuit breaker
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                policy_config = config["CALL_POLICY"]
+                breaker = _breakers[name] = CircuitBreaker(
+                    name, policy_config["breaker_failures"], policy_config["breaker_reset_timeout"]
+                )
+    return breaker
+
+
+def circuit_breaker_stats() -> Dict[str, Dict[str, int]]:
+    """Returns counters of all circuit breakers
+
+    Returns:
+        Dict[str, Dict[str, int]]: Counters per model name
+    """
+    return {name: breaker.stats() for name, breaker in list(_breakers.items())}
+
+
+# Threads (greenlets under gevent) running hedged requests
+_hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+
+class CallPolicy:
+    """Timeout, retry, hedging and circuit breaker policy of the LLM calls of a chain.
+
+    Every attempt gets the per-chain timeout, cut to the time left of the turn deadline.
+    Provider errors are retried with jittered exponential backoff while the deadline allows.
+    Hedging sends a duplicate request when the first one is slower than the recent p95 latency
+    of the chain and keeps the first answer. The circuit breaker of the model fails calls fast
+    while the provider is failing.
+    """
+
+    def __init__(self, chain_name: str):
+        """Constructor of CallPolicy class
+
+        Args:
+            chain_name (str): Name of the chain. Per-chain settings are read from its config
+        """
+        policy_config = config["CALL_POLICY"]
+        chain_config = config["chains"][chain_name]
+        self._chain_name = chain_name
+        self._timeout = chain_config.get("timeout", policy_config["timeout"])
+        self._max_attempts = policy_config["max_attempts"]
+        self._backoff_multiplier = policy_config["backoff_multiplier"]
+        self._backoff_max = policy_config["backoff_max"]
+        self._hedge = chain_config.get("hedge", False)
+        self._hedge_min_delay = policy_config["hedge_min_delay"]
+        self._hedge_quantile = policy_config["hedge_quantile"]
+
+        # Recent latencies of successful calls, for the hedging delay
+        self._lock = Lock()
+        self._latencies = deque(maxlen=policy_config["hedge_window"])
+        self._hedges = 0
+
+    def attempt_timeout(self) -> Optional[float]:
+        """Returns timeout of the next attempt
+
+        Raises:
+            DeadlineExceededError: Deadline of the turn passed
+
+        Returns:
+            Optional[float]: Seconds. None if there is no limit
+        """
+        remaining = remaining_time()
+        if remaining is None:
+            return self._timeout
+        if remaining <= 0:
+            raise DeadlineExceededError(f"Deadline of the turn passed before {self._chain_name} call")
+        return min(self._timeout, remaining) if self._timeout is not None else remaining
+
+    def hedge_delay(self) -> Optional[float]:
+        """Returns seconds to wait before sending a duplicate request
+
+        Returns:
+            Optional[float]: Seconds. None if the call is not hedged
+        """
+        if not self._hedge:
+            return None
+        with self._lock:
+            # Too few calls to know the tail latency
+            if len(self._latencies) < 20:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(self._hedge_quantile * len(latencies)))
+        return max(self._hedge_min_delay, latencies[index])
+
+    def _wait(self, retry_state) -> float:
+        # Jittered exponential backoff, never past the deadline
+        seconds = wait_random_exponential(multiplier=self._backoff_multiplier, max=self._backoff_max)(retry_state)
+        remaining = remaining_time()
+        return max(0.0, min(seconds, remaining)) if remaining is not None else seconds
+
+    def _stop(self, retry_state) -> bool:
+        return stop_after_attempt(self._max_attempts)(retry_state) or deadline_passed()
+
+    def _breaker(self, model_name: str) -> CircuitBreaker:
+        breaker = circuit_breaker(model_name)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit of {model_name} is open")
+        return breaker
+
+    def _record(self, breaker: CircuitBreaker, start: float):
+        breaker.success()
+        with self._lock:
+            self._latencies.append(perf_counter() - start)
+
+    @staticmethod
+    def _failed(breaker: CircuitBreaker, error: BaseException):
+        # Only provider errors count against the circuit
+        if is_retryable(error):
+            breaker.failure()
+        else:
+            breaker.release()
+
+    def _count_retry(self, retry_state):
+        metrics.retries.inc((f"CallPolicy.{self._chain_name}",))
+
+    @staticmethod
+    def _give_up(error: BaseException) -> CallPolicyError:
+        if isinstance(error, CallPolicyError):
+            return error
+        if deadline_passed():
+            return DeadlineExceededError(f"Deadline of the turn passed: {error}")
+        return LLMUnavailableError(f"LLM call failed: {error}")
+
+    def call(self, model_name: str, fn: Callable[[Optional[float]], T]) -> T:
+        """Calls the LLM with the policy
+
+        Args:
+            model_name (str): Model of the call. Circuit breakers are per model
+            fn (Callable[[Optional[float]], T]): Makes one attempt with the given timeout
+
+        Raises:
+            CallPolicyError: Call was given up
+
+        Returns:
+            T: Result of fn
+        """
+        def attempt():
+            # Circuit is checked on every attempt, so retries stop once it opens
+            breaker = self._breaker(model_name)
+            start = perf_counter()
+            try:
+                result = self._hedged(fn)
+            except BaseException as e:
+                self._failed(breaker, e)
+                raise
+            self._record(breaker, start)
+            return result
+
+        try:
+            for retry_state in Retrying(
+                    stop=self._stop,
+                    wait=self._wait,
+                    retry=retry_if_exception(is_retryable),
+                    before_sleep=self._count_retry,
+                    reraise=True,
+            ):
+                with retry_state:
+                    return attempt()
+        except Exception as e:
+            if is_retryable(e) or isinstance(e, CallPolicyError):
+                raise self._give_up(e) from e
+            raise
+
+    async def acall(self, model_name: str, fn: Callable[[Optional[float]], Awaitable[T]]) -> T:
+        """Async version of call
+
+        Args:
+            model_name (str): Model of the call. Circuit breakers are per model
+            fn (Callable[[Optional[float]], Awaitable[T]]): Makes one attempt with the given timeout
+
+        Raises:
+            CallPolicyError: Call was given up
+
+        Returns:
+            T: Result of fn
+        """
+        async def attempt():
+            breaker = self._breaker(model_name)
+            start = perf_counter()
+            try:
+                result = await self._ahedged(fn)
+            except BaseException as e:
+                self._failed(breaker, e)
+                raise
+            self._record(breaker, start)
+            return result
+
+        try:
+            async for retry_state in AsyncRetrying(
+                    stop=self._stop,
+                    wait=self._wait,
+                    retry=retry_if_exception(is_retryable),
+                    before_sleep=self._count_retry,
+                    reraise=True,
+            ):
+                with retry_state:
+                    return await attempt()
+        except Exception as e:
+            if is_retryable(e) or isinstance(e, CallPolicyError):
+                raise self._give_up(e) from e
+            raise
+
+    def stream(self, model_name: str, fn: Callable[[Optional[float]], Iterator[T]]) -> Iterator[T]:
+        """Streams from the LLM with timeout and circuit breaker. Streams are not retried or
+        hedged, parts may already be sent to the client.
+
+        Args:
+            model_name (str): Model of the call
+            fn (Callable[[Optional[float]], Iterator[T]]): Starts the stream with the given timeout
+
+        Yields:
+            T: Parts of the stream
+        """
+        breaker = self._breaker(model_name)
+        start = perf_counter()
+        try:
+            yield from fn(self.attempt_timeout())
+        except BaseException as e:
+            self._failed(breaker, e)
+            if is_retryable(e):
+                raise self._give_up(e) from e
+            raise
+        self._record(breaker, start)
+
+    def _hedged(self, fn: Callable[[Optional[float]], T]) -> T:
+        delay = self.hedge_delay()
+        if delay is None:
+            return fn(self.attempt_timeout())
+
+        # Context is copied, so spans of both requests are reported with the turn
+        primary = _hedge_executor.submit(contextvars.copy_context().run, fn, self.attempt_timeout())
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self._hedges += 1
+        hedge = _hedge_executor.submit(contextvars.copy_context().run, fn, self.attempt_timeout())
+
+        # First successful answer wins. The slower request can not be stopped, it is dropped
+        pending, error = {primary, hedge}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _ahedged(self, fn: Callable[[Optional[float]], Awaitable[T]]) -> T:
+        delay = self.hedge_delay()
+        if delay is None:
+            return await fn(self.attempt_timeout())
+
+        primary = asyncio.ensure_future(fn(self.attempt_timeout()))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self._hedges += 1
+        hedge = asyncio.ensure_future(fn(self.attempt_timeout()))
+
+        pending, error = {primary, hedge}, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, float]:
+        """Returns policy counters
+
+        Returns:
+            Dict[str, float]: Duplicate requests sent and current hedging delay in seconds
+        """
+        return {"hedges": self._hedges, "hedge_delay": self.hedge_delay() or 0.0}
+
+
+# Call policies of the process. Keys are chain names
+_policies: Dict[str, CallPolicy] = {}
+
+
+def call_policy(chain_name: str) -> CallPolicy:
+    """Returns the shared call policy of a chain
+
+    Args:
+        chain_name (str): Name of the chain
+
+    Returns:
+        CallPolicy: Call policy
+    """
+    policy = _policies.get(chain_name)
+    if policy is None:
+        policy = _policies.setdefault(chain_name, CallPolicy(chain_name))
+    return policy
+
+
+def call_policy_stats() -> Dict[str, Dict[str, float]]:
+    """Returns counters of all call policies
+
+    Returns:
+        Dict[str, Dict[str, float]]: Counters per chain name
+    """
+    return {chain_name: policy.stats() for chain_name, policy in list(_policies.items())}
@@ -1,3 +1,7 @@
+import hashlib
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
 from langchain import LLMChain
 from langchain.prompts.chat import (
     ChatPromptTemplate,
@@ -6,10 +10,177 @@ from langchain.prompts.chat import (
 )
 from pydantic import BaseModel, Field
 from langchain.output_parsers import PydanticOutputParser,OutputFixingParser
-from langchain.chat_models import ChatOpenAI
+from langchain.output_parsers.prompts import NAIVE_FIX
 from langchain.llms import BaseLLM
+from Model.CallPolicy.CallPolicy import call_policy
 from Model.Config.Config import config
-from Model.Parsers.Parsers import GuidanceChainParser
+from Model.LLM.Backend import llm_backend
+from Model.LLM.LLM import llm_client_pool
+from Model.Metrics.Metrics import metrics
+from Model.Parsers.Parsers import GuidanceChainParser, guidance_output_parser
+from Model.Tokens.Tokens import count_message_tokens, count_tokens, token_ledger
+
+
+# Prompt inputs which are the same for every session and turn. Only these may appear in the
+# static prefix of prefix-stable prompts
+STATIC_PROMPT_INPUTS = {"ai_name", "persona_description", "persona_attributes", "format_instructions"}
+
+
+@dataclass
+class CompiledChain:
+    """Prompt template, parser and input variables of a chain. Compiled once per worker and
+    shared by every request running the chain.
+    """
+    chain_name: str
+    prompt: ChatPromptTemplate
+    input_variables: List[str]
+    parser: Optional[PydanticOutputParser] = None
+    format_instructions: Optional[str] = None
+    # Prompt layout the chain is compiled with. "default" or "prefix_stable"
+    layout: str = "default"
+    # Number of leading messages which use only static prompt inputs
+    static_message_count: int = 0
+
+    def static_prefix(self, static_inputs: Dict[str, str]) -> str:
+        """Renders leading static messages of the prompt
+
+        Args:
+            static_inputs (Dict[str, str]): Values of static prompt inputs
+
+        Returns:
+            str: Static prefix text
+        """
+        inputs = {**self.prompt.partial_variables, **static_inputs}
+        messages = [
+            template.format(**{name: inputs[name] for name in template.input_variables})
+            for template in self.prompt.messages[:self.static_message_count]
+        ]
+        return "".join(f"{message.type}: {message.content}\n" for message in messages)
+
+    def prefix_fingerprint(self, static_inputs: Dict[str, str]) -> str:
+        """Returns hash of the static prefix. Same fingerprint on every turn means provider-side
+        prompt caching can reuse the prefix.
+
+        Args:
+            static_inputs (Dict[str, str]): Values of static prompt inputs
+
+        Returns:
+            str: Hex digest
+        """
+        return hashlib.sha256(self.static_prefix(static_inputs).encode()).hexdigest()
+
+
+# Compiled chains of the process. Keys are (chain name, use parser, layout)
+_compiled_chains: Dict[Tuple[str, bool, str], CompiledChain] = {}
+
+# LLMChain objects of the process. Keys are (chain name, id of pooled llm, verbose, use parser)
+_llm_chains: Dict[Tuple[str, int, bool, bool], LLMChain] = {}
+
+
+def chain_layout(chain_name: str) -> str:
+    """Returns prompt layout of the chain. Chains without a prefix-stable template use default layout
+
+    Args:
+        chain_name (str): Name of the chain. Must be same with config file.
+
+    Returns:
+        str: "default" or "prefix_stable"
+    """
+    chain_config = config["chains"][chain_name]
+    layout = chain_config.get("prompt_layout", config["PROMPT_LAYOUT"])
+    if layout == "prefix_stable" and "prefix_stable_prompt_template" not in chain_config:
+        return "default"
+    return layout
+
+
+def compile_chain(chain_name: str, use_parser: bool = False, layout: Optional[str] = None) -> CompiledChain:
+    """Builds prompt template, output parser and format instructions of a chain. Results are
+    cached, so config is read only on the first call.
+
+    Args:
+        chain_name (str): Name of the chain. Must be same with config file.
+        use_parser (bool, optional): Whether chain output is parsed. Defaults to False.
+        layout (Optional[str], optional): Prompt layout. Defaults to config file.
+
+    Raises:
+        ValueError: Static prefix of a prefix-stable template uses per-session inputs
+
+    Returns:
+        CompiledChain: Compiled chain
+    """
+    layout = layout or chain_layout(chain_name)
+    key = (chain_name, use_parser, layout)
+    compiled = _compiled_chains.get(key)
+    if compiled is not None:
+        return compiled
+
+    # Read config and get information according to chain name
+    chain_config = config["chains"][chain_name]
+    if layout == "prefix_stable":
+        templates = chain_config["prefix_stable_prompt_template"]
+        messages = [
+            SystemMessagePromptTemplate.from_template(templates["system_prompt_template"]),
+            SystemMessagePromptTemplate.from_template(templates["context_prompt_template"]),
+            HumanMessagePromptTemplate.from_template(templates["human_prompt_template"]),
+        ]
+
+        # Static prefix must be byte-identical on every turn
+        variable_inputs = set(messages[0].input_variables) - STATIC_PROMPT_INPUTS
+        if variable_inputs:
+            raise ValueError(
+                f"Static prefix of {chain_name} uses per-session inputs: {sorted(variable_inputs)}"
+            )
+    else:
+        messages = [
+            SystemMessagePromptTemplate.from_template(
+                chain_config["prompt_template"]["system_prompt_template"]
+            ),
+            HumanMessagePromptTemplate.from_template(
+                chain_config["prompt_template"]["human_prompt_template"]
+            ),
+        ]
+    prompt_input = list(chain_config["prompt_inputs"])
+
+    static_message_count = 0
+    for message in messages:
+        if not set(message.input_variables) <= STATIC_PROMPT_INPUTS:
+            break
+        static_message_count += 1
+
+    parser = None
+    format_instructions = None
+    if use_parser:
+        parser = PydanticOutputParser(pydantic_object=globals()[chain_name + "Parser"])
+        format_instructions = parser.get_format_instructions()
+
+        # Prompt template of chain
+        prompt = ChatPromptTemplate(
+            messages=messages,
+            input_variables=prompt_input,
+            output_parser=parser,
+            partial_variables={"format_instructions": format_instructions},
+        )
+    else:
+        # Prompt template of chain
+        prompt = ChatPromptTemplate(messages=messages, input_variables=prompt_input)
+
+    compiled = CompiledChain(
+        chain_name=chain_name,
+        prompt=prompt,
+        input_variables=prompt_input,
+        parser=parser,
+        format_instructions=format_instructions,
+        layout=layout,
+        static_message_count=static_message_count,
+    )
+    _compiled_chains[key] = compiled
+    return compiled
+
+
+def compile_all_chains():
+    """Compiles every chain in config file. Called at import time of the application"""
+    for chain_name, chain_config in config["chains"].items():
+        compile_chain(chain_name=chain_name, use_parser=chain_config["use_parser"])
 
 
 class BaseChain(LLMChain):
@@ -25,48 +196,28 @@ class BaseChain(LLMChain):
         verbose: bool = False,
         use_parser: bool = False,
     ) -> LLMChain:
-        """Class method which has been inherited from LLMChain class.
+        """Class method which has been inherited from LLMChain class. Chains are cached per
+        pooled llm, so prompt and parser are built only once.
 
         Args:
             llm (BaseLLM): Langchain LLM Object to use
             chain_name (str): Name of the chain created
             verbose (bool, optional): Show inner dialog of chain. Defaults to True.
+            use_parser (bool, optional): Parse output with the chain parser. Defaults to False.
 
         Returns:
             LLMChain: Chain with given prompt template, llm type and verbose choice
         """
+        key = (chain_name, id(llm), verbose, use_parser)
+        chain = _llm_chains.get(key)
+        if chain is None or chain.llm is not llm:
+            compiled = compile_chain(chain_name=chain_name, use_parser=use_parser)
 
-        # Read config and get information according to chain name
-        chain_config = config["chains"][chain_name]
-        messages = [
-            SystemMessagePromptTemplate.from_template(
-                chain_config["prompt_template"]["system_prompt_template"]
-            ),
-            HumanMessagePromptTemplate.from_template(
-                chain_config["prompt_template"]["human_prompt_template"]
-            ),
-        ]
-        prompt_input = chain_config["prompt_inputs"]
-
-        if use_parser:
-            # print(globals()[chain_name + "Parser"])
-            parser = PydanticOutputParser(pydantic_object=globals()[chain_name + "Parser"])
-
-            # Prompt template of chain
-            prompt = ChatPromptTemplate(
-                messages=messages,
-                input_variables=prompt_input,
-                output_parser=parser,
-                partial_variables={
-                    "format_instructions": parser.get_format_instructions()
-                },
-            )
-        else:
-            # Prompt template of chain
-            prompt = ChatPromptTemplate(messages=messages, input_variables=prompt_input)
+            # LLMChain object which can be used to get response from OpenAI ChatGPT.
+            chain = cls(prompt=compiled.prompt, llm=llm, verbose=verbose)
+            _llm_chains[key] = chain
 
-        # Returns a LLMChain object which can be used to get response from OpenAI ChatGPT.
-        return cls(prompt=prompt, llm=llm, verbose=verbose)
+        return chain
 
 
 class Chain(object):
@@ -86,6 +237,8 @@ class Chain(object):
                 temperature: Initial temperature value of the chain. Defaults to config file
                 verbose: Initial verbose value of the chain. Defaults to config file
                 use_parser: Initial parser requirement bool. Determine wheter to use parse or not. Defaults to config file.
+                max_input_tokens: Token budget of the prompt. Defaults to config file
+                max_output_tokens: Maximum tokens of the answer. Defaults to config file
         """
         self._chain_name = chain_name
         self._chain_config = config["chains"][chain_name]
@@ -95,6 +248,11 @@ class Chain(object):
         self._temperature = kwargs.get("temperature", self._chain_config["temperature"])
         self._verbose = kwargs.get("verbose", self._chain_config["verbose"])
         self._use_parser = kwargs.get("use_parser", self._chain_config["use_parser"])
+        self._max_input_tokens = kwargs.get("max_input_tokens", self._chain_config.get("max_input_tokens"))
+        self._max_output_tokens = kwargs.get("max_output_tokens", self._chain_config.get("max_output_tokens"))
+
+        # Timeouts, retries, hedging and circuit breaker of LLM calls. Shared by the chain's objects
+        self._policy = call_policy(chain_name)
 
     @property
     def chain_name(self):
@@ -120,6 +278,77 @@ class Chain(object):
     def require_parser(self):
         return self._use_parser
 
+    @property
+    def max_input_tokens(self):
+        return self._max_input_tokens
+
+    @property
+    def max_output_tokens(self):
+        return self._max_output_tokens
+
+    def count_input_tokens(self, inputs) -> int:
+        """Counts prompt tokens of the chain for given inputs locally
+
+        Args:
+            inputs (dict): Required inputs for chain's prompt template.
+
+        Returns:
+            int: Number of prompt tokens
+        """
+        compiled = compile_chain(chain_name=self._chain_name, use_parser=self._use_parser)
+        return count_message_tokens(compiled.prompt.format_messages(**inputs))
+
+    def _record_tokens(self, model_name: str, prompt_tokens: int, completion: str):
+        token_ledger.record(
+            chain_name=self._chain_name,
+            model_name=model_name,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=count_tokens(completion),
+            max_input_tokens=self._max_input_tokens,
+        )
+
+    def _parse(self, chain: LLMChain, completion: str):
+        # Answers of chains without a parser are returned as they are
+        if not self._use_parser:
+            return completion
+        with metrics.span("parse", chain=self._chain_name):
+            if self._chain_config.get("tolerant_parsing"):
+                return guidance_output_parser.parse(completion, repair=self._repair)
+            return chain.prompt.output_parser.parse(completion)
+
+    async def _aparse(self, chain: LLMChain, completion: str):
+        # Async version of _parse. Repair call does not block the event loop
+        if not self._use_parser:
+            return completion
+        with metrics.span("parse", chain=self._chain_name):
+            if self._chain_config.get("tolerant_parsing"):
+                return await guidance_output_parser.aparse(completion, repair=self._arepair)
+            return chain.prompt.output_parser.parse(completion)
+
+    def _repair_chain(self) -> Tuple[LLMChain, dict]:
+        repair_config = config["OUTPUT_REPAIR"]
+        llm = llm_client_pool.get(
+            model_name=repair_config["model_name"], temperature=0, max_tokens=repair_config["max_tokens"]
+        )
+        compiled = compile_chain(chain_name=self._chain_name, use_parser=self._use_parser)
+        chain = LLMChain(llm=llm, prompt=ChatPromptTemplate.from_template(NAIVE_FIX))
+        return chain, {"instructions": compiled.format_instructions, "error": "Answer is not in the given format"}
+
+    def _repair(self, completion: str) -> str:
+        # Last resort of tolerant parsing. A cheap model rewrites the answer in the format
+        chain, inputs = self._repair_chain()
+        inputs = {**inputs, "completion": completion}
+        with metrics.span("repair", chain=self._chain_name, model=chain.llm.model_name):
+            return self._policy.call(chain.llm.model_name, lambda timeout: llm_backend.predict(chain, inputs, timeout))
+
+    async def _arepair(self, completion: str) -> str:
+        chain, inputs = self._repair_chain()
+        inputs = {**inputs, "completion": completion}
+        with metrics.span("repair", chain=self._chain_name, model=chain.llm.model_name):
+            return await self._policy.acall(
+                chain.llm.model_name, lambda timeout: llm_backend.apredict(chain, inputs, timeout)
+            )
+
     def run(self, inputs, **kwargs) -> (BaseModel, LLMChain):
         """Runs the chain according to inputs and keyword arguments
 
@@ -131,31 +360,124 @@ class Chain(object):
                 model_name(str): Initial model name of the chain. Defaults to config file
                 temperature(float): Initial temperature value of the chain. Defaults to config file
                 verbose(bool): Initial verbose value of the chain. Defaults to config file
+                max_tokens(int): Maximum tokens of the answer. Defaults to config file
+                prompt_tokens(int): Prompt tokens counted by the caller. Counted here if not given
 
         Returns:
             (response, chain) (tuple): Response is string answer from chain. Chain is the used chain object
         """
         
-        # Creating LLM
-        llm = ChatOpenAI(
-            model_name=kwargs.get("model_name", self._model_name),
-            openai_api_key=config["OPEN_AI_API_KEY"],
+        # Getting pooled LLM
+        model_name = kwargs.get("model_name", self._model_name)
+        llm = llm_client_pool.get(
+            model_name=model_name,
             temperature=kwargs.get("temperature", self._temperature),
+            max_tokens=kwargs.get("max_tokens", self._max_output_tokens),
         )
 
         # Create chain from BaseChain
-        chain = BaseChain.runChain(
-            llm=llm,
-            chain_name=self._chain_name,
-            verbose=kwargs.get("verbose", self._verbose),
-            use_parser=self._use_parser,
+        with metrics.span("chain_build", chain=self._chain_name):
+            chain = BaseChain.runChain(
+                llm=llm,
+                chain_name=self._chain_name,
+                verbose=kwargs.get("verbose", self._verbose),
+                use_parser=self._use_parser,
+            )
+
+        prompt_tokens = kwargs.get("prompt_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = self.count_input_tokens(inputs)
+
+        # Getting answer with inputs from created chain. Deadline, retries and hedging are up to the policy
+        with metrics.span("llm", chain=self._chain_name, model=model_name):
+            completion = self._policy.call(model_name, lambda timeout: llm_backend.predict(chain, inputs, timeout))
+        self._record_tokens(model_name=model_name, prompt_tokens=prompt_tokens, completion=completion)
+
+        answer = self._parse(chain, completion)
+        # Return both answer and chain itself
+        return answer, chain
+
+    async def arun(self, inputs, **kwargs) -> (BaseModel, LLMChain):
+        """Async version of run method. Awaits LLM without blocking the event loop
+
+        Args:
+            inputs (dict): Required inputs for chain's prompt template.
+            **kwargs (dict): Keyword arguments. Same with run method
+
+        Returns:
+            (response, chain) (tuple): Response is string answer from chain. Chain is the used chain object
+        """
+
+        # Getting pooled LLM
+        model_name = kwargs.get("model_name", self._model_name)
+        llm = llm_client_pool.get(
+            model_name=model_name,
+            temperature=kwargs.get("temperature", self._temperature),
+            max_tokens=kwargs.get("max_tokens", self._max_output_tokens),
         )
 
-        # Getting answer with inputs from created chain
-        answer = None
-        if self._use_parser:
-            answer = chain.predict_and_parse(**inputs)
-        else:
-            answer = chain.run(**inputs)
+        # Create chain from BaseChain
+        with metrics.span("chain_build", chain=self._chain_name):
+            chain = BaseChain.runChain(
+                llm=llm,
+                chain_name=self._chain_name,
+                verbose=kwargs.get("verbose", self._verbose),
+                use_parser=self._use_parser,
+            )
+
+        prompt_tokens = kwargs.get("prompt_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = self.count_input_tokens(inputs)
+
+        # Getting answer with inputs from created chain. Deadline, retries and hedging are up to the policy
+        with metrics.span("llm", chain=self._chain_name, model=model_name):
+            completion = await self._policy.acall(
+                model_name, lambda timeout: llm_backend.apredict(chain, inputs, timeout)
+            )
+        self._record_tokens(model_name=model_name, prompt_tokens=prompt_tokens, completion=completion)
+
+        answer = await self._aparse(chain, completion)
         # Return both answer and chain itself
         return answer, chain
+
+    def stream(self, inputs, **kwargs) -> Iterator[str]:
+        """Runs the chain and yields answer tokens while they arrive from LLM. Chains with a
+        parser can not be streamed, their parsed answer is yielded at once.
+
+        Args:
+            inputs (dict): Required inputs for chain's prompt template.
+            **kwargs (dict): Keyword arguments. Same with run method
+
+        Yields:
+            str: Parts of the answer
+        """
+        if self._use_parser:
+            yield str(self.run(inputs, **kwargs)[0])
+            return
+
+        # Getting pooled LLM
+        model_name = kwargs.get("model_name", self._model_name)
+        llm = llm_client_pool.get(
+            model_name=model_name,
+            temperature=kwargs.get("temperature", self._temperature),
+            max_tokens=kwargs.get("max_tokens", self._max_output_tokens),
+        )
+
+        # Fill compiled prompt and stream chunks from LLM
+        compiled = compile_chain(chain_name=self._chain_name, use_parser=self._use_parser)
+        messages = compiled.prompt.format_messages(**inputs)
+        prompt_tokens = kwargs.get("prompt_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = count_message_tokens(messages)
+
+        parts = []
+        try:
+            with metrics.span("llm", chain=self._chain_name, model=model_name):
+                for part in self._policy.stream(
+                        model_name, lambda timeout: llm_backend.stream(llm, messages, timeout)
+                ):
+                    parts.append(part)
+                    yield part
+        finally:
+            # Answers cut by a closed stream are recorded with the tokens received
+            self._record_tokens(model_name=model_name, prompt_tokens=prompt_tokens, completion="".join(parts))
@@ -0,0 +1,88 @@
+"""Reports the cacheable prompt prefix share of every chain, offline.
+
+Renders each chain's prompt for two different sessions and turns with both layouts. The
+common prefix of the two prompts is what provider-side prompt caching can reuse. Also
+checks that the static prefix fingerprint of prefix-stable prompts is identical for both.
+
+Usage:
+    python -m Model.Chain.prefix_report
+"""
+import os
+
+from Model.Chain.Chain import compile_chain
+from Model.Config.Config import config
+from Model.Memory.Memory import BaseMemory
+from Model.Persona.Persona import Persona
+from Model.Tokens.Tokens import count_tokens
+
+SAMPLE_TURNS = [
+    [
+        ("User", "Hi, I want to lose some weight before summer."),
+        ("Healty Diet Assistant", "Great goal! Let's start with your current eating habits. And drink water!"),
+        ("User", "I usually skip breakfast and eat a big dinner."),
+    ],
+    [
+        ("User", "What should I eat after a workout?"),
+        ("Healty Diet Assistant", "A mix of protein and carbs, like yogurt with fruit. Stay hydrated!"),
+        ("User", "I am vegan, any other ideas?"),
+        ("Healty Diet Assistant", "Sure! A smoothie with soy milk, banana and peanut butter works well."),
+        ("User", "How much protein do I need per day?"),
+    ],
+]
+
+
+def sample_inputs(turns) -> dict:
+    memory = BaseMemory()
+    for by, message in turns:
+        memory.append(by=by, message=message)
+
+    persona = Persona()
+    return {
+        "ai_name": "Healty Diet Assistant",
+        "memory": str(memory),
+        "text": turns[-1][1],
+        "persona_description": persona.description,
+        "persona_attributes": persona.attributes,
+        "summary": f"The user said: {turns[0][1]}",
+        "messages": str(memory),
+    }
+
+
+def render(compiled, inputs: dict) -> str:
+    messages = compiled.prompt.format_messages(**{name: inputs[name] for name in compiled.input_variables})
+    return "".join(f"{message.type}: {message.content}\n" for message in messages)
+
+
+def main():
+    samples = [sample_inputs(turns) for turns in SAMPLE_TURNS]
+    static_inputs = {name: samples[0][name] for name in ("ai_name", "persona_description", "persona_attributes")}
+
+    print(f"{'chain':<20}{'layout':<15}{'tokens':>8}{'prefix':>8}{'share':>8}  fingerprint")
+    for chain_name, chain_config in config["chains"].items():
+        layouts = ["default"]
+        if "prefix_stable_prompt_template" in chain_config:
+            layouts.append("prefix_stable")
+
+        for layout in layouts:
+            compiled = compile_chain(chain_name, use_parser=chain_config["use_parser"], layout=layout)
+            prompts = [render(compiled, inputs) for inputs in samples]
+
+            prefix = os.path.commonprefix(prompts)
+            total_tokens = sum(count_tokens(prompt) for prompt in prompts) / len(prompts)
+            prefix_tokens = count_tokens(prefix)
+
+            fingerprint = "-"
+            if compiled.static_message_count:
+                # Static prefix must be byte-identical in the prompt of every session
+                static_prefix = compiled.static_prefix(static_inputs)
+                stable = all(prompt.startswith(static_prefix) for prompt in prompts)
+                fingerprint = f"{compiled.prefix_fingerprint(static_inputs)[:16]} {'stable' if stable else 'UNSTABLE'}"
+
+            print(
+                f"{chain_name:<20}{layout:<15}{total_tokens:>8.0f}{prefix_tokens:>8}"
+                f"{prefix_tokens / total_tokens:>8.1%}  {fingerprint}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,35 @@ import ujson
 from dotenv import load_dotenv
 load_dotenv()
 open_ai_api_key = os.getenv("OPEN_AI_API_KEY")
+open_ai_api_base = os.getenv("OPEN_AI_API_BASE")
+
+# Read relative to this file, so the config loads from any working directory
+ATTRIBUTES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "attributes.json")
+ROUTER_MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Router", "router.json")
+
+
 def read_persona_attributes():
-    f = open("Model/Config/attributes.json")
-    loaded = ujson.load(f)
+    with open(ATTRIBUTES_PATH) as f:
+        loaded = ujson.load(f)
     return str(ujson.dumps(loaded, indent=1)).replace("{", "").replace("}", "")
 
 
+def optional_float_env(name: str, default: float):
+    # Empty value or "none" of the environment variable is None
+    value = os.getenv(name)
+    if value is None:
+        return default
+    if value.strip().lower() in ("", "none"):
+        return None
+    return float(value)
+
+
 config = {
     # Open AI API key to request
     "OPEN_AI_API_KEY": open_ai_api_key,
+    # Base url of OpenAI compatible API. None uses api.openai.com. Benchmarks point it to
+    # benchmarks/fake_openai.py
+    "OPEN_AI_API_BASE": open_ai_api_base,
     # PersonaChatbot AI Agent names.
     "AGENTS_NAMES": [
         "GuidanceAgent",
@@ -27,8 +47,204 @@ config = {
         **dict.fromkeys(["2", "B"], 2),
         **dict.fromkeys(["3", "C"], 3),
     },
-    # Long-Term memory sliding window. Still working on. Not implemented
+    # Shared HTTP connection pool of LLM clients. One pool per worker process
+    "LLM_CLIENT_POOL": {
+        "max_connections": 20,
+        "max_keepalive_connections": 10,
+        "keepalive_expiry": 30.0,
+        "timeout": 120.0,
+        # Retries are made by CALL_POLICY, the OpenAI client does not retry on its own
+        "max_retries": 0,
+    },
+    # Backend of LLM calls. "live" calls the LLM, "record" calls it and appends every request
+    # and answer to the recording, "replay" answers from the recording without the LLM
+    "LLM_BACKEND": {
+        "mode": os.getenv("LLM_BACKEND", "live"),
+        "recording_path": os.getenv("LLM_RECORDING_PATH", "llm_recording.bin"),
+        # Simulated latency of replayed answers. "recorded", seconds or None to answer at once
+        "replay_latency": os.getenv("LLM_REPLAY_LATENCY"),
+        # Requests which are not recorded. "error" raises LookupError, "live" calls the LLM
+        "on_miss": os.getenv("LLM_REPLAY_ON_MISS", "error"),
+    },
+    # Timeouts, retries, hedging and circuit breakers of LLM calls. See Model/CallPolicy
+    "CALL_POLICY": {
+        # Seconds a chat turn may take, shared by all of its LLM calls. None for no deadline, set
+        # TURN_DEADLINE empty or to "none"
+        "turn_deadline": optional_float_env("TURN_DEADLINE", 60.0),
+        # Seconds one LLM call may take, for chains without their own timeout
+        "timeout": 30.0,
+        # Attempts of a call failing with timeouts, connection, rate limit or server errors
+        "max_attempts": 3,
+        # Jittered exponential backoff between attempts, in seconds
+        "backoff_multiplier": 0.5,
+        "backoff_max": 8.0,
+        # Hedged calls wait at least this many seconds before the duplicate request
+        "hedge_min_delay": 1.0,
+        # Latency quantile of the recent calls after which the duplicate request is sent
+        "hedge_quantile": 0.95,
+        # Number of recent call latencies kept per chain
+        "hedge_window": 200,
+        # Consecutive failures of a model opening its circuit
+        "breaker_failures": 5,
+        # Seconds an open circuit fails calls fast before a trial call
+        "breaker_reset_timeout": 30.0,
+        # Agent answering when routing fails because of the LLM provider. None to fail the turn
+        "fallback_agent": "ConversationAgent",
+    },
+    # /api/chat/batch. Messages of different sessions run concurrently, messages of the same
+    # session run in order
+    "BATCH_CHAT": {
+        # Maximum items of a batch request
+        "max_items": 1000,
+        # Maximum sessions running at the same time per batch
+        "concurrency": 16,
+    },
+    # Model of a chain chosen per turn from a ladder of tiers. Turns are scored locally from input
+    # length, questions, nutrition terms and conversation state between 0 and 1, and get the first
+    # tier whose max_score is at least their score. Last tier has no max_score
+    "MODEL_TIERING": {
+        "enabled": os.getenv("MODEL_TIERING_ENABLED", "0") == "1",
+        "chains": {
+            "ConversationChain": [
+                # Acknowledgements, greetings and short small talk
+                {"name": "fast", "model_name": "gpt-3.5-turbo", "max_score": 0.3, "max_output_tokens": 300},
+                {"name": "standard", "model_name": "gpt-4-1106-preview", "max_score": None},
+            ],
+        },
+        # Number of recent latencies kept per tier
+        "latency_window": 200,
+    },
+    # Repair call of tolerant parsing. Rewrites an answer which could not be parsed locally
+    "OUTPUT_REPAIR": {
+        "model_name": "gpt-3.5-turbo",
+        "max_tokens": 200,
+    },
+    # Speculative routing. Runs the most likely agent of the session at the same time as
+    # GuidanceAgent and keeps its answer when routing agrees
+    "SPECULATIVE_ROUTING": {
+        "enabled": False,
+        # Number of last routed agents used for the prediction
+        "history_window": 5,
+        # Minimum share of the most common agent in the window to speculate
+        "min_agreement": 0.6,
+        # Predicted agent of sessions without routing history
+        "default_agent": "ConversationAgent",
+        # Maximum speculative agents running at the same time per worker
+        "max_workers": 32,
+        # A mispredicted agent of the sync pipeline can not be stopped, so every miss doubles the agent
+        # cost of the turn. Sync turns speculate only while the hit rate of the last hit_rate_window
+        # speculations is at least min_hit_rate, measured after min_samples of them. Below it, one
+        # turn in probe_every speculates to measure it again
+        "min_hit_rate": 0.7,
+        "hit_rate_window": 100,
+        "min_samples": 20,
+        "probe_every": 10,
+    },
+    # Local fast-path router in front of GuidanceAgent. Trained from the routing log with
+    # `python -m Model.Router.train`
+    "LOCAL_ROUTER": {
+        "enabled": False,
+        "model_path": ROUTER_MODEL_PATH,
+        # Minimum confidence to route without GuidanceAgent
+        "confidence_threshold": 0.9,
+        # JSON lines file of routing decisions. Logging is disabled if None
+        "log_path": os.getenv("ROUTING_LOG_PATH"),
+    },
+    # Store of session memories. "memory" keeps sessions in the worker process, "sqlite" shares
+    # them between workers of a host and "redis" between hosts
+    "SESSION_STORE": {
+        "backend": os.getenv("SESSION_STORE_BACKEND", "memory"),
+        "sqlite_path": os.getenv("SESSION_STORE_SQLITE_PATH", "sessions.sqlite3"),
+        "redis_url": os.getenv("SESSION_STORE_REDIS_URL", "redis://127.0.0.1:6379/0"),
+        # Seconds a session lives after its last message on redis and in the in-process store. None never expires
+        "ttl": 7 * 24 * 60 * 60,
+        # Maximum sessions of the in-process store, which keeps evicted sessions of the worker. None is unbounded
+        "max_sessions": 10000,
+    },
+    # Append-only log of memory changes, so sessions of the in-process session store survive worker
+    # restarts. Shared session stores already keep every session
+    "SESSION_LOG": {
+        "enabled": os.getenv("SESSION_LOG_ENABLED", "0") == "1",
+        "directory": os.getenv("SESSION_LOG_DIRECTORY", "session_log"),
+        # "always" answers turns after their records are on disk, "interval" syncs every
+        # fsync_interval seconds, "never" leaves it to the OS
+        "fsync": os.getenv("SESSION_LOG_FSYNC", "interval"),
+        "fsync_interval": 1.0,
+        # Records of a session between its snapshots. Restore reads the snapshot and at most this many records
+        "snapshot_every": 50,
+        # Size a log segment file is finished at. Finished segments are deleted by compaction
+        "segment_bytes": 64 * 1024 * 1024,
+    },
+    # Turns of a session run one at a time per worker. Repeated requests share the turn they repeat
+    "SESSION_TURNS": {
+        # Seconds the same message of a session in the same conversation state is answered with
+        # the previous turn, for double submits without an idempotency_key. 0 disables
+        "dedupe_window": 0,
+        # Seconds results of requests with an idempotency_key are kept
+        "idempotency_ttl": 10 * 60,
+        # Maximum finished turns kept per kind of key
+        "max_keys": 10000,
+    },
+    # Sessions kept alive in a worker. Least recently used and idle sessions are evicted
+    "SESSION_CACHE": {
+        "max_sessions": 1000,
+        # Seconds a session without messages stays in the worker
+        "idle_ttl": 60 * 60,
+        # Save evicted sessions to the in-process session store, so they can be restored. Bounded by
+        # max_sessions and ttl of SESSION_STORE. Shared stores already have every session
+        "persist_on_evict": os.getenv("SESSION_PERSIST_ON_EVICT", "0") == "1",
+    },
+    # Cache of chain answers keyed on chain config, persona, recent conversation and
+    # normalized user input
+    "RESPONSE_CACHE": {
+        "enabled": False,
+        "chains": ["ConversationChain"],
+        "max_size": 10000,
+        # Seconds an unused answer lives
+        "ttl": 60 * 60,
+        # Number of messages before the user input which must match
+        "context_window": 4,
+        # Calls with higher temperature are never cached
+        "max_temperature": 0.3,
+    },
+    # Cache of GuidanceAgent decisions keyed on the last messages of the conversation, shared by
+    # all sessions of a worker
+    "ROUTING_CACHE": {
+        "enabled": os.getenv("ROUTING_CACHE_ENABLED", "0") == "1",
+        # Number of last messages in the key, including the user input
+        "tail_size": 3,
+        "max_size": 10000,
+        # Seconds an unused decision lives
+        "ttl": 60 * 60,
+    },
+    # Prompt assembly of chains. "default" uses prompt_template. "prefix_stable" uses
+    # prefix_stable_prompt_template of chains which have it: static content (role, persona,
+    # instructions) comes first in a byte-identical prefix and per-session content (memory,
+    # user input) last, so provider-side prompt caching can reuse the prefix
+    "PROMPT_LAYOUT": os.getenv("PROMPT_LAYOUT", "default"),
+    # Prompt and completion tokens of chain calls. Totals are kept per chain in every worker
+    "TOKEN_ACCOUNTING": {
+        # JSON lines file of every chain call. Logging is disabled if None
+        "log_path": os.getenv("TOKEN_LOG_PATH"),
+    },
+    # Stage latency histograms and stats on /metrics in Prometheus text format
+    "METRICS": {
+        # Directory where every worker writes its metrics, so /metrics returns totals of all
+        # gunicorn workers. Only metrics of the answering worker are exported if None
+        "multiprocess_dir": os.getenv("METRICS_MULTIPROC_DIR"),
+        # Seconds between metrics writes of a worker, made by a background thread
+        "flush_interval": 5.0,
+        # Upper bounds of latency buckets in seconds
+        "buckets": [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0],
+        # Add Server-Timing header with stage durations to chat responses
+        "server_timing": os.getenv("SERVER_TIMING", "false").lower() == "true",
+    },
+    # Long-Term memory sliding window. Number of last messages kept verbatim in chat history.
+    # Older messages are folded into a rolling summary by SummaryChain in background.
+    # None keeps the whole history verbatim
     "LONG_TERM_MEMORY_WINDOW_SIZE": 10,
+    # Minimum number of messages folded into the rolling summary at once
+    "LONG_TERM_MEMORY_SUMMARY_BATCH": 4,
     # Opening Conversations for teacher ai
     "PossibleTeacherStartingConversations": [
         "Hello there, I am {ai_name}, an AI teacher. How may I help you?",
@@ -104,12 +320,64 @@ config = {
                     """
                 ),
             },
+            "prefix_stable_prompt_template": {
+                "system_prompt_template": dedent(
+                    """
+                        Goal: To route users to the appropriate agent based on their needs, without interrupting level measurement if the user is already in progress.
+
+                        Steps:
+
+                        1. Check the user's current state. If the user is in the level measurement section, do not change the agent.
+                        2. Read the user's input and identify their goal.
+                        3. Choose the appropriate agent based on the user's goal:
+                            * If the user wants to communicate without specific inquiries, route the user to the Conversation Agent (return '1' or "A").
+                            * If the user explicitly requests a language level assessment, route the user to the Exam Agent (return '2' or "B").
+                            * If the user requests grammar instruction, route the user to the Grammar Agent (return '3' or "C").
+                        4. If you are unsure which agent to choose, ask the user for clarification.
+                        5. Return the number or letter of the chosen agent.
+
+                        Examples of user input:
+
+                        * "I want to learn more about English grammar." (Grammar Agent)
+                        * "Can you measure my language level?" (Exam Agent)
+                        * "I'm looking for a practice conversation." (Conversation Agent)
+
+                        {format_instructions}
+                    """
+                ),
+                "context_prompt_template": dedent(
+                    """
+                        Conversation history: {memory}
+                    """
+                ),
+                "human_prompt_template": dedent(
+                    """What is the next best agent to run according to given conversation history? Please only return 
+                    the number of the agent and reason to choose.
+                    """
+                ),
+            },
             "prompt_inputs": ["ai_name", "memory"],
             "temperature": 0.2,
             "model_name": "gpt-3.5-turbo",
             "verbose": False,
             "use_parser": True,
-            "use_persona": False
+            # Parse answers with GuidanceOutputParser. Letters, numbers, agent names, code fences
+            # and broken JSON are recovered locally before a repair call is made
+            "tolerant_parsing": True,
+            "use_persona": False,
+            # Number of last messages given verbatim in {memory}. None uses LONG_TERM_MEMORY_WINDOW_SIZE
+            "memory_window": 4,
+            # Prepend rolling summary of older messages to {memory}
+            "memory_summary": False,
+            # Token budget of the prompt. Oldest messages in {memory} are left out to fit
+            "max_input_tokens": 3000,
+            # Maximum tokens of the answer
+            "max_output_tokens": 200,
+            # Seconds one LLM call may take. Cut to the time left of the turn deadline
+            "timeout": 15.0,
+            # Send a duplicate request when the first one is slower than the recent p95 latency. Each
+            # duplicate is a paid request, so hedging is opt-in
+            "hedge": False,
         },
         # endregion
         # region ConversationAgent
@@ -147,15 +415,116 @@ config = {
                     """
                 ),
             },
+            "prefix_stable_prompt_template": {
+                "system_prompt_template": dedent(
+                    """
+                    Role: Conversation agent within an AI chatbot, facilitating friendly and 
+                    straightforward conversations between {ai_name} and the user.
+
+                    Behavior:
+                        * Never say you are an AI.
+                        * Always act like a real human.
+                        * Always act according to Persona attributes below.
+                        * Always adjust the complexity of your dialogue according to the user
+                        * Gain insights from the chat history provided after these instructions to better understand the context.
+                        
+                    Persona:
+                    {persona_description}
+                    {persona_attributes}
+                    
+                    Instructions:
+                        * Generate text that is friendly, informative, and helpful.
+                        * Be creative and engaging in your responses.
+                        * Answer questions accurately and comprehensively.
+                        * Avoid making claims of sentience or consciousness.
+                    """
+                ),
+                "context_prompt_template": dedent(
+                    """
+                    Chat History: 
+                    {memory}
+                    """
+                ),
+                "human_prompt_template": dedent(
+                    """
+                        User: {text}
+                    """
+                ),
+            },
             "prompt_inputs": ["ai_name", "memory", "text", "persona_description", "persona_attributes"],
             "temperature": 0.2,
             "model_name": "gpt-4-1106-preview",
             "verbose": False,
             "use_parser": False,
-            "use_persona": True
+            "use_persona": True,
+            "memory_window": None,
+            "memory_summary": True,
+            # Budgets are not set, answers and chat history are only limited by the model. Set them
+            # to cap cost, answers and history over them are cut
+            "max_input_tokens": None,
+            "max_output_tokens": None,
+            "timeout": 45.0,
+            "hedge": False,
         },
         # endregion
         # endregion
+        # region Memory
+        "SummaryChain": {
+            "prompt_template": {
+                "system_prompt_template": dedent(
+                    """
+                    Progressively summarize the lines of conversation provided, adding onto the previous summary.
+                    Keep facts about the user such as goals, preferences, restrictions and health conditions.
+                    
+                    Previous summary:
+                    {summary}
+                    
+                    New lines of conversation:
+                    {messages}
+                    """
+                ),
+                "human_prompt_template": dedent(
+                    """
+                        Return only the new summary.
+                    """
+                ),
+            },
+            "prefix_stable_prompt_template": {
+                "system_prompt_template": dedent(
+                    """
+                    Progressively summarize the lines of conversation provided, adding onto the previous summary.
+                    Keep facts about the user such as goals, preferences, restrictions and health conditions.
+                    """
+                ),
+                "context_prompt_template": dedent(
+                    """
+                    Previous summary:
+                    {summary}
+                    
+                    New lines of conversation:
+                    {messages}
+                    """
+                ),
+                "human_prompt_template": dedent(
+                    """
+                        Return only the new summary.
+                    """
+                ),
+            },
+            "prompt_inputs": ["summary", "messages"],
+            "temperature": 0.0,
+            "model_name": "gpt-3.5-turbo",
+            "verbose": False,
+            "use_parser": False,
+            "use_persona": False,
+            "memory_window": None,
+            "memory_summary": False,
+            "max_input_tokens": None,
+            "max_output_tokens": None,
+            "timeout": 60.0,
+            "hedge": False,
+        },
+        # endregion
     },
     "agents": {
         "GuidanceAgent": {
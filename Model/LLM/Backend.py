@@ -0,0 +1,295 @@
+import asyncio
+import hashlib
+import os
+import struct
+import zlib
+from threading import Lock
+from time import perf_counter, sleep
+from typing import Dict, Iterator, List, Optional, Union
+
+import ujson
+from langchain import LLMChain
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import BaseMessage
+
+from Model.Config.Config import config
+
+
+def request_key(llm: ChatOpenAI, messages: List[BaseMessage]) -> str:
+    """Returns key of an LLM request. Same model settings and prompt give the same key
+
+    Args:
+        llm (ChatOpenAI): LLM client of the request
+        messages (List[BaseMessage]): Formatted prompt messages
+
+    Returns:
+        str: Hex digest
+    """
+    payload = ujson.dumps([
+        llm.model_name,
+        float(llm.temperature),
+        llm.max_tokens,
+        [[message.type, message.content] for message in messages],
+    ])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class LLMRecording:
+    """Append-only file of recorded LLM answers. Every record is a 4 byte big-endian length
+    followed by zlib-compressed JSON, written with a single append, so workers can record into
+    the same file. The whole file is indexed by request key on open.
+    """
+
+    def __init__(self, path: str):
+        """Constructor of LLMRecording class
+
+        Args:
+            path (str): Recording file path
+        """
+        self._path = path
+        self._lock = Lock()
+
+        # Request key -> recorded answers in recording order, and the next one to replay
+        self._records: Dict[str, List[dict]] = {}
+        self._positions: Dict[str, int] = {}
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            offset = 0
+            while offset + 4 <= len(data):
+                (length,) = struct.unpack_from(">I", data, offset)
+                record = ujson.loads(zlib.decompress(data[offset + 4:offset + 4 + length]))
+                self._records.setdefault(record["key"], []).append(record)
+                offset += 4 + length
+
+    def __len__(self):
+        return sum(len(records) for records in self._records.values())
+
+    def append(self, record: dict):
+        """Appends a record
+
+        Args:
+            record (dict): Record with key, completion and latency fields
+        """
+        data = zlib.compress(ujson.dumps(record).encode())
+        with self._lock:
+            with open(self._path, "ab") as f:
+                f.write(struct.pack(">I", len(data)) + data)
+            self._records.setdefault(record["key"], []).append(record)
+
+    def next(self, key: str) -> Optional[dict]:
+        """Returns the next recorded answer of a request. Answers recorded for the same request
+        are replayed in recording order, then again from the first one.
+
+        Args:
+            key (str): Request key
+
+        Returns:
+            Optional[dict]: Record. None if the request was not recorded
+        """
+        records = self._records.get(key)
+        if not records:
+            return None
+        with self._lock:
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+        return records[position % len(records)]
+
+
+class LLMBackend:
+    """Sends chain prompts to the LLM. Chain.run, arun and stream get completions through the
+    backend, so LLM calls can be recorded and replayed without touching the rest of the stack.
+    """
+
+    def predict(self, chain: LLMChain, inputs: dict, timeout: Optional[float] = None) -> str:
+        """Returns raw completion of the chain
+
+        Args:
+            chain (LLMChain): Chain with pooled LLM
+            inputs (dict): Prompt inputs
+            timeout (Optional[float], optional): Request timeout in seconds. Defaults to None, timeout of the pool
+
+        Returns:
+            str: Completion text
+        """
+        if timeout is None:
+            return chain.predict(**inputs)
+        # LLMChain can not pass arguments of a single request, so the LLM is called directly
+        return chain.llm.predict_messages(chain.prompt.format_messages(**inputs), timeout=timeout).content
+
+    async def apredict(self, chain: LLMChain, inputs: dict, timeout: Optional[float] = None) -> str:
+        """Async version of predict"""
+        if timeout is None:
+            return await chain.apredict(**inputs)
+        message = await chain.llm.apredict_messages(chain.prompt.format_messages(**inputs), timeout=timeout)
+        return message.content
+
+    def stream(self, llm: ChatOpenAI, messages: List[BaseMessage], timeout: Optional[float] = None) -> Iterator[str]:
+        """Yields completion parts while they arrive
+
+        Args:
+            llm (ChatOpenAI): Pooled LLM
+            messages (List[BaseMessage]): Formatted prompt messages
+            timeout (Optional[float], optional): Request timeout in seconds. Defaults to None, timeout of the pool
+
+        Yields:
+            str: Parts of the completion
+        """
+        chunks = llm.stream(messages, timeout=timeout) if timeout is not None else llm.stream(messages)
+        for chunk in chunks:
+            if chunk.content:
+                yield chunk.content
+
+
+class RecordingLLMBackend(LLMBackend):
+    """Live backend which also writes every request and answer to a recording"""
+
+    def __init__(self, recording: LLMRecording):
+        self._recording = recording
+
+    def _record(self, llm: ChatOpenAI, messages: List[BaseMessage], completion: str, latency: float, **kwargs):
+        self._recording.append({
+            "key": request_key(llm, messages),
+            "model_name": llm.model_name,
+            "completion": completion,
+            "latency": latency,
+            **kwargs,
+        })
+
+    def predict(self, chain: LLMChain, inputs: dict, timeout: Optional[float] = None) -> str:
+        start = perf_counter()
+        completion = super().predict(chain, inputs, timeout)
+        self._record(chain.llm, chain.prompt.format_messages(**inputs), completion, perf_counter() - start)
+        return completion
+
+    async def apredict(self, chain: LLMChain, inputs: dict, timeout: Optional[float] = None) -> str:
+        start = perf_counter()
+        completion = await super().apredict(chain, inputs, timeout)
+        self._record(chain.llm, chain.prompt.format_messages(**inputs), completion, perf_counter() - start)
+        return completion
+
+    def stream(self, llm: ChatOpenAI, messages: List[BaseMessage], timeout: Optional[float] = None) -> Iterator[str]:
+        start = perf_counter()
+        first_token_latency = None
+        parts = []
+        for part in super().stream(llm, messages, timeout):
+            if first_token_latency is None:
+                first_token_latency = perf_counter() - start
+            parts.append(part)
+            yield part
+
+        # Only complete answers are recorded
+        self._record(
+            llm, messages, "".join(parts), perf_counter() - start,
+            first_token_latency=first_token_latency, parts=len(parts),
+        )
+
+
+class ReplayLLMBackend(LLMBackend):
+    """Serves recorded answers without calling the LLM"""
+
+    def __init__(self, recording: LLMRecording, **kwargs):
+        """Constructor of ReplayLLMBackend class
+
+        Args:
+            recording (LLMRecording): Recorded answers
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                latency (Union[str, float, None]): Simulated latency. "recorded" waits as long as the
+            recorded call, a number waits that many seconds, None answers at once. Defaults to None
+                on_miss (str): "error" raises LookupError for requests not recorded, "live" calls the
+            LLM. Defaults to "error"
+        """
+        self._recording = recording
+        latency = kwargs.get("latency", None)
+        # Numbers may come as strings from environment variables
+        self._latency: Union[str, float, None] = float(latency) if latency not in (None, "recorded") else latency
+        self._on_miss = kwargs.get("on_miss", "error")
+        self._hits = 0
+        self._misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Returns replay counters
+
+        Returns:
+            Dict[str, int]: Replayed and not recorded requests
+        """
+        return {"hits": self._hits, "misses": self._misses}
+
+    def _lookup(self, llm: ChatOpenAI, messages: List[BaseMessage]) -> Optional[dict]:
+        record = self._recording.next(request_key(llm, messages))
+        if record is None:
+            self._misses += 1
+            if self._on_miss != "live":
+                raise LookupError(f"LLM request of {llm.model_name} is not recorded")
+        else:
+            self._hits += 1
+        return record
+
+    def _delay(self, record: dict) -> float:
+        if self._latency == "recorded":
+            return record["latency"]
+        return self._latency or 0.0
+
+    def predict(self, chain: LLMChain, inputs: dict, timeout: Optional[float] = None) -> str:
+        record = self._lookup(chain.llm, chain.prompt.format_messages(**inputs))
+        if record is None:
+            return super().predict(chain, inputs, timeout)
+        sleep(self._delay(record))
+        return record["completion"]
+
+    async def apredict(self, chain: LLMChain, inputs: dict, timeout: Optional[float] = None) -> str:
+        record = self._lookup(chain.llm, chain.prompt.format_messages(**inputs))
+        if record is None:
+            return await super().apredict(chain, inputs, timeout)
+        await asyncio.sleep(self._delay(record))
+        return record["completion"]
+
+    def stream(self, llm: ChatOpenAI, messages: List[BaseMessage], timeout: Optional[float] = None) -> Iterator[str]:
+        record = self._lookup(llm, messages)
+        if record is None:
+            yield from super().stream(llm, messages, timeout)
+            return
+
+        # Words are replayed as parts, spread over the time after the first token
+        delay = self._delay(record)
+        first_token_delay = delay
+        if self._latency == "recorded" and record.get("first_token_latency") is not None:
+            first_token_delay = record["first_token_latency"]
+        words = record["completion"].split(" ")
+        parts = [f"{word} " for word in words[:-1]] + words[-1:]
+        part_delay = (delay - first_token_delay) / len(parts)
+
+        sleep(first_token_delay)
+        for index, part in enumerate(parts):
+            if index:
+                sleep(part_delay)
+            if part:
+                yield part
+
+
+def create_llm_backend() -> LLMBackend:
+    """Creates LLM backend of config file
+
+    Returns:
+        LLMBackend: LLM backend
+    """
+    backend_config = config["LLM_BACKEND"]
+    mode = backend_config["mode"]
+    if mode == "live":
+        return LLMBackend()
+    if mode == "record":
+        return RecordingLLMBackend(LLMRecording(backend_config["recording_path"]))
+    if mode == "replay":
+        return ReplayLLMBackend(
+            LLMRecording(backend_config["recording_path"]),
+            latency=backend_config["replay_latency"],
+            on_miss=backend_config["on_miss"],
+        )
+    raise ValueError(f"Unknown LLM backend mode: {mode}")
+
+
+# LLM backend of the process
+llm_backend = create_llm_backend()
@@ -0,0 +1,175 @@
+import os
+from threading import Lock
+from typing import Dict, Optional, Tuple, Union
+
+import httpx
+import openai
+from langchain.chat_models import ChatOpenAI
+
+from Model.Config.Config import config
+
+
+class LLMClientPool:
+    """Process-wide registry of LLM clients. Every chain asking for the same
+    (model_name, temperature, max_tokens, api key) gets the same ChatOpenAI object, and all of them share
+    one keep-alive HTTP connection pool. httpx uses the standard socket and ssl modules, so the
+    pool cooperates with gevent once gunicorn's gevent worker has monkey-patched them.
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor of LLMClientPool class
+
+        Args:
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                max_connections (int): Maximum open connections in the pool. Defaults to config file
+                max_keepalive_connections (int): Maximum idle connections kept alive. Defaults to config file
+                keepalive_expiry (float): Seconds an idle connection is kept alive. Defaults to config file
+                timeout (float): Request timeout in seconds. Defaults to config file
+                max_retries (int): Retries of the OpenAI client. Defaults to config file
+        """
+        pool_config = config["LLM_CLIENT_POOL"]
+        self._max_connections = kwargs.get("max_connections", pool_config["max_connections"])
+        self._max_keepalive_connections = kwargs.get(
+            "max_keepalive_connections", pool_config["max_keepalive_connections"]
+        )
+        self._keepalive_expiry = kwargs.get("keepalive_expiry", pool_config["keepalive_expiry"])
+        self._timeout = kwargs.get("timeout", pool_config["timeout"])
+        self._max_retries = kwargs.get("max_retries", pool_config["max_retries"])
+
+        # Clients are created lazily and shared by every greenlet/thread in the process
+        self._lock = Lock()
+        self._http_client: Union[httpx.Client, None] = None
+        self._async_http_client: Union[httpx.AsyncClient, None] = None
+        self._clients: Dict[Tuple[str, float, Optional[int], str], ChatOpenAI] = {}
+
+        # Pool counters
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def limits(self):
+        return httpx.Limits(
+            max_connections=self._max_connections,
+            max_keepalive_connections=self._max_keepalive_connections,
+            keepalive_expiry=self._keepalive_expiry,
+        )
+
+    def stats(self) -> Dict[str, int]:
+        """Returns pool counters
+
+        Returns:
+            Dict[str, int]: Hits, misses and number of pooled clients. Hits of the lock-free path are
+            counted without the lock, so concurrent hits may be undercounted
+        """
+        return {"hits": self._hits, "misses": self._misses, "clients": len(self._clients)}
+
+    def _get_http_client(self) -> httpx.Client:
+        # Caller must hold the lock
+        if self._http_client is None:
+            self._http_client = httpx.Client(limits=self.limits, timeout=self._timeout)
+        return self._http_client
+
+    def _get_async_http_client(self) -> httpx.AsyncClient:
+        # Caller must hold the lock. Used by the asyncio pipeline only
+        if self._async_http_client is None:
+            self._async_http_client = httpx.AsyncClient(limits=self.limits, timeout=self._timeout)
+        return self._async_http_client
+
+    def get(
+            self,
+            model_name: str,
+            temperature: float,
+            api_key: Union[str, None] = None,
+            max_tokens: Optional[int] = None,
+    ) -> ChatOpenAI:
+        """Returns pooled ChatOpenAI client for given model, temperature, api key and answer
+        budget. Creates it on the first request.
+
+        Args:
+            model_name (str): Name of the OpenAI model
+            temperature (float): Sampling temperature
+            api_key (str, optional): OpenAI api key. Defaults to config file
+            max_tokens (int, optional): Maximum tokens of answers. Defaults to None, no limit
+
+        Returns:
+            ChatOpenAI: Shared LLM client
+        """
+        api_key = api_key or config["OPEN_AI_API_KEY"]
+        base_url = config["OPEN_AI_API_BASE"]
+        key = (model_name, float(temperature), max_tokens, api_key)
+
+        # Fast path without locking
+        llm = self._clients.get(key)
+        if llm is not None:
+            self._hits += 1
+            return llm
+
+        with self._lock:
+            llm = self._clients.get(key)
+            if llm is not None:
+                self._hits += 1
+                return llm
+
+            self._misses += 1
+            # OpenAI clients sharing the pooled connections are passed as the client fields of
+            # ChatOpenAI. Its http_client field is not used, it would be given to the async client too,
+            # which needs an httpx.AsyncClient
+            llm = ChatOpenAI(
+                model_name=model_name,
+                openai_api_key=api_key,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                openai_api_base=base_url,
+                client=openai.OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=self._max_retries,
+                    http_client=self._get_http_client(),
+                ).chat.completions,
+                async_client=openai.AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=self._max_retries,
+                    http_client=self._get_async_http_client(),
+                ).chat.completions,
+            )
+
+            self._clients[key] = llm
+            return llm
+
+    def reset(self):
+        """Drops all clients without closing their connections. Called in forked workers, whose
+        inherited connections still belong to the parent process
+        """
+        # Lock may have been held by another thread of the parent while forking
+        self._lock = Lock()
+        self._http_client = None
+        self._async_http_client = None
+        self._clients = {}
+
+    def close(self):
+        """Closes pooled connections and drops all clients"""
+        with self._lock:
+            if self._http_client is not None:
+                self._http_client.close()
+            self._http_client = None
+            # Async connections are bound to their event loop, they are only dropped here
+            self._async_http_client = None
+            self._clients = {}
+
+
+# Shared pool of the process
+llm_client_pool = LLMClientPool()
+
+# Workers forked from a preloading master open their own connections
+os.register_at_fork(after_in_child=llm_client_pool.reset)
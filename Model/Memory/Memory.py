@@ -1,25 +1,45 @@
-from typing import List, Dict
+import sys
+import zlib
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Iterable, List, Dict, Optional, Tuple
 from time import time
 
+import ujson
+
+from Model.Tokens.Tokens import count_tokens
+
+# Line between messages in transcript text
+MEMORY_SEPARATOR = "----------------------------------------\n"
+
 
 class MemoryVariable:
     """Custom memory variable for teacher AI.
     """
+    # No per-instance __dict__. Long sessions keep thousands of memories
+    __slots__ = ("_by", "_message", "_agent_name", "_timestamp", "_rendered", "_tokens")
+
     def __init__(
-        self, by: str, message: str, agent_name: str, timestamp: float = time()
+        self, by: str, message: str, agent_name: Optional[str], timestamp: Optional[float] = None
     ):
         """Constructor of MemoryVariable class
 
         Args:
             by (str): String representation of sender of message. For example; User or teacher name.
             message (str): Message string
-            agent_name (str): Agent who answered with message. If message belongs to user, none or empty can be used.
-            timestamp (float, optional): Message send time. Defaults to creation time.
+            agent_name (Optional[str]): Agent who answered with message. If message belongs to user, none or empty can be used.
+            timestamp (Optional[float], optional): Message send time. Defaults to creation time.
         """
-        self._by = by
+        # Senders and agent names repeat in every session, so one string object is shared
+        self._by = sys.intern(by)
         self._message = message
-        self._agent_name = agent_name
-        self._timestamp = timestamp
+        self._agent_name = sys.intern(agent_name) if agent_name else ""
+        self._timestamp = timestamp if timestamp is not None else time()
+
+        # Transcript text and token count of the memory. Computed once on first use
+        self._rendered: Optional[str] = None
+        self._tokens: Optional[int] = None
 
     @property
     def by(self):
@@ -37,41 +57,375 @@ class MemoryVariable:
     def timestamp(self):
         return self._timestamp
 
+    @property
+    def rendered(self) -> str:
+        """Transcript text of the memory, including the separator line"""
+        if self._rendered is None:
+            self._rendered = f"{self._by}: {self._message}\n{MEMORY_SEPARATOR}"
+        return self._rendered
+
+    @property
+    def tokens(self) -> int:
+        """Number of tokens of the transcript text of the memory"""
+        if self._tokens is None:
+            self._tokens = count_tokens(self.rendered)
+        return self._tokens
+
+
+# Threads (greenlets under gevent) updating rolling summaries off the request path
+_summary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="memory-summary")
+
 
 class BaseMemory:
     """Base class to be used in different AI teacher applications. It can store and manipulate
     memory variables.
     """
-    def __init__(self):
+    def __init__(self, **kwargs):
+        """Constructor of BaseMemory class
+
+        Args:
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                window_size (int): Number of last memories kept verbatim. Older memories are folded
+            into a rolling summary. Defaults to None, which keeps everything verbatim
+                summarizer (Callable[[str, str], str]): Function returns new summary from previous
+            summary and transcript of memories to fold. Required for rolling summary
+                summary_batch (int): Minimum number of memories folded at once. Defaults to 4
+                journal (Callable[[tuple], None]): Called with an entry of every change of memories
+            and summary, which replay method applies again. Defaults to None
+        """
+        # Rolling summary settings
+        self._window_size: Optional[int] = kwargs.get("window_size", None)
+        self._summarizer: Optional[Callable[[str, str], str]] = kwargs.get("summarizer", None)
+        self._summary_batch: int = kwargs.get("summary_batch", 4)
+
+        self._journal: Optional[Callable[[tuple], None]] = kwargs.get("journal", None)
+
+        # Guards summary fields and generation against summary jobs finishing in background
+        self._summary_lock = Lock()
+        self._reset()
+
+    def _reset(self):
         self._memory_array: List[MemoryVariable] = []
         self._number_of_memories = 0
 
+        # Indexes of the latest memory per sender and per agent, and agents in messaging order
+        self._last_by_index: Dict[str, int] = {}
+        self._last_agent_index: Dict[str, int] = {}
+        self._agent_sequence: List[str] = []
+
+        # Append-only transcript buffer. Segment texts of memories and prefix sums of their tokens
+        self._segments: List[str] = []
+        self._token_prefix: List[int] = [0]
+        # Whole transcript text of the first _transcript_count memories
+        self._transcript = ""
+        self._transcript_count = 0
+        # Estimated bytes of memory variables and their transcript segments
+        self._estimated_bytes = 0
+
+        with self._summary_lock:
+            # Rolling summary of memories older than the window
+            self._summary = ""
+            self._summary_tokens = 0
+            # Number of memories from the start covered by summary
+            self._summarized_count = 0
+            self._summary_future: Optional[Future] = None
+            # Number of memories the running summary job covers
+            self._summary_end = 0
+            # Changes when memories are replaced or memories of the running summary job are removed,
+            # so the job's summary is ignored
+            self._generation = getattr(self, "_generation", 0) + 1
+
     def __str__(self):
-        text = ""
-        if self.number_of_memories > 0:
-            text = "----------------------------------------\n".join(
-                [f"{memory.by}: {memory.message}\n" for memory in self.memory_array]
-            ) + "----------------------------------------\n"
-            
-        return text
+        # Only segments appended since the last call are joined
+        if self._transcript_count != len(self._segments):
+            self._transcript += "".join(self._segments[self._transcript_count:])
+            self._transcript_count = len(self._segments)
+
+        return self._transcript
+
+    @property
+    def journal(self) -> Optional[Callable[[tuple], None]]:
+        return self._journal
+
+    @journal.setter
+    def journal(self, value: Optional[Callable[[tuple], None]]):
+        self._journal = value
+
+    @staticmethod
+    def _render_memories(memories: List[MemoryVariable]) -> str:
+        return "".join([memory.rendered for memory in memories])
+
+    @property
+    def summary(self):
+        return self._summary
+
+    @property
+    def summarized_count(self):
+        return self._summarized_count
+
+    def tokens(self, start: int = 0) -> int:
+        """Returns number of tokens of transcript text of memories
+
+        Args:
+            start (int, optional): Index of the first memory counted. Defaults to 0.
+
+        Returns:
+            int: Number of tokens
+        """
+        return self._token_prefix[-1] - self._token_prefix[start]
+
+    def render(
+            self, window_size: Optional[int] = None, use_summary: bool = True, max_tokens: Optional[int] = None
+    ) -> str:
+        """Returns transcript of memory to use in prompt templates
+
+        Args:
+            window_size (Optional[int], optional): Number of last memories kept verbatim. Defaults to
+        None, which returns whole transcript
+            use_summary (bool, optional): Prepend rolling summary of older memories. Defaults to True.
+            max_tokens (Optional[int], optional): Token budget of transcript. Oldest memories are left
+        out to fit. Defaults to None.
+
+        Returns:
+            str: Transcript text
+        """
+        if window_size is None and max_tokens is None:
+            return str(self)
+        return self.render_with_tokens(window_size=window_size, use_summary=use_summary, max_tokens=max_tokens)[0]
+
+    def render_with_tokens(
+            self, window_size: Optional[int] = None, use_summary: bool = True, max_tokens: Optional[int] = None
+    ) -> Tuple[str, int]:
+        """Same as render, also returns number of tokens of the transcript. Tokens are counted from
+        cached counts of memories, so the transcript is not tokenized again.
+
+        Args:
+            window_size (Optional[int], optional): Number of last memories kept verbatim. Defaults to
+        None, which returns whole transcript
+            use_summary (bool, optional): Prepend rolling summary of older memories. Defaults to True.
+            max_tokens (Optional[int], optional): Token budget of transcript. Oldest memories are left
+        out to fit. Defaults to None.
+
+        Returns:
+            (str, int): Transcript text, number of tokens
+        """
+        summary, summarized_count = self._summary, self._summarized_count
+        number_of_memories = len(self._segments)
+        start = max(0, number_of_memories - window_size) if window_size is not None else 0
+        if window_size is not None and use_summary:
+            # Memories not folded into summary yet stay verbatim, also while there is no summary
+            start = min(start, summarized_count)
+        else:
+            summary = ""
+
+        if max_tokens is not None:
+            if summary and self._summary_tokens + self.tokens(start) > max_tokens:
+                summary = ""
+            # First memory where the tail fits into the budget
+            budget_start = bisect_left(self._token_prefix, self._token_prefix[-1] - max(max_tokens, 0))
+            start = max(start, min(budget_start, number_of_memories))
+
+        text = "".join(self._segments[start:])
+        tokens = self.tokens(start)
+        if summary:
+            text = f"Summary of earlier conversation: {summary}\n{MEMORY_SEPARATOR}" + text
+            tokens += self._summary_tokens
+
+        return text, tokens
+
+    def _schedule_summary(self):
+        """Folds memories older than the window into the rolling summary in background. Does not
+        wait for the summarizer, prompts use the previous summary until it is done.
+        """
+        if self._summarizer is None or self._window_size is None:
+            return
+        if self._summary_future is not None and not self._summary_future.done():
+            return
+
+        end = self.number_of_memories - self._window_size
+        if end - self._summarized_count < self._summary_batch:
+            return
+
+        memories = self._memory_array[self._summarized_count:end]
+        with self._summary_lock:
+            self._summary_end = end
+            self._summary_future = _summary_executor.submit(
+                self._update_summary, self._summary, memories, end, self._generation
+            )
+
+    def _update_summary(self, summary: str, memories: List[MemoryVariable], end: int, generation: int):
+        try:
+            new_summary = self._summarizer(summary, self._render_memories(memories))
+        except Exception as e:
+            print(f"Memory summary failed: {str(e)}")
+            return
+
+        summary_tokens = count_tokens(new_summary)
+        with self._summary_lock:
+            # Memories were replaced or some of the summarized ones were removed meanwhile
+            if generation != self._generation or end > self.number_of_memories:
+                return
+            # Summary is set before its token count, readers never count tokens of a summary not there yet
+            self._summary, self._summarized_count = new_summary, end
+            self._summary_tokens = summary_tokens
+            if self._journal is not None:
+                self._journal(("summary", new_summary, end))
 
     @property
     def memory_array(self):
         return self._memory_array
 
     def append(self, by: str, message: str, **kwargs):
-        self._memory_array.append(
-            MemoryVariable(
-                by=by,
-                message=message,
-                agent_name=kwargs.get("agent_name", ""),
-                timestamp=kwargs.get("timestamp", time()),
-            )
+        memory = MemoryVariable(
+            by=by,
+            message=message,
+            agent_name=kwargs.get("agent_name", None),
+            timestamp=kwargs.get("timestamp", None),
         )
+        self._append_memory(memory)
+        if self._journal is not None:
+            self._journal((
+                "append", self.number_of_memories - 1, memory.by, memory.message, memory.agent_name,
+                memory.timestamp, memory.tokens,
+            ))
+        self._schedule_summary()
+
+    def _append_memory(self, memory: MemoryVariable):
+        self._memory_array.append(memory)
+        self._index(len(self._memory_array) - 1, memory)
+        self._segments.append(memory.rendered)
+        self._token_prefix.append(self._token_prefix[-1] + memory.tokens)
+        self._estimated_bytes += self._memory_bytes(memory)
+
+    @staticmethod
+    def _memory_bytes(memory: MemoryVariable) -> int:
+        # Variable, message, segment, token count and three list slots. Interned names are shared
+        return (
+            sys.getsizeof(memory) + sys.getsizeof(memory.message) + sys.getsizeof(memory.rendered)
+            + sys.getsizeof(memory.tokens) + 3 * 8
+        )
+
+    @property
+    def estimated_bytes(self) -> int:
+        """Estimated bytes used by memories, transcript cache and summary"""
+        return self._estimated_bytes + sys.getsizeof(self._transcript) + sys.getsizeof(self._summary)
+
+    def _index(self, index: int, memory: MemoryVariable):
+        self._last_by_index[memory.by] = index
+        if memory.agent_name:
+            self._last_agent_index[memory.agent_name] = index
+            if memory.agent_name != "User":
+                self._agent_sequence.append(memory.agent_name)
+
+    def dumps(self) -> bytes:
+        """Serializes memories and rolling summary in a compact columnar form
+
+        Returns:
+            bytes: zlib compressed JSON
+        """
+        memories = self._memory_array
+        return zlib.compress(ujson.dumps({
+            "version": 1,
+            "by": [memory.by for memory in memories],
+            "message": [memory.message for memory in memories],
+            "agent_name": [memory.agent_name for memory in memories],
+            "timestamp": [memory.timestamp for memory in memories],
+            "tokens": [memory.tokens for memory in memories],
+            "summary": self._summary,
+            "summarized_count": self._summarized_count,
+        }).encode(), 1)
+
+    def restore(self, data: bytes):
+        """Replaces memories and rolling summary with serialized ones. Summary settings are kept.
+
+        Args:
+            data (bytes): Output of dumps method
+        """
+        loaded = ujson.loads(zlib.decompress(data))
+
+        self._reset()
+        for by, message, agent_name, timestamp, tokens in zip(
+                loaded["by"], loaded["message"], loaded["agent_name"], loaded["timestamp"], loaded["tokens"]
+        ):
+            memory = MemoryVariable(by=by, message=message, agent_name=agent_name, timestamp=timestamp)
+            memory._tokens = tokens
+            self._append_memory(memory)
+
+        summary_tokens = count_tokens(loaded["summary"])
+        with self._summary_lock:
+            self._summary = loaded["summary"]
+            self._summary_tokens = summary_tokens
+            self._summarized_count = min(loaded["summarized_count"], self.number_of_memories)
+
+    def replay(self, entries: Iterable[tuple]):
+        """Applies journal entries on top of memories and summary, for example the log written
+        after a snapshot restored with restore method. Entries are not passed to the journal
+        again and no summary is scheduled.
+
+        Args:
+            entries (Iterable[tuple]): Journal entries in the order they were made
+        """
+        for entry in entries:
+            kind = entry[0]
+            if kind == "append":
+                _, index, by, message, agent_name, timestamp, tokens = entry
+                # Memories from the index on were removed by a change that is not replayed
+                while self.number_of_memories > index:
+                    self._pop_memory()
+                memory = MemoryVariable(by=by, message=message, agent_name=agent_name, timestamp=timestamp)
+                memory._tokens = tokens
+                self._append_memory(memory)
+            elif kind == "pop":
+                while self.number_of_memories > entry[1]:
+                    self._pop_memory()
+            elif kind == "summary":
+                summary_tokens = count_tokens(entry[1])
+                with self._summary_lock:
+                    self._summary = entry[1]
+                    self._summary_tokens = summary_tokens
+                    self._summarized_count = min(entry[2], self.number_of_memories)
+            else:
+                raise ValueError(f"Unknown memory journal entry: {kind}")
 
     @memory_array.deleter
     def memory_array(self):
-        self._memory_array.pop()
+        self._pop_memory()
+        if self._journal is not None:
+            self._journal(("pop", self.number_of_memories))
+
+    def _pop_memory(self):
+        memory = self._memory_array.pop()
+        segment = self._segments.pop()
+        if self._transcript_count > len(self._segments):
+            # Cached transcript ends with the removed memory, a later append must not find it there
+            self._transcript = self._transcript[:len(self._transcript) - len(segment)]
+            self._transcript_count = len(self._segments)
+        self._token_prefix.pop()
+        self._estimated_bytes -= self._memory_bytes(memory)
+        with self._summary_lock:
+            self._summarized_count = min(self._summarized_count, self.number_of_memories)
+            if self.number_of_memories < self._summary_end:
+                # Running summary job folds the removed memory. Memories appended later take its
+                # index, so the memory count alone can not tell the job's summary is stale
+                self._generation += 1
+                self._summary_end = self.number_of_memories
+
+        # Point indexes of removed memory to the previous one
+        if memory.agent_name and memory.agent_name != "User":
+            self._agent_sequence.pop()
+        for index_map, key, attribute in (
+                (self._last_by_index, memory.by, "by"),
+                (self._last_agent_index, memory.agent_name, "agent_name"),
+        ):
+            if not key:
+                continue
+            index_map.pop(key, None)
+            for i in range(len(self._memory_array) - 1, -1, -1):
+                if getattr(self._memory_array[i], attribute) == key:
+                    index_map[key] = i
+                    break
 
     @property
     def number_of_memories(self):
@@ -87,21 +441,17 @@ class BaseMemory:
         Returns:
             MemoryVariable: MemoryVariable class
         """
-        last_user_memory = None
-        for i in range(1, self.number_of_memories + 1):
-            if self._memory_array[-1 * i].by == user_name:
-                last_user_memory = self._memory_array[-1 * i]
+        index = self._last_by_index.get(user_name)
+        return self._memory_array[index] if index is not None else None
 
-        return last_user_memory
-    
     def get_all_agents(self):
         """Returns all agents in messaging order
 
         Returns:
             List[str]: List of agents name with order
         """
-        return [memory._agent_name for memory in self.memory_array  if memory.agent_name not in ["", "User"]]
-    
+        return list(self._agent_sequence)
+
     def get_last_agent_memory(self, agent_name: str):
         """Returns last agent memory variable
 
@@ -109,11 +459,7 @@ class BaseMemory:
             agent_name (str): Name of the agent
 
         Returns:
-            MemoryVariable: MemoryVariable class
+            str: Message of the memory variable
         """
-        last_agent_memory = None
-        for i in range(1, self.number_of_memories + 1):
-            if self._memory_array[-1 * i].agent_name == agent_name:
-                last_agent_memory = self._memory_array[-1 * i].message
-
-        return last_agent_memory
\ No newline at end of file
+        index = self._last_agent_index.get(agent_name)
+        return self._memory_array[index].message if index is not None else None
@@ -0,0 +1,35 @@
+from Model.Cache.ResponseCache import response_cache
+from Model.Cache.RoutingCache import routing_cache
+from Model.CallPolicy.CallPolicy import call_policy_stats, circuit_breaker_stats
+from Model.LLM.Backend import ReplayLLMBackend, llm_backend
+from Model.LLM.LLM import llm_client_pool
+from Model.Metrics.Metrics import metrics
+from Model.Parsers.Parsers import guidance_output_parser
+from Model.PersonaChatbot.PersonaChatbot import speculation_stats
+from Model.Router.Router import local_router
+from Model.Session.Session import session_gauges, session_log
+from Model.Session.SessionTurns import session_turns
+from Model.Tiering.Tiering import model_tiering
+from Model.Tokens.Tokens import token_ledger
+
+
+def register_stats_collectors():
+    """Exports counters of the process singletons as gauges on /metrics"""
+    metrics.register_collector("llm_pool", llm_client_pool.stats)
+    metrics.register_collector("speculation", speculation_stats.stats)
+    # Messages routed per agent get an "agent" label
+    metrics.register_collector("local_router", local_router.stats, label="agent")
+    metrics.register_collector("response_cache", response_cache.stats)
+    metrics.register_collector("routing_cache", routing_cache.stats)
+    metrics.register_collector("sessions", session_gauges)
+    metrics.register_collector("session_turns", session_turns.stats)
+    metrics.register_collector("guidance_parser", guidance_output_parser.stats)
+    # Stats per chain, model and tier become gauges per stat with a chain, model or tier label
+    metrics.register_collector("tokens", lambda: {"chains": token_ledger.stats()}, label="chain")
+    metrics.register_collector("call_policy", lambda: {"chains": call_policy_stats()}, label="chain")
+    metrics.register_collector("circuit_breaker", lambda: {"models": circuit_breaker_stats()}, label="model")
+    metrics.register_collector("model_tier", lambda: {"tiers": model_tiering.stats()}, label="tier")
+    if session_log is not None:
+        metrics.register_collector("session_log", session_log.stats)
+    if isinstance(llm_backend, ReplayLLMBackend):
+        metrics.register_collector("llm_replay", llm_backend.stats)
@@ -0,0 +1,526 @@
+import atexit
+import os
+import tempfile
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import ujson
+
+from Model.Config.Config import config
+
+# Labels of stage spans. Labels which do not apply to a stage are empty
+STAGE_LABELS = ("stage", "agent", "chain", "model")
+
+# Spans of the running request, used for the Server-Timing header. None outside of requests
+_request_timings: ContextVar[Optional[List[Tuple[str, str, float]]]] = ContextVar("request_timings", default=None)
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values) if value != ""]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _merge_snapshots(snapshots: List[dict]) -> Tuple[Dict[str, dict], Dict[str, dict], Dict[str, list]]:
+    # Histograms and counters are summed per label values, gauges are kept per process
+    histograms: Dict[str, dict] = {}
+    counters: Dict[str, dict] = {}
+    gauges: Dict[str, List[Tuple[str, str, str, float]]] = {}
+
+    for snapshot in snapshots:
+        for name, histogram in snapshot["histograms"].items():
+            merged = histograms.setdefault(name, {**histogram, "series": {}})
+            for labels, buckets, total, count in histogram["series"]:
+                series = merged["series"].setdefault(tuple(labels), [[0] * len(buckets), 0.0, 0])
+                series[0] = [a + b for a, b in zip(series[0], buckets)]
+                series[1] += total
+                series[2] += count
+        for name, counter in snapshot["counters"].items():
+            merged = counters.setdefault(name, {**counter, "series": {}})
+            for labels, value in counter["series"]:
+                merged["series"][tuple(labels)] = merged["series"].get(tuple(labels), 0) + value
+        for name, label, label_value, value in snapshot["gauges"]:
+            gauges.setdefault(name, []).append((str(snapshot["pid"]), label, label_value, value))
+    return histograms, counters, gauges
+
+
+class Histogram:
+    """Prometheus histogram with fixed buckets and label values"""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...], buckets: List[float]):
+        """Constructor of Histogram class
+
+        Args:
+            name (str): Metric name
+            documentation (str): Help text
+            label_names (Tuple[str, ...]): Label names
+            buckets (List[float]): Upper bounds of buckets, ascending. +Inf is added
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = list(buckets)
+        self._lock = Lock()
+
+        # Label values -> [bucket counts, sum, count]. Bucket counts are not cumulative
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, label_values: Tuple[str, ...]):
+        """Records a value
+
+        Args:
+            value (float): Observed value
+            label_values (Tuple[str, ...]): Values of labels in label_names order
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> List[list]:
+        with self._lock:
+            return [[list(labels), list(series[0]), series[1], series[2]] for labels, series in self._series.items()]
+
+    def reset(self):
+        # Only called after a fork, the lock of the parent is not used
+        self._lock = Lock()
+        self._series = {}
+
+
+class Counter:
+    """Prometheus counter with label values"""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...]):
+        """Constructor of Counter class
+
+        Args:
+            name (str): Metric name
+            documentation (str): Help text
+            label_names (Tuple[str, ...]): Label names
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._lock = Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, label_values: Tuple[str, ...], amount: float = 1):
+        """Increments the counter
+
+        Args:
+            label_values (Tuple[str, ...]): Values of labels in label_names order
+            amount (float, optional): Increment. Defaults to 1.
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def snapshot(self) -> List[list]:
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+    def reset(self):
+        # Only called after a fork, the lock of the parent is not used
+        self._lock = Lock()
+        self._values = {}
+
+
+class MetricsRegistry:
+    """Stage latency histograms, counters and stats collectors of the process, exported in
+    Prometheus text format.
+
+    Every gunicorn worker has its own registry. When a multiprocess directory is configured,
+    workers write snapshots to a file per process and /metrics merges the files of all workers,
+    so the endpoint returns the same totals whichever worker answers the scrape. Histograms and
+    counters of exited workers are folded into one file, gauges are reported per live worker with
+    a pid label.
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor of MetricsRegistry class
+
+        Args:
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                multiprocess_dir (str): Directory of worker snapshots. Defaults to config file
+                flush_interval (float): Seconds between snapshot writes of the background flusher. Defaults
+            to config file
+                buckets (List[float]): Buckets of latency histograms in seconds. Defaults to config file
+        """
+        metrics_config = config["METRICS"]
+        self._multiprocess_dir = kwargs.get("multiprocess_dir", metrics_config["multiprocess_dir"])
+        self._flush_interval = kwargs.get("flush_interval", metrics_config["flush_interval"])
+        self._buckets = kwargs.get("buckets", metrics_config["buckets"])
+
+        self._lock = Lock()
+        self._histograms: Dict[str, Histogram] = {}
+        self._counters: Dict[str, Counter] = {}
+        # Gauge prefix -> (stats function, label name of nested keys)
+        self._collectors: Dict[str, Tuple[Callable[[], Dict[str, object]], str]] = {}
+        self._started = time()
+        # Snapshots are written by a background thread started on the first observation, so
+        # requests never run the collectors or write files
+        self._flusher: Optional[Thread] = None
+        self._stopped = Event()
+
+        self.stage_seconds = self.histogram(
+            "persona_stage_duration_seconds", "Duration of request stages", STAGE_LABELS
+        )
+        self.retries = self.counter("persona_retries_total", "Retried attempts of retrying functions", ("function",))
+
+        if self._multiprocess_dir:
+            os.makedirs(self._multiprocess_dir, exist_ok=True)
+            atexit.register(self._final_flush)
+
+    def after_fork(self):
+        """Starts empty metrics in a forked worker. Observations of the parent process are
+        reported by the parent
+        """
+        self._lock = Lock()
+        self._started = time()
+        # Flusher thread of the parent does not exist in the worker
+        self._flusher = None
+        self._stopped = Event()
+        for metric in [*self._histograms.values(), *self._counters.values()]:
+            metric.reset()
+
+    def histogram(self, name: str, documentation: str, label_names: Tuple[str, ...]) -> Histogram:
+        """Registers a latency histogram
+
+        Args:
+            name (str): Metric name
+            documentation (str): Help text
+            label_names (Tuple[str, ...]): Label names
+
+        Returns:
+            Histogram: Registered histogram
+        """
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(name, documentation, label_names, self._buckets)
+            return self._histograms[name]
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...]) -> Counter:
+        """Registers a counter
+
+        Args:
+            name (str): Metric name
+            documentation (str): Help text
+            label_names (Tuple[str, ...]): Label names
+
+        Returns:
+            Counter: Registered counter
+        """
+        with self._lock:
+            if name not in self._counters:
+                self._counters[name] = Counter(name, documentation, label_names)
+            return self._counters[name]
+
+    def register_collector(self, name: str, collector: Callable[[], Dict[str, object]], label: str = "name"):
+        """Registers a stats function exported as gauges on every scrape. Numeric values become
+        persona_<name>_<key> gauges. Nested dictionaries {key: {label value: value}} become
+        persona_<name>_<key> gauges with their keys as label. Stats per entity
+        {group: {label value: {key: value}}} become persona_<name>_<key> gauges the same way.
+
+        Args:
+            name (str): Prefix of gauges
+            collector (Callable[[], Dict[str, object]]): Function returning stats
+            label (str, optional): Label name of nested keys. For example; chain, model. Defaults to "name".
+        """
+        self._collectors[name] = (collector, label)
+
+    @contextmanager
+    def span(self, stage: str, **labels: str) -> Iterator[None]:
+        """Times a stage of the request
+
+        Args:
+            stage (str): Stage name. For example; route, agent, prompt, llm, parse
+            **labels (str): agent, chain and model labels of the stage
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            self.observe(stage, seconds, **labels)
+
+    def observe(self, stage: str, seconds: float, **labels: str):
+        """Records duration of a stage
+
+        Args:
+            stage (str): Stage name
+            seconds (float): Duration in seconds
+            **labels (str): agent, chain and model labels of the stage
+        """
+        label_values = (stage, labels.get("agent", ""), labels.get("chain", ""), labels.get("model", ""))
+        self.stage_seconds.observe(seconds, label_values)
+
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, labels.get("chain") or labels.get("agent") or "", seconds))
+
+        if self._multiprocess_dir and self._flusher is None:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Metrics flush failed: {str(e)}")
+
+    def _final_flush(self):
+        self._stopped.set()
+        try:
+            self.flush(final=True)
+        except Exception as e:
+            print(f"Metrics flush failed: {str(e)}")
+
+    def count_retry(self, retry_state):
+        """tenacity before_sleep callback counting retried attempts
+
+        Args:
+            retry_state (tenacity.RetryCallState): State of the retrying call
+        """
+        self.retries.inc((getattr(retry_state.fn, "__qualname__", str(retry_state.fn)),))
+
+    def start_request(self):
+        """Starts collecting spans of the current request for the Server-Timing header
+
+        Returns:
+            Token to pass to end_request
+        """
+        return _request_timings.set([])
+
+    def end_request(self, token) -> str:
+        """Stops collecting spans of the current request
+
+        Args:
+            token: Token returned by start_request
+
+        Returns:
+            str: Server-Timing header value
+        """
+        timings = _request_timings.get() or []
+        _request_timings.reset(token)
+
+        entries = []
+        for stage, description, seconds in timings:
+            entry = f"{stage}"
+            if description:
+                entry += f';desc="{description}"'
+            entries.append(entry + f";dur={seconds * 1e3:.1f}")
+        return ", ".join(entries)
+
+    def _collect_gauges(self) -> List[list]:
+        gauges = []
+        for prefix, (collector, label) in list(self._collectors.items()):
+            try:
+                stats = collector()
+            except Exception as e:
+                print(f"Metrics collector {prefix} failed: {e}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, dict):
+                    for label_value, nested in value.items():
+                        if isinstance(nested, dict):
+                            for nested_key, nested_value in nested.items():
+                                gauges.append([f"persona_{prefix}_{nested_key}", label, str(label_value), nested_value])
+                        else:
+                            gauges.append([f"persona_{prefix}_{key}", label, str(label_value), nested])
+                else:
+                    gauges.append([f"persona_{prefix}_{key}", "", "", value])
+        return [gauge for gauge in gauges if isinstance(gauge[3], (int, float)) and not isinstance(gauge[3], bool)]
+
+    def _snapshot(self, final: bool = False) -> dict:
+        return {
+            "pid": os.getpid(),
+            "histograms": {
+                name: {
+                    "documentation": histogram.documentation,
+                    "label_names": list(histogram.label_names),
+                    "buckets": histogram.buckets,
+                    "series": histogram.snapshot(),
+                }
+                for name, histogram in self._histograms.items()
+            },
+            "counters": {
+                name: {
+                    "documentation": counter.documentation,
+                    "label_names": list(counter.label_names),
+                    "series": counter.snapshot(),
+                }
+                for name, counter in self._counters.items()
+            },
+            # Gauges of an exited worker are dropped
+            "gauges": [] if final else self._collect_gauges(),
+        }
+
+    def _snapshot_path(self) -> str:
+        # Start time keeps a reused pid from overwriting the file of an exited worker
+        return os.path.join(self._multiprocess_dir, f"metrics-{os.getpid()}-{int(self._started * 1e3)}.json")
+
+    @staticmethod
+    def _write(path: str, snapshot: dict):
+        # Unique temporary file, so concurrent writers of the same snapshot do not replace each other's
+        fd, temp_path = tempfile.mkstemp(
+            prefix=f"{os.path.basename(path)}.", suffix=".tmp", dir=os.path.dirname(path)
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                ujson.dump(snapshot, f)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def flush(self, final: bool = False):
+        """Writes snapshot of the process to the multiprocess directory
+
+        Args:
+            final (bool, optional): Process is exiting, gauges are not written. Defaults to False.
+        """
+        if not self._multiprocess_dir:
+            return
+        self._write(self._snapshot_path(), self._snapshot(final=final))
+
+    def clear_multiprocess_dir(self):
+        """Removes snapshots of a previous run. Called by the gunicorn master before it starts
+        workers, so metrics of old processes are not reported
+        """
+        if not self._multiprocess_dir:
+            return
+        for file_name in os.listdir(self._multiprocess_dir):
+            if file_name.startswith("metrics-") and file_name.endswith((".json", ".tmp")):
+                try:
+                    os.remove(os.path.join(self._multiprocess_dir, file_name))
+                except FileNotFoundError:
+                    pass
+
+    def mark_process_dead(self, pid: int):
+        """Folds histograms and counters of an exited worker into the file of exited workers and
+        removes its snapshot, so the directory does not grow with worker restarts. Called by the
+        gunicorn master only, which is the single writer of that file
+
+        Args:
+            pid (int): Process id of the exited worker
+        """
+        if not self._multiprocess_dir:
+            return
+        paths = [
+            os.path.join(self._multiprocess_dir, file_name)
+            for file_name in os.listdir(self._multiprocess_dir)
+            if file_name.startswith(f"metrics-{pid}-") and file_name.endswith(".json")
+        ]
+        if not paths:
+            return
+
+        exited_path = os.path.join(self._multiprocess_dir, "metrics-exited.json")
+        snapshots = self._read_snapshots([exited_path, *paths])
+        histograms, counters, _ = _merge_snapshots(snapshots)
+        self._write(exited_path, {
+            "pid": "exited",
+            "histograms": {
+                name: {
+                    **histogram,
+                    "series": [[list(labels), *series] for labels, series in histogram["series"].items()],
+                }
+                for name, histogram in histograms.items()
+            },
+            "counters": {
+                name: {**counter, "series": [[list(labels), value] for labels, value in counter["series"].items()]}
+                for name, counter in counters.items()
+            },
+            "gauges": [],
+        })
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _read_snapshots(paths: List[str]) -> List[dict]:
+        snapshots = []
+        for path in paths:
+            try:
+                with open(path) as f:
+                    snapshots.append(ujson.load(f))
+            except (OSError, ValueError):
+                # File of a worker is being replaced or was removed
+                continue
+        return snapshots
+
+    def _snapshots(self) -> List[dict]:
+        if not self._multiprocess_dir:
+            return [self._snapshot()]
+
+        # Answering worker reports its current values. Its last written snapshot is used if writing fails
+        try:
+            self.flush()
+        except OSError as e:
+            print(f"Metrics flush failed: {str(e)}")
+        return self._read_snapshots([
+            os.path.join(self._multiprocess_dir, file_name)
+            for file_name in os.listdir(self._multiprocess_dir)
+            if file_name.endswith(".json")
+        ])
+
+    def render(self) -> str:
+        """Returns metrics of all workers in Prometheus text format
+
+        Returns:
+            str: Exposition text
+        """
+        histograms, counters, gauges = _merge_snapshots(self._snapshots())
+
+        lines = []
+        for name, histogram in sorted(histograms.items()):
+            lines.append(f"# HELP {name} {histogram['documentation']}")
+            lines.append(f"# TYPE {name} histogram")
+            bounds = [str(bucket) for bucket in histogram["buckets"]] + ["+Inf"]
+            for labels, (buckets, total, count) in sorted(histogram["series"].items()):
+                cumulative = 0
+                for bound, bucket in zip(bounds, buckets):
+                    cumulative += bucket
+                    label_text = _format_labels(histogram["label_names"], labels, f'le="{bound}"')
+                    lines.append(f"{name}_bucket{label_text} {cumulative}")
+                label_text = _format_labels(histogram["label_names"], labels)
+                lines.append(f"{name}_sum{label_text} {total}")
+                lines.append(f"{name}_count{label_text} {count}")
+        for name, counter in sorted(counters.items()):
+            lines.append(f"# HELP {name} {counter['documentation']}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in sorted(counter["series"].items()):
+                lines.append(f"{name}{_format_labels(counter['label_names'], labels)} {value}")
+        for name, values in sorted(gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            for pid, label, label_value, value in values:
+                lines.append(f"{name}{_format_labels(('pid', label), (pid, label_value))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of the process
+metrics = MetricsRegistry()
+
+# Workers forked from a preloading master report their own metrics
+os.register_at_fork(after_in_child=metrics.after_fork)
@@ -1,5 +1,14 @@
+import re
+from threading import Lock
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import ujson
+from langchain.output_parsers import PydanticOutputParser
+from langchain.schema import OutputParserException
 from pydantic import BaseModel, Field
 
+from Model.Config.Config import config
+
 
 class GuidanceChainParser(BaseModel):
     agent_index: int = Field(description="next agent to run")
@@ -7,3 +16,195 @@ class GuidanceChainParser(BaseModel):
         description="Name of chosen agent without space for example; 'ConversationAgent'"
     )
     reason: str = Field(description="reason to select this agent")
+
+
+# Code fences around JSON answers
+_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+# Keys without quotes and commas before closing braces
+_UNQUOTED_KEY_PATTERN = re.compile(r"([{,]\s*)([A-Za-z_]\w*)\s*:")
+_TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+# Agent number or letter given as the answer. For example; "A", "2.", "Answer: B", "agent 1"
+_ANSWER_PATTERNS = [
+    re.compile(r"^\W*([0-9A-Z])\W*$"),
+    re.compile(r"^\W*([0-9A-Z])(?:[.):\-]|\s+-)"),
+    re.compile(r"(?:agent|answer|option|choice)\W{0,3}([0-9A-Z])\b", re.IGNORECASE),
+]
+
+GUIDANCE_PARSE_PATHS = ("strict", "lenient_json", "mapping", "repair", "failed")
+
+
+def resolve_agent_index(value) -> Optional[int]:
+    """Resolves an agent answer to its index in AGENTS_NAMES. Accepts indexes, numbers and
+    letters of AGENT_MAPPINGS and agent names with or without spaces.
+
+    Args:
+        value: Agent answer
+
+    Returns:
+        Optional[int]: Agent index. None if the answer is not an agent
+    """
+    index = None
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        index = value
+    elif isinstance(value, str):
+        answer = value.strip().strip("'\".").strip()
+        names = {name.lower(): i for i, name in enumerate(config["AGENTS_NAMES"])}
+        if answer.upper() in config["AGENT_MAPPINGS"]:
+            index = config["AGENT_MAPPINGS"][answer.upper()]
+        elif answer.lstrip("-").isdigit():
+            index = int(answer)
+        elif answer.replace(" ", "").lower() in names:
+            index = names[answer.replace(" ", "").lower()]
+
+    if index is None or not 0 <= index < len(config["AGENTS_NAMES"]):
+        return None
+    return index
+
+
+class GuidanceOutputParser:
+    """Tolerant parser of GuidanceChain answers. Tries the strict pydantic parser, then lenient
+    JSON recovery, then agent numbers, letters and names in the text. Only when all of them fail
+    the caller's repair function is asked for a new answer. Counts which path parsed each answer.
+    """
+
+    def __init__(self):
+        self._parser = PydanticOutputParser(pydantic_object=GuidanceChainParser)
+        self._lock = Lock()
+        self._counts: Dict[str, int] = dict.fromkeys(GUIDANCE_PARSE_PATHS, 0)
+
+    @property
+    def format_instructions(self):
+        return self._parser.get_format_instructions()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns parse counters
+
+        Returns:
+            Dict[str, int]: Number of answers parsed by each path
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def _count(self, path: str):
+        with self._lock:
+            self._counts[path] += 1
+
+    @staticmethod
+    def _result(index: int, reason: str = "") -> GuidanceChainParser:
+        return GuidanceChainParser(
+            agent_index=index, agent_name=config["AGENTS_NAMES"][index], reason=str(reason or "")
+        )
+
+    def _parse_strict(self, text: str) -> Optional[GuidanceChainParser]:
+        try:
+            result = self._parser.parse(text)
+        except Exception:
+            return None
+        # Index must name an agent, otherwise the answer is parsed again leniently
+        if resolve_agent_index(result.agent_index) is None:
+            return None
+        return result
+
+    @staticmethod
+    def _parse_lenient_json(text: str) -> Optional[GuidanceChainParser]:
+        fenced = _FENCE_PATTERN.search(text)
+        if fenced:
+            text = fenced.group(1)
+        start, end = text.find("{"), text.rfind("}")
+        if start < 0 or end <= start:
+            return None
+
+        candidate = text[start:end + 1]
+        if '"' not in candidate:
+            candidate = candidate.replace("'", '"')
+        candidate = _UNQUOTED_KEY_PATTERN.sub(r'\1"\2":', candidate)
+        candidate = _TRAILING_COMMA_PATTERN.sub(r"\1", candidate)
+        try:
+            data = ujson.loads(candidate)
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+
+        for key in ("agent_index", "index", "agent_name", "agent", "name", "choice", "answer"):
+            index = resolve_agent_index(data.get(key))
+            if index is not None:
+                return GuidanceOutputParser._result(index, data.get("reason", ""))
+        return None
+
+    @staticmethod
+    def _parse_mapping(text: str) -> Optional[GuidanceChainParser]:
+        # Agent names in prose
+        compact = text.replace(" ", "").lower()
+        named = [i for i, name in enumerate(config["AGENTS_NAMES"]) if name.lower() in compact]
+        if len(named) == 1:
+            return GuidanceOutputParser._result(named[0], text.strip())
+
+        for pattern in _ANSWER_PATTERNS:
+            match = pattern.search(text.strip())
+            if match:
+                index = resolve_agent_index(match.group(1))
+                if index is not None:
+                    return GuidanceOutputParser._result(index, text.strip())
+        return None
+
+    def parse_local(self, text: str) -> Tuple[Optional[GuidanceChainParser], Optional[str]]:
+        """Parses answer without calling the LLM
+
+        Args:
+            text (str): Raw GuidanceChain answer
+
+        Returns:
+            (Optional[GuidanceChainParser], Optional[str]): Parsed answer and the path which parsed
+            it. None, None if no path could parse it
+        """
+        for path, parse in (
+                ("strict", self._parse_strict),
+                ("lenient_json", self._parse_lenient_json),
+                ("mapping", self._parse_mapping),
+        ):
+            result = parse(text)
+            if result is not None:
+                return result, path
+        return None, None
+
+    def parse(self, text: str, repair: Optional[Callable[[str], str]] = None) -> GuidanceChainParser:
+        """Parses answer, asking repair for a new answer only if local parsing fails
+
+        Args:
+            text (str): Raw GuidanceChain answer
+            repair (Optional[Callable[[str], str]], optional): Returns a corrected answer for an
+        answer which could not be parsed. Defaults to None.
+
+        Raises:
+            OutputParserException: Answer could not be parsed
+
+        Returns:
+            GuidanceChainParser: Parsed answer
+        """
+        result, path = self.parse_local(text)
+        if result is None and repair is not None:
+            result, path = self.parse_local(repair(text))
+            path = path and "repair"
+        return self._finish(text, result, path)
+
+    async def aparse(self, text: str, repair: Optional[Callable[[str], Awaitable[str]]] = None) -> GuidanceChainParser:
+        """Async version of parse. Awaits repair"""
+        result, path = self.parse_local(text)
+        if result is None and repair is not None:
+            result, path = self.parse_local(await repair(text))
+            path = path and "repair"
+        return self._finish(text, result, path)
+
+    def _finish(self, text: str, result: Optional[GuidanceChainParser], path: Optional[str]) -> GuidanceChainParser:
+        if result is None:
+            self._count("failed")
+            raise OutputParserException(f"Could not parse GuidanceChain answer: {text!r}")
+        self._count(path)
+        return result
+
+
+# Shared GuidanceChain parser of the process
+guidance_output_parser = GuidanceOutputParser()
@@ -1,10 +1,21 @@
+import asyncio
+import contextvars
 import random
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional, Dict
+from threading import Lock
+from time import perf_counter
+from typing import List, Optional, Dict, Iterator, Tuple
 
 from Model.Agents.Agents import GuidanceAgent, ConversationAgent, BaseAgent
+from Model.Cache.RoutingCache import routing_cache
+from Model.CallPolicy.CallPolicy import CallPolicyError, DeadlineExceededError
+from Model.Chain.Chain import Chain
 from Model.Config.Config import config
 from Model.Memory.Memory import BaseMemory
+from Model.Metrics.Metrics import metrics
+from Model.Router.Router import local_router, routing_log
 
 
 @dataclass
@@ -13,11 +24,137 @@ class AgentIndex:
     max: int
 
 
+class SpeculationStats:
+    """Hit/miss counters of speculative routing. Shared by all sessions of the process.
+
+    A mispredicted agent of the sync pipeline can not be stopped, so every sync miss pays for one
+    more agent call. Sync speculation is only used while the hit rate of the recent speculations
+    is at least min_hit_rate. Below it, one turn in probe_every still speculates, so the hit rate
+    is measured again.
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor of SpeculationStats class
+
+        Args:
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                min_hit_rate (float): Minimum recent hit rate of sync speculation. Defaults to config file
+                hit_rate_window (int): Number of recent speculations of the hit rate. Defaults to config file
+                min_samples (int): Speculations made before the hit rate is used. Defaults to config file
+                probe_every (int): Below the hit rate, one turn in probe_every speculates. Defaults to config file
+        """
+        speculation_config = config["SPECULATIVE_ROUTING"]
+        self._min_hit_rate = kwargs.get("min_hit_rate", speculation_config["min_hit_rate"])
+        self._min_samples = kwargs.get("min_samples", speculation_config["min_samples"])
+        self._probe_every = kwargs.get("probe_every", speculation_config["probe_every"])
+
+        self._lock = Lock()
+        # Recent outcomes, 1 for a hit and 0 for a miss
+        self._outcomes = deque(maxlen=kwargs.get("hit_rate_window", speculation_config["hit_rate_window"]))
+        self._hits = 0
+        self._misses = 0
+        self._skipped = 0
+        self._below_hit_rate = 0
+        self._saved_seconds = 0.0
+        self._wasted = 0
+        self._wasted_seconds = 0.0
+
+    def hit(self, saved_seconds: float):
+        with self._lock:
+            self._hits += 1
+            self._outcomes.append(1)
+            self._saved_seconds += saved_seconds
+
+    def miss(self):
+        with self._lock:
+            self._misses += 1
+            self._outcomes.append(0)
+
+    def skip(self):
+        with self._lock:
+            self._skipped += 1
+
+    def waste(self, seconds: float):
+        """Records an agent call made for a miss which could not be cancelled
+
+        Args:
+            seconds (float): Seconds the dropped agent ran
+        """
+        with self._lock:
+            self._wasted += 1
+            self._wasted_seconds += seconds
+
+    def sync_speculation_allowed(self) -> bool:
+        """Returns whether a sync turn may speculate. Counts turns skipped for the hit rate
+
+        Returns:
+            bool: True while the recent hit rate is high enough, not known yet, or the turn probes it
+        """
+        with self._lock:
+            if len(self._outcomes) < self._min_samples:
+                return True
+            if sum(self._outcomes) / len(self._outcomes) >= self._min_hit_rate:
+                return True
+            self._below_hit_rate += 1
+            return self._below_hit_rate % self._probe_every == 0
+
+    def stats(self) -> Dict[str, float]:
+        """Returns speculation counters
+
+        Returns:
+            Dict[str, float]: hits, misses, turns without a prediction, sync turns not speculated for
+            the hit rate, hit rate, recent hit rate, total latency saved in seconds and agent calls and
+            seconds wasted on sync misses
+        """
+        with self._lock:
+            speculated = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "skipped": self._skipped,
+                "below_hit_rate": self._below_hit_rate,
+                "hit_rate": self._hits / speculated if speculated else 0.0,
+                "recent_hit_rate": sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0,
+                "saved_seconds": self._saved_seconds,
+                "wasted": self._wasted,
+                "wasted_seconds": self._wasted_seconds,
+            }
+
+
+speculation_stats = SpeculationStats()
+
+# Threads (greenlets under gevent) running speculative agents
+_speculation_executor = ThreadPoolExecutor(
+    max_workers=config["SPECULATIVE_ROUTING"]["max_workers"],
+    thread_name_prefix="speculation",
+)
+
+
+def summarize_memories(summary: str, messages: str) -> str:
+    """Folds transcript of old messages into the rolling summary with SummaryChain
+
+    Args:
+        summary (str): Previous summary
+        messages (str): Transcript of messages to fold
+
+    Returns:
+        str: New summary
+    """
+    answer, _ = Chain(chain_name="SummaryChain").run(inputs={"summary": summary, "messages": messages})
+    return answer.strip()
+
+
 class PersonaChatbotMemory(BaseMemory):
     """AI PersonaChatbot memory class. Inherits from BaseMemory"""
 
     def __init__(self):
-        super().__init__()
+        super().__init__(
+            window_size=config["LONG_TERM_MEMORY_WINDOW_SIZE"],
+            summarizer=summarize_memories,
+            summary_batch=config["LONG_TERM_MEMORY_SUMMARY_BATCH"],
+        )
 
 
 class BasePersonaChatbot:
@@ -130,13 +267,89 @@ class BasePersonaChatbot:
         Returns:
             (int, str): agent_index in AGENTS array, agent name
         """
+        with metrics.span("route"):
+            # Same conversation tail was routed before
+            routed = routing_cache.get(self._memory.memory_array)
+            if routed is not None:
+                return routed
+
+            # Local router answers without a network call when it is confident
+            previous_agent = self.previous_agent()
+            start = perf_counter()
+            routed = local_router.route(text=self._user_input, previous_agent=previous_agent)
+            if routed is not None:
+                routing_log.append(self._user_input, previous_agent, routed[1], "local", perf_counter() - start)
+                return routed
+
+            # Calls for GuidanceAgent which is responsible from selecting next agent to
+            # answer user prompt, according to conversation history.
+            guidance_agent: GuidanceAgent = self._agents["GuidanceAgent"]
+            try:
+                agent_index, agent_name = guidance_agent.chooseNextAgent()
+            except CallPolicyError as e:
+                return self._fallback_agent(e)
+            routing_log.append(self._user_input, previous_agent, agent_name, "llm", perf_counter() - start)
+            routing_cache.set(self._memory.memory_array, (agent_index, agent_name))
+
+            return agent_index, agent_name
+
+    async def achoose_next_agent(self) -> (int, str):
+        """Async version of choose_next_agent
+
+        Returns:
+            (int, str): agent_index in AGENTS array, agent name
+        """
+        with metrics.span("route"):
+            # Same conversation tail was routed before
+            routed = routing_cache.get(self._memory.memory_array)
+            if routed is not None:
+                return routed
+
+            previous_agent = self.previous_agent()
+            start = perf_counter()
+            routed = local_router.route(text=self._user_input, previous_agent=previous_agent)
+            if routed is not None:
+                routing_log.append(self._user_input, previous_agent, routed[1], "local", perf_counter() - start)
+                return routed
+
+            guidance_agent: GuidanceAgent = self._agents["GuidanceAgent"]
+            try:
+                agent_index, agent_name = await guidance_agent.achooseNextAgent()
+            except CallPolicyError as e:
+                return self._fallback_agent(e)
+            routing_log.append(self._user_input, previous_agent, agent_name, "llm", perf_counter() - start)
+            routing_cache.set(self._memory.memory_array, (agent_index, agent_name))
+
+            return agent_index, agent_name
+
+    def _fallback_agent(self, error: CallPolicyError) -> (int, str):
+        """Returns agent answering when GuidanceAgent could not reach the LLM provider. Fallback
+        answers are not cached or logged as routing decisions.
+
+        Args:
+            error (CallPolicyError): Error of the routing call
+
+        Raises:
+            CallPolicyError: No fallback agent is configured or the turn deadline passed
+
+        Returns:
+            (int, str): agent_index in AGENTS array, agent name
+        """
+        agent_name = config["CALL_POLICY"]["fallback_agent"]
+        # Without time left the fallback agent could not answer either
+        if isinstance(error, DeadlineExceededError) or agent_name not in self._agents:
+            raise error
+        print(f"Routing failed, falling back to {agent_name}: {error}")
+        return config["AGENTS_NAMES"].index(agent_name), agent_name
 
-        # Calls for GuidanceAgent which is responsible from selecting next agent to
-        # answer user prompt, according to conversation history.
-        guidance_agent: GuidanceAgent = self._agents["GuidanceAgent"]
-        agent_index, agent_name = guidance_agent.chooseNextAgent()
+    def previous_agent(self) -> Optional[str]:
+        """Returns the agent answered the previous message of the session
 
-        return agent_index, agent_name
+        Returns:
+            Optional[str]: Agent name. None if no agent answered yet
+        """
+        agents = [agent_name for agent_name in self._memory.get_all_agents() if agent_name in self._agents]
+        return agents[-1] if agents else None
 
     def run_agent_by_name(self, agent_name: str) -> str:
         """Run agent by name. The Name of the agent must be same with config file naming
@@ -147,14 +360,189 @@ class BasePersonaChatbot:
         Returns:
             str: Answer of agent
         """
+        message = self._run_agent(agent_name=agent_name)
+        self.add_to_memory(by=self._ai_name, message=message, agent_name=agent_name)
+        return message
+
+    async def arun_agent_by_name(self, agent_name: str) -> str:
+        """Async version of run_agent_by_name
+
+        Args:
+            agent_name (str): Name of agent
+
+        Returns:
+            str: Answer of agent
+        """
+        message = await self._arun_agent(agent_name=agent_name)
+        self.add_to_memory(by=self._ai_name, message=message, agent_name=agent_name)
+        return message
+
+    def _run_agent(self, agent_name: str) -> str:
+        # Runs agent without adding its answer to memory
+        # Change text variable in the agent
+        self._agents[agent_name].text = self._user_input
+
+        with metrics.span("agent", agent=agent_name):
+            _, responses, _ = self._agents[agent_name].run_chains()
+
+        return "\n".join(responses)
+
+    async def _arun_agent(self, agent_name: str) -> str:
+        # Runs agent without adding its answer to memory
         # Change text variable in the agent
         self._agents[agent_name].text = self._user_input
 
-        _, responses, _ = self._agents[agent_name].run_chains()
+        with metrics.span("agent", agent=agent_name):
+            _, responses, _ = await self._agents[agent_name].arun_chains()
+
+        return "\n".join(responses)
+
+    def predict_next_agent(self) -> Optional[str]:
+        """Predicts next agent from the recent routing history of the session. Used to start the
+        agent speculatively while GuidanceAgent is still routing.
+
+        Returns:
+            Optional[str]: Name of the most likely agent. None if history is not decisive enough
+        """
+        speculation_config = config["SPECULATIVE_ROUTING"]
+
+        # Only agents which answer user can be predicted
+        history = [
+            agent_name for agent_name in self._memory.get_all_agents()
+            if agent_name in self._agents and agent_name != "GuidanceAgent"
+        ][-speculation_config["history_window"]:]
+
+        if not history:
+            default_agent = speculation_config["default_agent"]
+            return default_agent if default_agent in self._agents else None
+
+        agent_name, count = Counter(history).most_common(1)[0]
+        if count / len(history) < speculation_config["min_agreement"]:
+            return None
+
+        return agent_name
+
+    def run_next_agent(self) -> Tuple[str, str]:
+        """Chooses next agent and runs it. When speculative routing is enabled in config file, the
+        predicted agent runs at the same time as GuidanceAgent. Its answer is kept if routing
+        agrees, otherwise it is dropped and the chosen agent runs. A dropped agent can not be
+        stopped, so a miss costs one more agent call. Turns do not speculate while the recent hit
+        rate is below min_hit_rate.
+
+        Returns:
+            (str, str): agent name, answer of agent
+        """
+        predicted_agent = None
+        if config["SPECULATIVE_ROUTING"]["enabled"]:
+            predicted_agent = self.predict_next_agent()
+            if predicted_agent is None:
+                speculation_stats.skip()
+            elif not speculation_stats.sync_speculation_allowed():
+                predicted_agent = None
+
+        if predicted_agent is None:
+            _, agent_name = self.choose_next_agent()
+            return agent_name, self.run_agent_by_name(agent_name=agent_name)
+
+        # Start predicted agent and route at the same time
+        start = perf_counter()
+        # Context is copied, so spans of the speculative agent are reported with the request
+        speculative_answer = _speculation_executor.submit(
+            contextvars.copy_context().run, self._timed_run_agent, predicted_agent
+        )
+        try:
+            _, agent_name = self.choose_next_agent()
+        except Exception:
+            speculative_answer.cancel()
+            raise
+        routing_seconds = perf_counter() - start
+
+        if agent_name == predicted_agent:
+            message, agent_seconds = speculative_answer.result()
+            speculation_stats.hit(saved_seconds=min(routing_seconds, agent_seconds))
+        else:
+            # Running threads can not be stopped, their answer is dropped and their time is wasted
+            if not speculative_answer.cancel():
+                speculative_answer.add_done_callback(lambda _: speculation_stats.waste(perf_counter() - start))
+            speculation_stats.miss()
+            message = self._run_agent(agent_name=agent_name)
 
-        message = "\n".join(responses)
         self.add_to_memory(by=self._ai_name, message=message, agent_name=agent_name)
-        return message
+        return agent_name, message
+
+    async def arun_next_agent(self) -> Tuple[str, str]:
+        """Async version of run_next_agent. The speculative agent is cancelled when routing does
+        not agree.
+
+        Returns:
+            (str, str): agent name, answer of agent
+        """
+        predicted_agent = None
+        if config["SPECULATIVE_ROUTING"]["enabled"]:
+            predicted_agent = self.predict_next_agent()
+            if predicted_agent is None:
+                speculation_stats.skip()
+
+        if predicted_agent is None:
+            _, agent_name = await self.achoose_next_agent()
+            return agent_name, await self.arun_agent_by_name(agent_name=agent_name)
+
+        # Start predicted agent and route at the same time
+        start = perf_counter()
+        speculative_answer = asyncio.ensure_future(self._atimed_run_agent(predicted_agent))
+        try:
+            _, agent_name = await self.achoose_next_agent()
+        except BaseException:
+            speculative_answer.cancel()
+            raise
+        routing_seconds = perf_counter() - start
+
+        if agent_name == predicted_agent:
+            message, agent_seconds = await speculative_answer
+            speculation_stats.hit(saved_seconds=min(routing_seconds, agent_seconds))
+        else:
+            speculative_answer.cancel()
+            speculation_stats.miss()
+            message = await self._arun_agent(agent_name=agent_name)
+
+        self.add_to_memory(by=self._ai_name, message=message, agent_name=agent_name)
+        return agent_name, message
+
+    def _timed_run_agent(self, agent_name: str) -> Tuple[str, float]:
+        start = perf_counter()
+        message = self._run_agent(agent_name=agent_name)
+        return message, perf_counter() - start
+
+    async def _atimed_run_agent(self, agent_name: str) -> Tuple[str, float]:
+        start = perf_counter()
+        message = await self._arun_agent(agent_name=agent_name)
+        return message, perf_counter() - start
+
+    def stream_agent_by_name(self, agent_name: str) -> Iterator[str]:
+        """Streaming version of run_agent_by_name. Yields answer parts of the agent while they
+        are generated. The whole message is added to memory when the stream finishes or is
+        closed early, for example when the client disconnects.
+
+        Args:
+            agent_name (str): Name of agent
+
+        Yields:
+            str: Parts of the answer of agent
+        """
+        # Change text variable in the agent
+        self._agents[agent_name].text = self._user_input
+
+        parts = []
+        try:
+            with metrics.span("agent", agent=agent_name):
+                for part in self._agents[agent_name].stream_chains():
+                    parts.append(part)
+                    yield part
+        finally:
+            # Stored like answers of run_agent_by_name, without surrounding whitespace of the parts
+            message = "".join(parts).strip()
+            if message:
+                self.add_to_memory(by=self._ai_name, message=message, agent_name=agent_name)
 
     def add_to_memory(self, by: str, message: str, **kwargs):
         """Appends to the memory array.
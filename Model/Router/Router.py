@@ -0,0 +1,321 @@
+import math
+import os
+import re
+import zlib
+from collections import defaultdict
+from random import Random
+from threading import Lock
+from time import perf_counter, time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import ujson
+
+from Model.Config.Config import config
+
+_WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+def routing_features(text: str, previous_agent: Optional[str] = None, dimension: int = 2 ** 18) -> List[int]:
+    """Hashed n-gram features of a routing example
+
+    Args:
+        text (str): User input
+        previous_agent (Optional[str], optional): Agent answered the previous message. Defaults to None.
+        dimension (int, optional): Size of the hashed feature space. Defaults to 2 ** 18.
+
+    Returns:
+        List[int]: Indexes of active features
+    """
+    text = text.lower()
+    words = _WORD_PATTERN.findall(text)
+
+    grams = [f"w:{word}" for word in words]
+    grams += [f"b:{first} {second}" for first, second in zip(words, words[1:])]
+    padded = f" {' '.join(words)} "
+    grams += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    grams.append(f"p:{previous_agent or ''}")
+    grams.append("bias")
+
+    # crc32 is stable across processes unlike hash()
+    return list({zlib.crc32(gram.encode()) % dimension for gram in grams})
+
+
+class HashedNgramRouter:
+    """Multinomial logistic regression over hashed word, bigram and character n-grams.
+    Small enough to run on every message without a network call.
+    """
+
+    def __init__(self, labels: List[str], dimension: int = 2 ** 18):
+        """Constructor of HashedNgramRouter class
+
+        Args:
+            labels (List[str]): Agent names the router can choose
+            dimension (int, optional): Size of the hashed feature space. Defaults to 2 ** 18.
+        """
+        self._labels = list(labels)
+        self._dimension = dimension
+
+        # Sparse weights. Feature index -> weight per label
+        self._weights: Dict[int, List[float]] = {}
+
+    @property
+    def labels(self):
+        return self._labels
+
+    def predict_proba(self, text: str, previous_agent: Optional[str] = None) -> List[float]:
+        """Returns probability of every label
+
+        Args:
+            text (str): User input
+            previous_agent (Optional[str], optional): Agent answered the previous message. Defaults to None.
+
+        Returns:
+            List[float]: Probabilities in labels order
+        """
+        scores = [0.0] * len(self._labels)
+        for feature in routing_features(text, previous_agent, self._dimension):
+            weights = self._weights.get(feature)
+            if weights is not None:
+                for i, weight in enumerate(weights):
+                    scores[i] += weight
+
+        # Softmax
+        top = max(scores)
+        exps = [math.exp(score - top) for score in scores]
+        total = sum(exps)
+        return [value / total for value in exps]
+
+    def predict(self, text: str, previous_agent: Optional[str] = None) -> Tuple[str, float]:
+        """Returns most likely label and its probability
+
+        Args:
+            text (str): User input
+            previous_agent (Optional[str], optional): Agent answered the previous message. Defaults to None.
+
+        Returns:
+            (str, float): label, confidence
+        """
+        probabilities = self.predict_proba(text, previous_agent)
+        best = max(range(len(probabilities)), key=probabilities.__getitem__)
+        return self._labels[best], probabilities[best]
+
+    def fit(
+            self,
+            examples: List[Tuple[str, Optional[str], str]],
+            epochs: int = 10,
+            learning_rate: float = 0.5,
+            l2: float = 1e-6,
+            seed: int = 0,
+    ):
+        """Trains the router with stochastic gradient descent
+
+        Args:
+            examples (List[Tuple[str, Optional[str], str]]): (text, previous agent, label) examples
+            epochs (int, optional): Passes over examples. Defaults to 10.
+            learning_rate (float, optional): Initial learning rate. Defaults to 0.5.
+            l2 (float, optional): L2 regularization. Defaults to 1e-6.
+            seed (int, optional): Shuffle seed. Defaults to 0.
+        """
+        label_indexes = {label: i for i, label in enumerate(self._labels)}
+        data = [
+            (routing_features(text, previous_agent, self._dimension), label_indexes[label])
+            for text, previous_agent, label in examples if label in label_indexes
+        ]
+        random = Random(seed)
+
+        for epoch in range(epochs):
+            random.shuffle(data)
+            rate = learning_rate / (1 + epoch)
+            for features, target in data:
+                scores = [0.0] * len(self._labels)
+                for feature in features:
+                    weights = self._weights.get(feature)
+                    if weights is not None:
+                        for i, weight in enumerate(weights):
+                            scores[i] += weight
+
+                top = max(scores)
+                exps = [math.exp(score - top) for score in scores]
+                total = sum(exps)
+
+                # Gradient of cross entropy with softmax
+                gradients = [value / total - (1.0 if i == target else 0.0) for i, value in enumerate(exps)]
+                for feature in features:
+                    weights = self._weights.setdefault(feature, [0.0] * len(self._labels))
+                    for i, gradient in enumerate(gradients):
+                        weights[i] -= rate * (gradient + l2 * weights[i])
+
+    def save(self, path: str):
+        """Saves router to a JSON file
+
+        Args:
+            path (str): File path
+        """
+        with open(path, "w") as f:
+            ujson.dump(
+                {
+                    "labels": self._labels,
+                    "dimension": self._dimension,
+                    "weights": {str(feature): weights for feature, weights in self._weights.items()},
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "HashedNgramRouter":
+        """Loads router from a JSON file
+
+        Args:
+            path (str): File path
+
+        Returns:
+            HashedNgramRouter: Trained router
+        """
+        with open(path) as f:
+            data = ujson.load(f)
+
+        router = cls(labels=data["labels"], dimension=data["dimension"])
+        router._weights = {int(feature): weights for feature, weights in data["weights"].items()}
+        return router
+
+
+class RoutingLog:
+    """Append-only JSON lines log of routing decisions. Training data of the local router"""
+
+    def __init__(self, path: Optional[str]):
+        """Constructor of RoutingLog class
+
+        Args:
+            path (Optional[str]): Log file path. Logging is disabled if None
+        """
+        self._path = path
+        self._lock = Lock()
+
+    def append(self, text: str, previous_agent: Optional[str], agent_name: str, source: str, latency: float):
+        """Appends a routing decision
+
+        Args:
+            text (str): User input
+            previous_agent (Optional[str]): Agent answered the previous message
+            agent_name (str): Chosen agent
+            source (str): Router made the decision. "llm" or "local"
+            latency (float): Routing latency in seconds
+        """
+        if not self._path:
+            return
+
+        line = ujson.dumps({
+            "text": text,
+            "previous_agent": previous_agent,
+            "agent_name": agent_name,
+            "source": source,
+            "latency": latency,
+            "timestamp": time(),
+        })
+        with self._lock:
+            with open(self._path, "a") as f:
+                f.write(line + "\n")
+
+    @staticmethod
+    def read(path: str) -> Iterable[dict]:
+        """Reads routing decisions of a log file
+
+        Args:
+            path (str): Log file path
+
+        Yields:
+            dict: Logged routing decision
+        """
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield ujson.loads(line)
+
+
+class LocalRouter:
+    """Fast-path router in front of GuidanceAgent. Answers when the trained model is confident
+    enough, otherwise GuidanceAgent is asked.
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor of LocalRouter class
+
+        Args:
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                enabled (bool): Use the local router. Defaults to config file
+                model_path (str): Trained router file. Defaults to config file
+                confidence_threshold (float): Minimum confidence to skip GuidanceAgent. Defaults to config file
+        """
+        router_config = config["LOCAL_ROUTER"]
+        self._enabled = kwargs.get("enabled", router_config["enabled"])
+        self._model_path = kwargs.get("model_path", router_config["model_path"])
+        self._confidence_threshold = kwargs.get("confidence_threshold", router_config["confidence_threshold"])
+
+        # Model is loaded on the first message
+        self._model: Optional[HashedNgramRouter] = None
+        self._loaded = False
+        self._lock = Lock()
+
+        # Counters per route
+        self._routed: Dict[str, int] = defaultdict(int)
+        self._fallbacks = 0
+        self._seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def _get_model(self) -> Optional[HashedNgramRouter]:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    if os.path.exists(self._model_path):
+                        self._model = HashedNgramRouter.load(self._model_path)
+                    else:
+                        print(f"Local router model not found: {self._model_path}")
+                    self._loaded = True
+        return self._model
+
+    def route(self, text: str, previous_agent: Optional[str] = None) -> Optional[Tuple[int, str]]:
+        """Routes user input locally
+
+        Args:
+            text (str): User input
+            previous_agent (Optional[str], optional): Agent answered the previous message. Defaults to None.
+
+        Returns:
+            Optional[Tuple[int, str]]: agent index, agent name. None if not confident enough
+        """
+        if not self._enabled:
+            return None
+
+        model = self._get_model()
+        if model is None:
+            return None
+
+        start = perf_counter()
+        agent_name, confidence = model.predict(text, previous_agent)
+        self._seconds += perf_counter() - start
+
+        if confidence < self._confidence_threshold or agent_name not in config["AGENTS_NAMES"]:
+            self._fallbacks += 1
+            return None
+
+        self._routed[agent_name] += 1
+        return config["AGENTS_NAMES"].index(agent_name), agent_name
+
+    def stats(self) -> Dict[str, object]:
+        """Returns local router counters
+
+        Returns:
+            Dict[str, object]: Messages routed locally per agent, fallbacks to GuidanceAgent and
+            total local routing time in seconds
+        """
+        return {"routed": dict(self._routed), "fallbacks": self._fallbacks, "seconds": self._seconds}
+
+
+# Shared router and routing log of the process
+local_router = LocalRouter()
+routing_log = RoutingLog(config["LOCAL_ROUTER"]["log_path"])
@@ -0,0 +1,120 @@
+"""Trains and evaluates the local router from logged routing decisions.
+
+Usage:
+    python -m Model.Router.train --log routing.jsonl [--model Model/Router/router.json] [--eval-split 0.2]
+"""
+import argparse
+from collections import defaultdict
+from random import Random
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+from Model.Config.Config import config
+from Model.Router.Router import HashedNgramRouter, RoutingLog
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def evaluate(
+        router: HashedNgramRouter,
+        examples: List[Tuple[str, Optional[str], str]],
+        threshold: float,
+):
+    """Prints per-route accuracy, coverage at confidence threshold and local routing latency
+
+    Args:
+        router (HashedNgramRouter): Trained router
+        examples (List[Tuple[str, Optional[str], str]]): (text, previous agent, label) examples
+        threshold (float): Confidence threshold of fast path
+    """
+    totals = defaultdict(int)
+    corrects = defaultdict(int)
+    predicted = defaultdict(int)
+    confident = 0
+    confident_correct = 0
+    latencies = []
+
+    for text, previous_agent, label in examples:
+        start = perf_counter()
+        prediction, confidence = router.predict(text, previous_agent)
+        latencies.append(perf_counter() - start)
+
+        totals[label] += 1
+        predicted[prediction] += 1
+        corrects[label] += prediction == label
+        if confidence >= threshold:
+            confident += 1
+            confident_correct += prediction == label
+
+    print(f"{'route':<20}{'support':>10}{'recall':>10}{'precision':>12}")
+    for label in router.labels:
+        recall = corrects[label] / totals[label] if totals[label] else 0.0
+        precision = corrects[label] / predicted[label] if predicted[label] else 0.0
+        print(f"{label:<20}{totals[label]:>10}{recall:>10.3f}{precision:>12.3f}")
+
+    total = len(examples)
+    print(f"accuracy: {sum(corrects.values()) / total:.3f}")
+    print(f"fast path coverage at {threshold}: {confident / total:.3f}")
+    print(f"fast path accuracy at {threshold}: {confident_correct / confident if confident else 0.0:.3f}")
+    print(
+        f"local latency: p50 {percentile(latencies, 0.5) * 1e3:.3f} ms, "
+        f"p99 {percentile(latencies, 0.99) * 1e3:.3f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--log", required=True, help="Routing log written by the application")
+    parser.add_argument("--model", default=config["LOCAL_ROUTER"]["model_path"], help="Output model path")
+    parser.add_argument("--eval-split", type=float, default=0.2, help="Share of examples held out")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=config["LOCAL_ROUTER"]["confidence_threshold"])
+    args = parser.parse_args()
+
+    # Only decisions of GuidanceAgent are ground truth. Labels are the agents of the config file, so
+    # agents missing from the log still get weights
+    labels = list(config["AGENTS_NAMES"])
+    records = [
+        record for record in RoutingLog.read(args.log)
+        if record["source"] == "llm" and record["agent_name"] in labels
+    ]
+    examples = [(record["text"], record["previous_agent"], record["agent_name"]) for record in records]
+    Random(0).shuffle(examples)
+
+    # A router trained on one agent is always confident and would route every message to it
+    seen_labels = {label for _, _, label in examples}
+    if len(seen_labels) < 2:
+        raise SystemExit(
+            f"Routing log has examples of {sorted(seen_labels)} only. At least 2 agents are needed to train"
+        )
+
+    llm_latencies = [record["latency"] for record in records]
+    print(f"examples: {len(examples)}")
+    print(
+        f"llm latency: p50 {percentile(llm_latencies, 0.5) * 1e3:.1f} ms, "
+        f"p99 {percentile(llm_latencies, 0.99) * 1e3:.1f} ms"
+    )
+
+    split = int(len(examples) * (1 - args.eval_split))
+    train_examples, eval_examples = examples[:split], examples[split:]
+
+    router = HashedNgramRouter(labels=labels)
+    router.fit(train_examples, epochs=args.epochs)
+
+    if eval_examples:
+        evaluate(router, eval_examples, args.threshold)
+
+    # Final model is trained with all examples
+    router = HashedNgramRouter(labels=labels)
+    router.fit(examples, epochs=args.epochs)
+    router.save(args.model)
+    print(f"saved: {args.model}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import os
+from typing import Dict
+
+from Model.Cache.Cache import LRUCache
+from Model.Config.Config import config
+from Model.PersonaChatbot.PersonaChatbot import PersonaChatbot
+from Model.Session.SessionLog import create_session_log
+from Model.Session.SessionStore import create_session_store
+
+# Name of the PersonaChatbot serving every session
+PERSONA_CHATBOT_NAME = "Healty Diet Assistant"
+
+# Store of session memories and version of every session loaded in this worker
+session_store = create_session_store()
+_session_versions: Dict[str, int] = {}
+
+# Log of memory changes, so sessions of the in-process store survive worker restarts
+session_log = create_session_log()
+if session_log is not None and session_store.shared:
+    print("Session log is not used, shared session store keeps every session")
+    session_log = None
+
+# Workers forked from a preloading master open their own store connections and log segments
+os.register_at_fork(after_in_child=session_store.after_fork)
+if session_log is not None:
+    os.register_at_fork(after_in_child=session_log.after_fork)
+
+
+def _on_session_evicted(session_id: str, persona_chatbot: PersonaChatbot):
+    """Eviction hook of the session cache. Keeps evicted sessions in the in-process store in
+    serialized form when configured.
+
+    Args:
+        session_id (str): Id of the chat session
+        persona_chatbot (PersonaChatbot): Evicted PersonaChatbot
+    """
+    if config["SESSION_CACHE"]["persist_on_evict"] and not session_store.shared:
+        _session_versions[session_id] = session_store.save(session_id, persona_chatbot.memory.dumps())
+    else:
+        _session_versions.pop(session_id, None)
+
+
+# Cache to store PersonaChatbot instances for each session
+persona_chatbots = LRUCache(
+    max_size=config["SESSION_CACHE"]["max_sessions"],
+    ttl=config["SESSION_CACHE"]["idle_ttl"],
+    on_evict=_on_session_evicted,
+)
+
+
+def get_persona_chatbot(session_id: str) -> PersonaChatbot:
+    """Returns PersonaChatbot of the session. Creates it on the first message of the session.
+    Memory is loaded from the session store if the session is not alive in this worker or if
+    another worker saved a newer version. Sessions not in the store are restored from the session
+    log, if enabled.
+
+    Args:
+        session_id (str): Id of the chat session
+
+    Returns:
+        PersonaChatbot: PersonaChatbot of the session
+    """
+    # Idle sessions are evicted before a new one is added
+    persona_chatbots.expire()
+
+    persona_chatbot = persona_chatbots.get(session_id)
+    is_new = persona_chatbot is None
+    if is_new:
+        persona_chatbot = PersonaChatbot(PERSONA_CHATBOT_NAME)
+        persona_chatbots.set(session_id, persona_chatbot)
+
+    if is_new or session_store.shared:
+        version = session_store.version(session_id)
+        if version is not None and (is_new or version != _session_versions.get(session_id)):
+            stored = session_store.load(session_id)
+            if stored is not None:
+                version, data = stored
+                persona_chatbot.memory.restore(data)
+                _session_versions[session_id] = version
+                # Live session is the only copy in this worker, it is saved again when evicted
+                if not session_store.shared:
+                    session_store.delete(session_id)
+
+    if is_new and session_log is not None:
+        if session_id not in _session_versions:
+            session_log.restore(session_id, persona_chatbot.memory)
+        # Changes from now on are logged, restored memories already are
+        persona_chatbot.memory.journal = session_log.journal(session_id)
+
+    return persona_chatbot
+
+
+def save_persona_chatbot(session_id: str):
+    """Saves memory of the session to the session store. With the session log, snapshots the
+    session when due and waits for its records as the fsync policy requires
+
+    Args:
+        session_id (str): Id of the chat session
+    """
+    persona_chatbot = persona_chatbots.get(session_id, touch=False)
+    if persona_chatbot is None:
+        return
+    if session_log is not None:
+        session_log.commit(session_id, persona_chatbot.memory)
+    if not session_store.shared:
+        return
+
+    data = persona_chatbot.memory.dumps()
+    _session_versions[session_id] = session_store.save(session_id, data)
+
+
+def session_gauges() -> Dict[str, float]:
+    """Returns gauges of sessions alive in this worker
+
+    Returns:
+        Dict[str, float]: Live sessions, total stored messages, estimated bytes of memories,
+        session cache counters and size of the in-process session store
+    """
+    memories = [persona_chatbot.memory for persona_chatbot in persona_chatbots.values()]
+    gauges = {
+        "live_sessions": len(memories),
+        "stored_messages": sum(memory.number_of_memories for memory in memories),
+        "estimated_bytes": sum(memory.estimated_bytes for memory in memories),
+        **{f"cache_{name}": value for name, value in persona_chatbots.stats().items()},
+    }
+    if not session_store.shared:
+        # Evicted sessions kept in serialized form
+        store_stats = session_store.stats()
+        gauges.update({f"store_{name}": value for name, value in store_stats.items()})
+        gauges["estimated_bytes"] += store_stats["bytes"]
+    return gauges
@@ -0,0 +1,630 @@
+import atexit
+import fcntl
+import hashlib
+import os
+import struct
+import zlib
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread, get_ident
+from time import monotonic, perf_counter
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import ujson
+
+from Model.Config.Config import config
+from Model.Memory.Memory import BaseMemory
+
+# Record header: payload length and crc32 of the payload. A torn or corrupt record ends the segment
+_HEADER = struct.Struct(">II")
+
+# Suffixes of log segment and snapshot files
+SEGMENT_SUFFIX = ".log"
+SNAPSHOT_SUFFIX = ".snap"
+
+# File locked by the writer of a group, so sequence numbers are given by one process at a time
+LOCK_FILE = "sequence.lock"
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+def _encode(payload: bytes) -> bytes:
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _read_records(f: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    """Yields offset and payload of every record of a file up to the first torn or corrupt one"""
+    offset = 0
+    while True:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        length, crc = _HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        yield offset, payload
+        offset += _HEADER.size + length
+
+
+class SessionLog:
+    """Durable append-only log of memory changes of every session, so sessions survive worker
+    restarts. Every BaseMemory change is a record of the session with a sequence number. Records
+    are written by a background writer in groups, one write and at most one fsync per group.
+
+    A compact snapshot of a session is written every snapshot_every records. A session is restored
+    from its snapshot and the records after it, which are found through an index of the log. The
+    index reads only the records appended to the segments since its last update. compact method
+    snapshots sessions of finished segments and deletes them, so the log does not grow with the
+    history.
+
+    Every process writes its own segment files, named with its pid. Sequence numbers order the
+    records of a session across segments. They are given by the writer of a group while it holds
+    the lock file of the directory, after it indexed the records other processes appended, so
+    records of a session written by several workers get distinct numbers in the order they are
+    written.
+    """
+
+    def __init__(self, directory: str, **kwargs):
+        """Constructor of SessionLog class
+
+        Args:
+            directory (str): Directory of log segments and snapshots
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                fsync (str): "always" makes commit wait until records are on disk, "interval" syncs
+            every fsync_interval seconds, "never" leaves it to the OS. Defaults to config file
+                fsync_interval (float): Seconds between syncs of "interval" policy. Defaults to config file
+                snapshot_every (int): Records of a session between its snapshots. Defaults to config file
+                segment_bytes (int): Size a segment is finished at. Defaults to config file
+        """
+        log_config = config["SESSION_LOG"]
+        self._directory = directory
+        self._snapshot_directory = os.path.join(directory, "snapshots")
+        self._fsync = kwargs.get("fsync", log_config["fsync"])
+        self._fsync_interval = kwargs.get("fsync_interval", log_config["fsync_interval"])
+        self._snapshot_every = kwargs.get("snapshot_every", log_config["snapshot_every"])
+        self._segment_bytes = kwargs.get("segment_bytes", log_config["segment_bytes"])
+        if self._fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown session log fsync policy: {self._fsync}")
+
+        os.makedirs(self._snapshot_directory, exist_ok=True)
+
+        # Records since the last snapshot per session
+        self._since_snapshot: Dict[str, int] = {}
+
+        # Session id -> [(segment path, offset, sequence)] of records not covered by a read snapshot,
+        # last sequence number in the log and in the memory of this process per session, and bytes
+        # of every segment indexed so far. Guarded by the index lock
+        self._index: Dict[str, List[Tuple[str, int, int]]] = {}
+        self._sequences: Dict[str, int] = {}
+        self._memory_sequences: Dict[str, int] = {}
+        self._indexed: Dict[str, int] = {}
+
+        # Read-only descriptors of segments
+        self._readers: Dict[str, int] = {}
+
+        self._reset_writer()
+        atexit.register(self.close)
+
+    def _reset_writer(self):
+        self._condition = Condition()
+        self._index_lock = Lock()
+        self._lock_file: Optional[BinaryIO] = None
+        self._writer: Optional[Thread] = None
+        self._closed = False
+
+        # Records and snapshots waiting for the writer, with the ticket of the last record appended
+        # before them. Records get their sequence numbers when written
+        self._pending: List[Tuple[int, str, tuple]] = []
+        self._pending_snapshots: List[Tuple[int, str, bytes]] = []
+
+        # Tickets of appended and written records and counts of queued and written snapshots, so
+        # commit and flush know when theirs are written
+        self._appended = 0
+        self._written = 0
+        self._snapshots_queued = 0
+        self._snapshots = 0
+        # Tickets of the last group failed to write and its error
+        self._failure: Optional[Tuple[int, int, Exception]] = None
+
+        # Segment written by this process
+        self._writer_id = f"{os.getpid()}-{int(monotonic() * 1e6):x}"
+        self._segment_number = 0
+        self._segment: Optional[BinaryIO] = None
+        self._segment_path = ""
+        self._segment_size = 0
+        self._unsynced = False
+        self._last_sync = monotonic()
+
+        # Counters
+        self._batches = 0
+        self._fsyncs = 0
+        self._bytes = 0
+        self._restored = 0
+        self._restore_seconds = 0.0
+
+    def after_fork(self):
+        """Called in a worker forked from a preloading master. The worker writes its own segments
+        with its own writer thread
+        """
+        self._reset_writer()
+        self._readers = {}
+
+    def stats(self) -> Dict[str, float]:
+        """Returns log counters
+
+        Returns:
+            Dict[str, float]: Records appended, records waiting for the writer, groups written, fsyncs,
+            bytes written, snapshots written, sessions restored and their average restore seconds
+        """
+        with self._condition:
+            return {
+                "records": self._appended,
+                "pending": len(self._pending),
+                "batches": self._batches,
+                "fsyncs": self._fsyncs,
+                "bytes": self._bytes,
+                "snapshots": self._snapshots,
+                "restored": self._restored,
+                "restore_seconds": self._restore_seconds / self._restored if self._restored else 0.0,
+            }
+
+    def journal(self, session_id: str) -> Callable[[tuple], None]:
+        """Returns journal of BaseMemory writing the changes of the session to the log
+
+        Args:
+            session_id (str): Id of the chat session
+
+        Returns:
+            Callable[[tuple], None]: Journal
+        """
+        return lambda entry: self.append(session_id, entry)
+
+    def append(self, session_id: str, entry: tuple):
+        """Adds a memory journal entry of the session to the next group written. Does not wait for it
+
+        Args:
+            session_id (str): Id of the chat session
+            entry (tuple): Journal entry of BaseMemory
+        """
+        with self._condition:
+            self._since_snapshot[session_id] = self._since_snapshot.get(session_id, 0) + 1
+            self._appended += 1
+            self._pending.append((self._appended, session_id, entry))
+            self._start_writer()
+            self._condition.notify_all()
+
+    def commit(self, session_id: str, memory: BaseMemory):
+        """Ends a turn of the session. Queues a snapshot of the memory when it is due and, with
+        "always" fsync policy, waits until the records appended so far are on disk. Concurrent
+        turns share the write and the fsync of one group.
+
+        Args:
+            session_id (str): Id of the chat session
+            memory (BaseMemory): Memory of the session. Must not change during the call
+
+        Raises:
+            OSError: Records of the session could not be written
+        """
+        with self._condition:
+            snapshot_due = self._since_snapshot.get(session_id, 0) >= self._snapshot_every
+            if snapshot_due:
+                self._since_snapshot[session_id] = 0
+            ticket = self._appended
+
+        if snapshot_due:
+            # Records appended up to the ticket are in the snapshot. Ones made by the summary thread
+            # during dumps may be too, replaying them again is harmless
+            data = memory.dumps()
+            with self._condition:
+                self._pending_snapshots.append((ticket, session_id, data))
+                self._snapshots_queued += 1
+                self._start_writer()
+                self._condition.notify_all()
+
+        if self._fsync == "always":
+            self._wait(ticket, 0)
+
+    def flush(self):
+        """Waits until every record and snapshot queued so far is written"""
+        with self._condition:
+            ticket, snapshots = self._appended, self._snapshots_queued
+        self._wait(ticket, snapshots)
+
+    def _wait(self, ticket: int, snapshots: int):
+        with self._condition:
+            if self._written >= ticket and self._snapshots >= snapshots:
+                return
+            self._start_writer()
+            self._condition.notify_all()
+            while self._written < ticket or self._snapshots < snapshots:
+                self._condition.wait()
+            if self._failure is not None and self._failure[0] < ticket <= self._failure[1]:
+                raise OSError(f"Session log write failed: {str(self._failure[2])}")
+
+    def close(self):
+        """Writes everything queued and stops the writer. Written records are synced unless fsync
+        policy is "never"
+        """
+        with self._condition:
+            writer = self._writer
+            if writer is None:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        writer.join()
+        with self._condition:
+            self._writer = None
+            self._closed = False
+            self._close_segment()
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = Thread(target=self._write_loop, name="session-log", daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._pending_snapshots and not self._closed:
+                    if self._unsynced and self._fsync == "interval":
+                        # Written records are synced once the interval is due
+                        timeout = self._fsync_interval - (monotonic() - self._last_sync)
+                        if timeout <= 0:
+                            break
+                        self._condition.wait(timeout)
+                    else:
+                        self._condition.wait()
+                records, self._pending = self._pending, []
+                snapshots, self._pending_snapshots = self._pending_snapshots, []
+                # Records are taken in order, so every ticket up to the last appended one is in the group
+                ticket, written_before = self._appended, self._written
+                closed = self._closed
+
+            written = 0
+            try:
+                written, snapshots = self._write_records(records, snapshots)
+                self._unsynced = self._unsynced or bool(written)
+                if self._unsynced and self._segment is not None and (
+                        self._fsync == "always"
+                        or (self._fsync == "interval" and (closed or monotonic() - self._last_sync >= self._fsync_interval))
+                ):
+                    os.fsync(self._segment.fileno())
+                    self._fsyncs += 1
+                    self._last_sync = monotonic()
+                    self._unsynced = False
+                for session_id, sequence, data in snapshots:
+                    self._write_snapshot(session_id, sequence, data)
+            except Exception as e:
+                print(f"Session log write failed: {str(e)}")
+                # Segment may end with a torn record, records after it would not be read back
+                self._close_segment()
+                with self._condition:
+                    self._failure = (written_before, ticket, e)
+
+            with self._condition:
+                self._written = ticket
+                self._batches += 1 if records else 0
+                self._bytes += written
+                self._snapshots += len(snapshots)
+                self._condition.notify_all()
+                if closed and not self._pending and not self._pending_snapshots:
+                    return
+
+    @contextmanager
+    def _sequence_lock(self) -> Iterator[None]:
+        if self._lock_file is None:
+            self._lock_file = open(os.path.join(self._directory, LOCK_FILE), "ab")
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _write_records(
+            self, records: List[Tuple[int, str, tuple]], snapshots: List[Tuple[int, str, bytes]]
+    ) -> Tuple[int, List[Tuple[str, int, bytes]]]:
+        """Gives sequence numbers to the records and writes them. Returns bytes written and the
+        snapshots with the sequence number of the last record in them
+        """
+        if not records:
+            with self._index_lock:
+                return 0, [
+                    (session_id, self._memory_sequences.get(session_id, 0), data) for _, session_id, data in snapshots
+                ]
+
+        with self._sequence_lock(), self._index_lock:
+            # Records of other processes are indexed first, so their sequence numbers are not given again
+            self._scan_segments()
+
+            chunks, positions, sequenced_snapshots = [], [], []
+            snapshots = sorted(snapshots, key=lambda snapshot: snapshot[0])
+            for ticket, session_id, entry in records:
+                while snapshots and snapshots[0][0] < ticket:
+                    _, snapshot_session_id, data = snapshots.pop(0)
+                    sequenced_snapshots.append(
+                        (snapshot_session_id, self._memory_sequences.get(snapshot_session_id, 0), data)
+                    )
+                sequence = self._sequences.get(session_id, 0) + 1
+                self._sequences[session_id] = self._memory_sequences[session_id] = sequence
+                chunks.append(_encode(ujson.dumps([session_id, sequence, *entry]).encode()))
+                positions.append((session_id, sequence))
+            sequenced_snapshots += [
+                (session_id, self._memory_sequences.get(session_id, 0), data) for _, session_id, data in snapshots
+            ]
+
+            size = sum(len(chunk) for chunk in chunks)
+            if self._segment is None or self._segment_size + size > self._segment_bytes:
+                self._rotate()
+
+            # One write per group
+            offset = self._segment_size
+            self._segment.write(b"".join(chunks))
+            self._segment.flush()
+            self._segment_size += size
+
+            for (session_id, sequence), chunk in zip(positions, chunks):
+                self._index.setdefault(session_id, []).append((self._segment_path, offset, sequence))
+                offset += len(chunk)
+            self._indexed[self._segment_path] = self._segment_size
+        return size, sequenced_snapshots
+
+    def _close_segment(self):
+        if self._segment is None:
+            return
+        try:
+            self._segment.close()
+        except OSError:
+            pass
+        self._segment = None
+
+    def _rotate(self):
+        if self._segment is not None:
+            # Finished segments are always on disk, compact may delete them after a snapshot
+            os.fsync(self._segment.fileno())
+            self._close_segment()
+        self._segment_number += 1
+        self._segment_path = os.path.join(
+            self._directory, f"{self._writer_id}-{self._segment_number:06d}{SEGMENT_SUFFIX}"
+        )
+        self._segment = open(self._segment_path, "ab")
+        self._segment_size = 0
+
+    def _snapshot_path(self, session_id: str) -> str:
+        name = hashlib.sha256(session_id.encode()).hexdigest()[:32]
+        return os.path.join(self._snapshot_directory, name + SNAPSHOT_SUFFIX)
+
+    def _write_snapshot(self, session_id: str, sequence: int, data: bytes):
+        if not sequence:
+            return
+        path = self._snapshot_path(session_id)
+        current = self._read_snapshot(session_id)
+        if current is not None and current[0] >= sequence:
+            return
+
+        # Written next to the old one and renamed over it, so a crash leaves one of them whole
+        temporary = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(_encode(ujson.dumps([session_id, sequence]).encode()) + _encode(data))
+            if self._fsync != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+    def _read_snapshot(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        try:
+            with open(self._snapshot_path(session_id), "rb") as f:
+                records = list(_read_records(f))
+        except FileNotFoundError:
+            return None
+        if len(records) != 2:
+            return None
+        stored_session_id, sequence = ujson.loads(records[0][1])
+        if stored_session_id != session_id:
+            return None
+        return sequence, records[1][1]
+
+    def segments(self) -> List[str]:
+        """Returns paths of log segments
+
+        Returns:
+            List[str]: Segment paths
+        """
+        return sorted(
+            os.path.join(self._directory, name)
+            for name in os.listdir(self._directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def sessions(self) -> List[str]:
+        """Returns ids of sessions with records in the log
+
+        Returns:
+            List[str]: Session ids
+        """
+        self._update_index()
+        with self._index_lock:
+            return list(self._index)
+
+    def _scan_segments(self):
+        # Indexes records appended since the last scan. Called with the index lock held. A torn
+        # record at the end of a segment being written is read again on the next scan
+        segments = self.segments()
+        removed = set(self._indexed) - set(segments)
+        if removed:
+            self._forget_segments(removed)
+
+        for path in segments:
+            indexed = self._indexed.get(path, 0)
+            try:
+                if os.path.getsize(path) <= indexed:
+                    continue
+                with open(path, "rb") as f:
+                    f.seek(indexed)
+                    for offset, payload in _read_records(f):
+                        session_id, sequence = ujson.loads(payload)[:2]
+                        self._index.setdefault(session_id, []).append((path, indexed + offset, sequence))
+                        self._sequences[session_id] = max(self._sequences.get(session_id, 0), sequence)
+                        end = indexed + offset + _HEADER.size + len(payload)
+                        self._indexed[path] = end
+            except FileNotFoundError:
+                # Deleted by compaction of another process
+                continue
+
+    def _forget_segments(self, paths: set):
+        # Called with the index lock held
+        for session_id in list(self._index):
+            positions = [position for position in self._index[session_id] if position[0] not in paths]
+            if positions:
+                self._index[session_id] = positions
+            else:
+                del self._index[session_id]
+        for path in paths:
+            self._indexed.pop(path, None)
+            fd = self._readers.pop(path, None)
+            if fd is not None:
+                os.close(fd)
+
+    def _update_index(self):
+        # Records of this process are indexed by the writer, records of other processes are read from
+        # the segment tails
+        self.flush()
+        with self._index_lock:
+            self._scan_segments()
+
+    def _read_record(self, path: str, offset: int) -> list:
+        fd = self._readers.get(path)
+        if fd is None:
+            fd = self._readers[path] = os.open(path, os.O_RDONLY)
+        length, crc = _HEADER.unpack(os.pread(fd, _HEADER.size, offset))
+        payload = os.pread(fd, length, offset + _HEADER.size)
+        if zlib.crc32(payload) != crc:
+            raise ValueError(f"Corrupt session log record at {path}:{offset}")
+        return ujson.loads(payload)
+
+    def restore(self, session_id: str, memory: BaseMemory) -> bool:
+        """Restores memory of the session from its snapshot and the records after it
+
+        Args:
+            session_id (str): Id of the chat session
+            memory (BaseMemory): Memory to restore into
+
+        Returns:
+            bool: Whether the session was found in the log
+        """
+        start = perf_counter()
+        self._update_index()
+
+        snapshot = self._read_snapshot(session_id)
+        covered = 0
+        if snapshot is not None:
+            covered, data = snapshot
+            memory.restore(data)
+
+        with self._index_lock:
+            # Records in the snapshot are not needed anymore
+            tail = [position for position in self._index.get(session_id, []) if position[2] > covered]
+            if tail:
+                self._index[session_id] = tail
+            else:
+                self._index.pop(session_id, None)
+        if snapshot is None and not tail:
+            return False
+
+        sequence = covered
+        entries = []
+        for path, offset, record_sequence in sorted(tail, key=lambda position: position[2]):
+            record = self._read_record(path, offset)
+            entries.append(tuple(record[2:]))
+            sequence = record_sequence
+        memory.replay(entries)
+
+        with self._index_lock:
+            self._memory_sequences[session_id] = sequence
+        with self._condition:
+            self._since_snapshot[session_id] = len(tail)
+            self._restored += 1
+            self._restore_seconds += perf_counter() - start
+        return True
+
+    def _finished_segments(self, segments: List[str]) -> List[str]:
+        """Returns segments no process appends to anymore. Only the last segment of a running process
+        is written
+        """
+        last: Dict[str, str] = {}
+        for path in segments:
+            writer_id = os.path.basename(path).rsplit("-", 1)[0]
+            last[writer_id] = max(last.get(writer_id, path), path)
+
+        finished = []
+        for path in segments:
+            writer_id = os.path.basename(path).rsplit("-", 1)[0]
+            if path != last[writer_id] or self._writer_stopped(writer_id):
+                finished.append(path)
+        return finished
+
+    def _writer_stopped(self, writer_id: str) -> bool:
+        pid = int(writer_id.split("-", 1)[0])
+        if pid == os.getpid():
+            return writer_id != self._writer_id
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def compact(self) -> Dict[str, float]:
+        """Snapshots every session with records in finished segments and deletes these segments.
+        Segments written by running processes are kept
+
+        Returns:
+            Dict[str, float]: Segments and bytes before and after, sessions snapshotted and seconds taken
+        """
+        start = perf_counter()
+        segments = self.segments()
+        size_before = sum(os.path.getsize(path) for path in segments)
+        finished = set(self._finished_segments(segments))
+
+        # Records of other running processes written since the last scan are indexed
+        self._update_index()
+        with self._index_lock:
+            sessions = [
+                session_id for session_id, positions in self._index.items()
+                if any(position[0] in finished for position in positions)
+            ]
+        for session_id in sessions:
+            memory = BaseMemory()
+            self.restore(session_id, memory)
+            with self._index_lock:
+                sequence = self._memory_sequences[session_id]
+            self._write_snapshot(session_id, sequence, memory.dumps())
+
+        with self._index_lock:
+            self._forget_segments(finished)
+        for path in finished:
+            os.remove(path)
+
+        remaining = self.segments()
+        return {
+            "segments_before": len(segments),
+            "segments_after": len(remaining),
+            "bytes_before": size_before,
+            "bytes_after": sum(os.path.getsize(path) for path in remaining),
+            "sessions_snapshotted": len(sessions),
+            "seconds": perf_counter() - start,
+        }
+
+
+def create_session_log() -> Optional[SessionLog]:
+    """Creates session log of config file
+
+    Returns:
+        Optional[SessionLog]: Session log. None if disabled
+    """
+    log_config = config["SESSION_LOG"]
+    if not log_config["enabled"]:
+        return None
+    return SessionLog(log_config["directory"])
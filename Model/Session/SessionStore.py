@@ -0,0 +1,342 @@
+import socket
+import struct
+from threading import Lock
+from time import time
+from typing import BinaryIO, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from Model.Cache.Cache import LRUCache
+from Model.Config.Config import config
+
+
+class SessionStore:
+    """Base class of session stores. A store keeps serialized BaseMemory of every session with a
+    version number, so workers can skip loading a session they already have up to date.
+    """
+
+    # Whether other worker processes see the saved sessions
+    shared = True
+
+    def load(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        """Returns serialized memory of the session
+
+        Args:
+            session_id (str): Id of the chat session
+
+        Returns:
+            Optional[Tuple[int, bytes]]: version, serialized memory. None if session is not stored
+        """
+        raise NotImplementedError
+
+    def version(self, session_id: str) -> Optional[int]:
+        """Returns stored version of the session without loading it
+
+        Args:
+            session_id (str): Id of the chat session
+
+        Returns:
+            Optional[int]: Version. None if session is not stored
+        """
+        raise NotImplementedError
+
+    def save(self, session_id: str, data: bytes) -> int:
+        """Saves serialized memory of the session
+
+        Args:
+            session_id (str): Id of the chat session
+            data (bytes): Serialized memory
+
+        Returns:
+            int: New version of the session
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        """Deletes the session
+
+        Args:
+            session_id (str): Id of the chat session
+        """
+        raise NotImplementedError
+
+    def after_fork(self):
+        """Called in a worker forked from a preloading master. Connections of the parent must
+        not be used by the worker
+        """
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """Session store in the worker process. Sessions are not shared between workers. Least recently
+    saved and idle sessions are dropped, so sessions evicted from the worker do not pile up.
+    """
+
+    shared = False
+
+    def __init__(self, max_sessions: Optional[int] = None, ttl: Optional[float] = None):
+        """Constructor of InMemorySessionStore class
+
+        Args:
+            max_sessions (Optional[int], optional): Maximum number of stored sessions. Defaults to None, unbounded
+            ttl (Optional[float], optional): Seconds a session lives after its last save. Defaults to None, no expiry
+        """
+        self._lock = Lock()
+        self._sessions = LRUCache(max_size=max_sessions, ttl=ttl)
+        # Versions stay increasing after a session is deleted, so a reloaded session is not mistaken
+        # for an older copy
+        self._versions = 0
+
+    def load(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        return self._sessions.get(session_id, touch=False)
+
+    def version(self, session_id: str) -> Optional[int]:
+        stored = self._sessions.get(session_id, touch=False)
+        return stored[0] if stored is not None else None
+
+    def save(self, session_id: str, data: bytes) -> int:
+        with self._lock:
+            self._versions += 1
+            version = self._versions
+            self._sessions.set(session_id, (version, data))
+        return version
+
+    def delete(self, session_id: str):
+        self._sessions.pop(session_id)
+
+    def stats(self) -> Dict[str, float]:
+        """Returns size of the store
+
+        Returns:
+            Dict[str, float]: Stored sessions, bytes of their serialized memories, evictions and expirations
+        """
+        self._sessions.expire()
+        cache_stats = self._sessions.stats()
+        return {
+            "sessions": cache_stats["size"],
+            "bytes": sum(len(data) for _, data in self._sessions.values()),
+            "evictions": cache_stats["evictions"],
+            "expirations": cache_stats["expirations"],
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """Session store in a SQLite database in WAL mode. Shared by the workers of one host"""
+
+    def __init__(self, path: str):
+        """Constructor of SQLiteSessionStore class
+
+        Args:
+            path (str): Database file path
+        """
+        self._path = path
+        self._lock = Lock()
+
+        # SQLite calls block the worker anyway, so one connection guarded by a lock is enough
+        self._connection = self._connect()
+        # Connections opened by the parent before a fork. Kept open, closing them in a worker
+        # would release SQLite file locks of the parent
+        self._inherited_connections = []
+
+    def _connect(self):
+        # Only imported when SQLite store is configured
+        import sqlite3
+
+        connection = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL, updated REAL NOT NULL)"
+        )
+        return connection
+
+    def after_fork(self):
+        self._lock = Lock()
+        self._inherited_connections.append(self._connection)
+        self._connection = self._connect()
+
+    def load(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version, data FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return (row[0], bytes(row[1])) if row is not None else None
+
+    def version(self, session_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def save(self, session_id: str, data: bytes) -> int:
+        with self._lock:
+            # Write lock is taken at BEGIN, so version can not change between two statements
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(
+                    "INSERT INTO sessions (session_id, version, data, updated) VALUES (?, 1, ?, ?) "
+                    "ON CONFLICT(session_id) DO UPDATE SET "
+                    "version = version + 1, data = excluded.data, updated = excluded.updated",
+                    (session_id, data, time()),
+                )
+                row = self._connection.execute(
+                    "SELECT version FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        return row[0]
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+
+class RedisSessionStore(SessionStore):
+    """Session store on a Redis protocol server. Shared by all workers and hosts.
+    Value of a session is an 8 byte big-endian version followed by the serialized memory, so
+    version checks read only 8 bytes. Speaks RESP directly over sockets, which gevent patches.
+    """
+
+    def __init__(self, url: str, **kwargs):
+        """Constructor of RedisSessionStore class
+
+        Args:
+            url (str): Server url. For example; redis://127.0.0.1:6379/0
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                prefix (str): Prefix of session keys. Defaults to "persona:session:"
+                ttl (int): Seconds a session lives after its last save. Defaults to None, no expiry
+                timeout (float): Socket timeout in seconds. Defaults to 5
+        """
+        parsed = urlparse(url)
+        self._host = parsed.hostname or "127.0.0.1"
+        self._port = parsed.port or 6379
+        self._db = int(parsed.path.lstrip("/") or 0)
+        self._password = parsed.password
+        self._prefix = kwargs.get("prefix", "persona:session:")
+        self._ttl = kwargs.get("ttl", None)
+        self._timeout = kwargs.get("timeout", 5.0)
+
+        # Idle connections with their buffered readers
+        self._lock = Lock()
+        self._connections: List[Tuple[socket.socket, BinaryIO]] = []
+
+    def after_fork(self):
+        # Idle connections of the parent are dropped, closing a socket copy does not affect the parent
+        self._lock = Lock()
+        self._connections = []
+
+    def _connect(self) -> Tuple[socket.socket, BinaryIO]:
+        sock = socket.create_connection((self._host, self._port), timeout=self._timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile("rb"))
+        if self._password:
+            self._call(connection, b"AUTH", self._password.encode())
+        if self._db:
+            self._call(connection, b"SELECT", str(self._db).encode())
+        return connection
+
+    def execute(self, *args: bytes):
+        """Runs a command on a pooled connection
+
+        Args:
+            *args (bytes): Command and its arguments
+
+        Returns:
+            Reply of the server
+        """
+        with self._lock:
+            connection = self._connections.pop() if self._connections else None
+        if connection is None:
+            connection = self._connect()
+
+        try:
+            reply = self._call(connection, *args)
+        except Exception:
+            connection[1].close()
+            connection[0].close()
+            raise
+
+        with self._lock:
+            self._connections.append(connection)
+        return reply
+
+    @staticmethod
+    def _call(connection: Tuple[socket.socket, BinaryIO], *args: bytes):
+        sock, reader = connection
+        command = b"*%d\r\n" % len(args) + b"".join(b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in args)
+        sock.sendall(command)
+        return RedisSessionStore._read_reply(reader)
+
+    @staticmethod
+    def _read_reply(stream):
+        line = stream.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest
+        if prefix == b"-":
+            raise RuntimeError(rest.decode())
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = stream.read(length + 2)
+            return data[:-2]
+        if prefix == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [RedisSessionStore._read_reply(stream) for _ in range(length)]
+        raise RuntimeError(f"Unknown Redis reply: {line!r}")
+
+    def _key(self, session_id: str) -> bytes:
+        return (self._prefix + session_id).encode()
+
+    def load(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        value = self.execute(b"GET", self._key(session_id))
+        if value is None:
+            return None
+        return struct.unpack(">Q", value[:8])[0], value[8:]
+
+    def version(self, session_id: str) -> Optional[int]:
+        value = self.execute(b"GETRANGE", self._key(session_id), b"0", b"7")
+        if not value:
+            return None
+        return struct.unpack(">Q", value)[0]
+
+    def save(self, session_id: str, data: bytes) -> int:
+        # Versions only need to differ between saves, so the write stays a single SET
+        version = int(time() * 1e6)
+        command = [b"SET", self._key(session_id), struct.pack(">Q", version) + data]
+        if self._ttl:
+            command += [b"EX", str(self._ttl).encode()]
+        self.execute(*command)
+        return version
+
+    def delete(self, session_id: str):
+        self.execute(b"DEL", self._key(session_id))
+
+
+def create_session_store() -> SessionStore:
+    """Creates session store of config file
+
+    Returns:
+        SessionStore: Session store
+    """
+    store_config = config["SESSION_STORE"]
+    backend = store_config["backend"]
+    if backend == "memory":
+        return InMemorySessionStore(store_config["max_sessions"], store_config["ttl"])
+    if backend == "sqlite":
+        return SQLiteSessionStore(store_config["sqlite_path"])
+    if backend == "redis":
+        return RedisSessionStore(store_config["redis_url"], ttl=store_config["ttl"])
+    raise ValueError(f"Unknown session store backend: {backend}")
@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from threading import Lock
+from typing import Awaitable, Callable, Dict, Hashable, Iterator, Optional, Tuple, TypeVar
+
+from Model.Cache.Cache import LRUCache
+from Model.Config.Config import config
+
+T = TypeVar("T")
+
+
+class IdempotencyKeyError(ValueError):
+    """Idempotency key was used before with another message"""
+
+
+class SessionTurns:
+    """Runs chat turns of a session one at a time and attaches duplicate requests to the turn
+    they repeat. A request with an idempotency key, or the same message of the same session in
+    the same conversation state within the dedupe window, waits for the running turn or gets the
+    result of the finished one instead of calling the LLM again. Only failed turns are run again.
+    A message repeated after the turn changed the conversation is a new turn.
+
+    Turns are ordered per worker. Requests of one session reaching different workers are ordered
+    by the session store versions only.
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor of SessionTurns class
+
+        Args:
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                dedupe_window (float): Seconds a repeated message in the same conversation state is
+            answered with the previous turn. 0 disables. Defaults to config file
+                idempotency_ttl (float): Seconds results of idempotency keys are kept. Defaults to config file
+                max_keys (int): Maximum finished turns kept per kind of key. Defaults to config file
+        """
+        turns_config = config["SESSION_TURNS"]
+        dedupe_window = kwargs.get("dedupe_window", turns_config["dedupe_window"])
+        idempotency_ttl = kwargs.get("idempotency_ttl", turns_config["idempotency_ttl"])
+        max_keys = kwargs.get("max_keys", turns_config["max_keys"])
+
+        self._lock = Lock()
+
+        # Session id -> [lock, requests holding or waiting for it]
+        self._session_locks: Dict[str, list] = {}
+        self._async_session_locks: Dict[str, list] = {}
+
+        # Running turns and results of finished turns. Values are (message digest, result)
+        self._in_flight: Dict[Hashable, Tuple[str, Future]] = {}
+        self._async_in_flight: Dict[Hashable, Tuple[str, asyncio.Future]] = {}
+        self._idempotent = LRUCache(max_size=max_keys, ttl=idempotency_ttl)
+        self._recent = LRUCache(max_size=max_keys, ttl=dedupe_window) if dedupe_window else None
+        # Session id -> turns finished within the dedupe window. Part of message keys, so a message
+        # repeated after a turn changed the conversation is not answered with an old turn
+        self._finished_turns = LRUCache(max_size=max_keys, ttl=dedupe_window) if dedupe_window else None
+
+        # Counters
+        self._turns = 0
+        self._coalesced = 0
+        self._replayed = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Returns turn counters
+
+        Returns:
+            Dict[str, int]: Turns run, requests attached to a running turn, requests answered from a
+            finished turn and requests waiting for their session
+        """
+        with self._lock:
+            waiting = sum(
+                entry[1] - 1 for locks in (self._session_locks, self._async_session_locks) for entry in locks.values()
+            )
+            return {
+                "turns": self._turns,
+                "coalesced": self._coalesced,
+                "replayed": self._replayed,
+                "waiting": waiting,
+            }
+
+    def _key(
+            self, session_id: str, user_input: str, idempotency_key: Optional[str]
+    ) -> Tuple[Optional[Hashable], Optional[LRUCache], str]:
+        digest = hashlib.sha256(user_input.encode()).hexdigest()
+        if idempotency_key:
+            return ("key", session_id, idempotency_key), self._idempotent, digest
+        if self._recent is not None:
+            finished_turns = self._finished_turns.get(session_id, 0, touch=False)
+            return ("message", session_id, finished_turns, digest), self._recent, digest
+        return None, None, digest
+
+    def _turn_finished(self, session_id: str):
+        if self._finished_turns is None:
+            return
+        with self._lock:
+            self._finished_turns.set(session_id, self._finished_turns.get(session_id, 0, touch=False) + 1)
+
+    @staticmethod
+    def _check(key: Hashable, digest: str, seen_digest: str):
+        if seen_digest != digest:
+            raise IdempotencyKeyError(f"Idempotency key {key[2]} was used with another message")
+
+    @contextmanager
+    def session_lock(self, session_id: str) -> Iterator[None]:
+        """Holds the turn lock of the session. A turn of the session ends when it is released
+
+        Args:
+            session_id (str): Id of the chat session
+        """
+        with self._lock:
+            entry = self._session_locks.setdefault(session_id, [Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                try:
+                    yield
+                finally:
+                    self._turn_finished(session_id)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._session_locks[session_id]
+
+    @asynccontextmanager
+    async def asession_lock(self, session_id: str):
+        """Async version of session_lock
+
+        Args:
+            session_id (str): Id of the chat session
+        """
+        with self._lock:
+            entry = self._async_session_locks.setdefault(session_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+        try:
+            async with entry[0]:
+                try:
+                    yield
+                finally:
+                    self._turn_finished(session_id)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._async_session_locks[session_id]
+
+    def run(
+            self, session_id: str, user_input: str, turn: Callable[[], T], idempotency_key: Optional[str] = None
+    ) -> T:
+        """Runs a turn of the session, or returns the result of the turn it repeats
+
+        Args:
+            session_id (str): Id of the chat session
+            user_input (str): Message of the user
+            turn (Callable[[], T]): Runs the turn
+            idempotency_key (Optional[str], optional): Key of the request given by the client. Defaults to
+        None, repeated messages are found by content and finished turns of the session within the
+        dedupe window
+
+        Raises:
+            IdempotencyKeyError: Idempotency key was used before with another message
+
+        Returns:
+            T: Result of the turn
+        """
+        key, finished, digest = self._key(session_id, user_input, idempotency_key)
+        if key is None:
+            with self.session_lock(session_id):
+                self._turns += 1
+                return turn()
+
+        with self._lock:
+            done = finished.get(key, touch=False)
+            if done is not None:
+                self._check(key, digest, done[0])
+                self._replayed += 1
+                return done[1]
+
+            running = self._in_flight.get(key)
+            if running is not None:
+                self._check(key, digest, running[0])
+                self._coalesced += 1
+            else:
+                future = Future()
+                self._in_flight[key] = (digest, future)
+
+        # Same request is already running, its result or error is shared
+        if running is not None:
+            return running[1].result()
+
+        try:
+            with self.session_lock(session_id):
+                self._turns += 1
+                result = turn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            # Result is kept before the turn leaves in-flight turns, so no request runs it again
+            finished.set(key, (digest, result))
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    async def arun(
+            self,
+            session_id: str,
+            user_input: str,
+            turn: Callable[[], Awaitable[T]],
+            idempotency_key: Optional[str] = None,
+    ) -> T:
+        """Async version of run"""
+        key, finished, digest = self._key(session_id, user_input, idempotency_key)
+        if key is None:
+            async with self.asession_lock(session_id):
+                self._turns += 1
+                return await turn()
+
+        with self._lock:
+            done = finished.get(key, touch=False)
+            if done is not None:
+                self._check(key, digest, done[0])
+                self._replayed += 1
+                return done[1]
+
+            running = self._async_in_flight.get(key)
+            if running is not None:
+                self._check(key, digest, running[0])
+                self._coalesced += 1
+            else:
+                future = asyncio.get_running_loop().create_future()
+                self._async_in_flight[key] = (digest, future)
+
+        # Shielded, so a cancelled duplicate does not cancel the running turn
+        if running is not None:
+            return await asyncio.shield(running[1])
+
+        try:
+            async with self.asession_lock(session_id):
+                self._turns += 1
+                result = await turn()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Marked as retrieved, the error is raised to the caller below
+                future.exception()
+            raise
+        else:
+            finished.set(key, (digest, result))
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._async_in_flight.pop(key, None)
+
+
+# Turns of the sessions served by this worker
+session_turns = SessionTurns()
@@ -0,0 +1,80 @@
+"""Compacts the session log and measures restore latency of its sessions.
+
+Snapshots every session with records in finished segments and deletes these segments. Restore
+latency of a sample of sessions is measured before and after. Safe to run while workers write
+the log, the segments they append to are kept.
+
+Usage:
+    python -m Model.Session.compact_log [--directory session_log] [--sample 200] [--dry-run]
+"""
+import argparse
+from random import Random
+from time import perf_counter
+from typing import List
+
+from Model.Config.Config import config
+from Model.Memory.Memory import BaseMemory
+from Model.Session.SessionLog import SessionLog
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def measure_restore(directory: str, session_ids: List[str]) -> List[float]:
+    """Restores the sessions from a new SessionLog, as a restarted worker does
+
+    Args:
+        directory (str): Log directory
+        session_ids (List[str]): Sessions to restore
+
+    Returns:
+        List[float]: Restore seconds per session. The first one includes building the index
+    """
+    session_log = SessionLog(directory)
+    latencies = []
+    for session_id in session_ids:
+        start = perf_counter()
+        session_log.restore(session_id, BaseMemory())
+        latencies.append(perf_counter() - start)
+    return latencies
+
+
+def report(name: str, latencies: List[float]):
+    print(
+        f"{name}: first {latencies[0] * 1e3:.2f} ms, p50 {percentile(latencies[1:], 0.5) * 1e3:.3f} ms, "
+        f"p99 {percentile(latencies[1:], 0.99) * 1e3:.3f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--directory", default=config["SESSION_LOG"]["directory"], help="Session log directory")
+    parser.add_argument("--sample", type=int, default=200, help="Sessions restored to measure latency")
+    parser.add_argument("--dry-run", action="store_true", help="Only measure restore latency")
+    args = parser.parse_args()
+
+    session_ids = SessionLog(args.directory).sessions()
+    print(f"sessions with log records: {len(session_ids)}")
+    if not session_ids:
+        return
+    sample = Random(0).sample(session_ids, min(args.sample, len(session_ids)))
+
+    report("restore before", measure_restore(args.directory, sample))
+    if args.dry_run:
+        return
+
+    result = SessionLog(args.directory).compact()
+    print(
+        f"segments: {result['segments_before']} -> {result['segments_after']}, "
+        f"bytes: {result['bytes_before']} -> {result['bytes_after']}, "
+        f"sessions snapshotted: {result['sessions_snapshotted']}, seconds: {result['seconds']:.2f}"
+    )
+    report("restore after", measure_restore(args.directory, sample))
+
+
+if __name__ == "__main__":
+    main()
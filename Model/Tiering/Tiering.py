@@ -0,0 +1,197 @@
+import re
+from collections import deque
+from dataclasses import dataclass
+from threading import Lock
+from typing import Deque, Dict, List, Optional, Tuple
+
+from Model.Config.Config import config
+from Model.Memory.Memory import BaseMemory
+
+_WORD_PATTERN = re.compile(r"[a-z0-9']+")
+_NUMBER_PATTERN = re.compile(r"\d")
+
+# Whole messages which need no reasoning. Acknowledgements, greetings and goodbyes
+_TRIVIAL_PATTERN = re.compile(
+    r"^(ok(ay)?|k|thanks?( a lot| so much)?|thank you( so much| very much)?|thx|ty|cool|great|nice|perfect|"
+    r"got it|sounds good|alright|sure|yes|yeah|yep|no|nope|bye|goodbye|see you|hi|hello|hey|"
+    r"good (morning|evening|night))( (thanks|thank you))?[\s!.,:)]*$"
+)
+
+_QUESTION_WORDS = {
+    "what", "why", "how", "which", "when", "where", "who", "should", "can", "could", "would", "is", "are",
+    "do", "does", "will", "recommend", "explain",
+}
+
+# Words of questions where a wrong answer is costly or needs nutrition knowledge
+_DOMAIN_WORDS = {
+    "calorie", "calories", "protein", "proteins", "carb", "carbs", "carbohydrate", "carbohydrates", "fat", "fats",
+    "macro", "macros", "vitamin", "vitamins", "mineral", "minerals", "iron", "sodium", "fiber", "sugar",
+    "cholesterol", "diabetes", "diabetic", "insulin", "blood", "pressure", "allergy", "allergic", "intolerance",
+    "intolerant", "gluten", "lactose", "pregnant", "pregnancy", "breastfeeding", "kidney", "liver", "heart",
+    "medication", "supplement", "supplements", "deficiency", "fasting", "keto", "vegan", "vegetarian", "plan",
+    "meal", "meals", "bmi", "weight", "muscle", "deficit",
+}
+
+
+def score_turn(text: str, memory: Optional[BaseMemory] = None) -> float:
+    """Scores complexity of a turn locally, without a network call. Long messages, questions,
+    nutrition terms and numbers raise the score. Acknowledgements score 0 unless they answer a
+    question of the assistant, which needs the conversation to continue.
+
+    Args:
+        text (str): User input
+        memory (Optional[BaseMemory], optional): Memory of the conversation. User input may already be
+    its last memory. Defaults to None.
+
+    Returns:
+        float: Score between 0 and 1
+    """
+    text = (text or "").strip().lower()
+
+    # Assistant asked something in its last message, so short answers continue a topic
+    answers_question = False
+    conversation_length = 0
+    if isinstance(memory, BaseMemory):
+        conversation_length = memory.number_of_memories
+        for memory_variable in reversed(memory.memory_array[-3:]):
+            if memory_variable.agent_name:
+                answers_question = "?" in memory_variable.message
+                break
+
+    if _TRIVIAL_PATTERN.match(text):
+        return 0.35 if answers_question else 0.0
+
+    words = _WORD_PATTERN.findall(text)
+    score = 0.35 * min(len(words) / 40, 1.0)
+    if "?" in text or (words and words[0] in _QUESTION_WORDS):
+        score += 0.25
+    score += 0.25 * min(sum(word in _DOMAIN_WORDS for word in words) / 3, 1.0)
+    if _NUMBER_PATTERN.search(text):
+        score += 0.1
+    score += 0.05 * min(conversation_length / 40, 1.0)
+    if answers_question:
+        score = max(score, 0.35)
+    return min(score, 1.0)
+
+
+@dataclass
+class ModelTier:
+    """Model of a chain for turns scoring up to max_score"""
+    name: str
+    model_name: str
+    # Highest score served by the tier. None serves every score
+    max_score: Optional[float] = None
+    # Maximum tokens of the answer. None keeps the chain setting
+    max_output_tokens: Optional[int] = None
+
+
+class TierStats:
+    """Turns, latency and tokens of a tier"""
+
+    def __init__(self, latency_window: int):
+        self.turns = 0
+        self.score_sum = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # Recent latencies in seconds
+        self.latencies: Deque[float] = deque(maxlen=latency_window)
+
+    def as_dict(self) -> Dict[str, float]:
+        latencies = sorted(self.latencies)
+
+        def quantile(q: float) -> float:
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+
+        return {
+            "turns": self.turns,
+            "average_score": self.score_sum / self.turns if self.turns else 0.0,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency_p50": quantile(0.5),
+            "latency_p95": quantile(0.95),
+        }
+
+
+class ModelTiering:
+    """Chooses the model of a chain per turn from a ladder of tiers. Turns are scored with
+    score_turn and get the first tier whose max_score is at least their score, so trivial turns
+    go to the fast model and hard ones keep the big model.
+    """
+
+    def __init__(self, tiering_config: dict):
+        """Constructor of ModelTiering class
+
+        Args:
+            tiering_config (dict): MODEL_TIERING section of config file
+
+        Raises:
+            ValueError: Last tier of a ladder does not serve every score
+        """
+        self._enabled = tiering_config["enabled"]
+        self._latency_window = tiering_config["latency_window"]
+        self._ladders: Dict[str, List[ModelTier]] = {}
+        for chain_name, tiers in tiering_config["chains"].items():
+            ladder = [ModelTier(**tier) for tier in tiers]
+            if not ladder or ladder[-1].max_score is not None:
+                raise ValueError(f"Last model tier of {chain_name} must have no max_score")
+            self._ladders[chain_name] = ladder
+
+        self._lock = Lock()
+        self._stats: Dict[Tuple[str, str], TierStats] = {}
+
+    def enabled(self, chain_name: str) -> bool:
+        return self._enabled and chain_name in self._ladders
+
+    def select(self, chain_name: str, text: str, memory: Optional[BaseMemory] = None) -> Tuple[ModelTier, float]:
+        """Returns tier of the turn
+
+        Args:
+            chain_name (str): Name of the chain
+            text (str): User input
+            memory (Optional[BaseMemory], optional): Memory of the conversation. Defaults to None.
+
+        Returns:
+            (ModelTier, float): Chosen tier, score of the turn
+        """
+        score = score_turn(text, memory)
+        for tier in self._ladders[chain_name]:
+            if tier.max_score is None or score <= tier.max_score:
+                return tier, score
+
+    def record(
+            self, chain_name: str, tier: ModelTier, score: float, seconds: float, prompt_tokens: int,
+            completion_tokens: int,
+    ):
+        """Records a turn answered by a tier
+
+        Args:
+            chain_name (str): Name of the chain
+            tier (ModelTier): Tier answered the turn
+            score (float): Score of the turn
+            seconds (float): Latency of the chain call
+            prompt_tokens (int): Tokens sent
+            completion_tokens (int): Tokens received
+        """
+        with self._lock:
+            stats = self._stats.get((chain_name, tier.name))
+            if stats is None:
+                stats = self._stats[(chain_name, tier.name)] = TierStats(self._latency_window)
+            stats.turns += 1
+            stats.score_sum += score
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.latencies.append(seconds)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns stats per tier
+
+        Returns:
+            Dict[str, Dict[str, float]]: Turns, average score, tokens and p50 and p95 latency in seconds
+            per "<chain>.<tier>"
+        """
+        with self._lock:
+            return {f"{chain_name}.{tier_name}": stats.as_dict() for (chain_name, tier_name), stats in self._stats.items()}
+
+
+# Model tiers of the process
+model_tiering = ModelTiering(config["MODEL_TIERING"])
@@ -0,0 +1,172 @@
+import os
+import re
+from collections import defaultdict
+from functools import lru_cache
+from threading import Lock
+from time import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import ujson
+
+from Model.Config.Config import config
+
+if TYPE_CHECKING:
+    from langchain.schema import BaseMessage
+
+# Fallback tokenizer. Words and runs of punctuation, close to BPE counts of English text
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]+")
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(encoding_name: str):
+    # tiktoken is imported on the first count. Preloading masters load it once, see load_tokenizer
+    try:
+        import tiktoken
+    except ImportError:
+        print("tiktoken is not installed, tokens are approximated")
+        return None
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        # For example, encoding files can not be downloaded. Counting must not fail the turns, the
+        # process keeps the approximation
+        print(f"Tokenizer {encoding_name} could not be loaded, tokens are approximated: {e}")
+        return None
+
+
+def load_tokenizer(encoding_name: str = "cl100k_base"):
+    """Loads the tokenizer before the first count. Called by preloading masters, so forked
+    workers share the encoding tables
+
+    Args:
+        encoding_name (str, optional): tiktoken encoding. Defaults to "cl100k_base".
+    """
+    _get_encoding(encoding_name)
+
+
+def count_tokens(text: str, encoding_name: str = "cl100k_base") -> int:
+    """Counts tokens of a text locally. Uses tiktoken when it is installed, otherwise an
+    approximation of it.
+
+    Args:
+        text (str): Text to count
+        encoding_name (str, optional): tiktoken encoding. Defaults to "cl100k_base".
+
+    Returns:
+        int: Number of tokens
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding(encoding_name)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+# Chat format overhead of OpenAI models. Tokens per message and tokens priming the reply
+MESSAGE_OVERHEAD_TOKENS = 3
+REPLY_OVERHEAD_TOKENS = 3
+
+
+def count_message_tokens(messages: List["BaseMessage"], encoding_name: str = "cl100k_base") -> int:
+    """Counts prompt tokens of chat messages, including chat format overhead
+
+    Args:
+        messages (List[BaseMessage]): Formatted prompt messages
+        encoding_name (str, optional): tiktoken encoding. Defaults to "cl100k_base".
+
+    Returns:
+        int: Number of prompt tokens
+    """
+    return REPLY_OVERHEAD_TOKENS + sum(
+        MESSAGE_OVERHEAD_TOKENS + count_tokens(message.content, encoding_name) for message in messages
+    )
+
+
+class TokenLedger:
+    """Prompt and completion tokens of chain calls. Keeps totals per chain and optionally
+    appends every call to a JSON lines file for capacity planning.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """Constructor of TokenLedger class
+
+        Args:
+            path (Optional[str], optional): JSON lines file of calls. Logging is disabled if None
+        """
+        self._path = path
+        self._lock = Lock()
+        # JSON lines file, opened on the first call. Line buffered, so every call is written at once
+        self._file = None
+
+        # Totals per chain name
+        self._totals: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "max_prompt_tokens": 0, "over_budget": 0}
+        )
+
+    def record(
+            self,
+            chain_name: str,
+            model_name: str,
+            prompt_tokens: int,
+            completion_tokens: int,
+            max_input_tokens: Optional[int] = None,
+    ):
+        """Records tokens of a chain call
+
+        Args:
+            chain_name (str): Name of the chain
+            model_name (str): Name of the model
+            prompt_tokens (int): Tokens sent
+            completion_tokens (int): Tokens received
+            max_input_tokens (Optional[int], optional): Input budget of the chain. Defaults to None.
+        """
+        over_budget = max_input_tokens is not None and prompt_tokens > max_input_tokens
+        with self._lock:
+            totals = self._totals[chain_name]
+            totals["calls"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["max_prompt_tokens"] = max(totals["max_prompt_tokens"], prompt_tokens)
+            totals["over_budget"] += over_budget
+
+            if self._path:
+                line = ujson.dumps({
+                    "chain_name": chain_name,
+                    "model_name": model_name,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "over_budget": over_budget,
+                    "timestamp": time(),
+                })
+                if self._file is None:
+                    self._file = open(self._path, "a", buffering=1)
+                self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def after_fork(self):
+        """Called in a worker forked from a preloading master. The worker opens the file again, so
+        it does not write through the handle of the parent
+        """
+        self._lock = Lock()
+        self._file = None
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns token totals per chain
+
+        Returns:
+            Dict[str, Dict[str, int]]: Calls, prompt tokens, completion tokens, largest prompt and
+            calls over input budget per chain
+        """
+        with self._lock:
+            return {chain_name: dict(totals) for chain_name, totals in self._totals.items()}
+
+
+# Token ledger of the process
+token_ledger = TokenLedger(config["TOKEN_ACCOUNTING"]["log_path"])
+os.register_at_fork(after_in_child=token_ledger.after_fork)
@@ -1,11 +1,158 @@
-from flask import Flask, request, jsonify
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from threading import Event
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import ujson
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from Model.PersonaChatbot.PersonaChatbot import PersonaChatbot
+from Model.CallPolicy.CallPolicy import CallPolicyError, DeadlineExceededError, turn_deadline
+from Model.Chain.Chain import compile_all_chains
+from Model.Config.Config import config
+from Model.Metrics.Collectors import register_stats_collectors
+from Model.Metrics.Metrics import metrics
+from Model.Session.Session import get_persona_chatbot, save_persona_chatbot
+from Model.Session.SessionTurns import IdempotencyKeyError, session_turns
+from Model.Tokens.Tokens import load_tokenizer
 
 app = Flask(__name__)
 CORS(app)
 
-persona_chatbots = {}  # Dictionary to store PersonaChatbot instances for each session
+# Prompt templates, parsers and the tokenizer are built once per worker. With gunicorn.conf.py
+# preloading, once in the master and shared with the forked workers
+compile_all_chains()
+load_tokenizer()
+
+# Pool, cache, router, session and token counters are exported on /metrics
+register_stats_collectors()
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    # Server-sent event frame
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {ujson.dumps(data)}\n\n"
+
+
+def policy_error_status(error: CallPolicyError) -> int:
+    # Passed deadlines are gateway timeouts, failing providers make the service unavailable
+    return 504 if isinstance(error, DeadlineExceededError) else 503
+
+
+@app.before_request
+def start_request_timing():
+    g.request_timing = metrics.start_request()
+
+
+@app.after_request
+def add_server_timing(response):
+    # Streamed responses only report the stages before the stream starts
+    token = g.pop("request_timing", None)
+    if token is not None:
+        server_timing = metrics.end_request(token)
+        if config["METRICS"]["server_timing"] and server_timing:
+            response.headers["Server-Timing"] = server_timing
+    return response
+
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    # Answers without touching sessions or the LLM. pid tells which worker answered
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def chat_turn(session_id: str, user_input: str, idempotency_key: Optional[str] = None) -> Tuple[str, str]:
+    """Answers a message of a session and saves the session. Turns of a session run one at a
+    time, repeated requests get the answer of the turn they repeat. LLM calls of the turn share
+    the turn deadline of config file
+
+    Args:
+        session_id (str): Id of the chat session
+        user_input (str): Message of the user
+        idempotency_key (Optional[str], optional): Key of the request given by the client. Defaults to None
+
+    Raises:
+        IdempotencyKeyError: Idempotency key was used before with another message
+
+    Returns:
+        (str, str): agent name, answer
+    """
+    def turn() -> Tuple[str, str]:
+        persona_chatbot = get_persona_chatbot(session_id)
+
+        # Set the user input for the chat session
+        persona_chatbot.user_input = user_input
+
+        # Choose the next agent for the session and get response from it
+        with turn_deadline():
+            agent_name, answer = persona_chatbot.run_next_agent()
+        save_persona_chatbot(session_id)
+
+        return agent_name, answer
+
+    return session_turns.run(session_id, user_input, turn, idempotency_key=idempotency_key)
+
+
+def run_batch(items: List[dict]) -> Iterator[dict]:
+    """Answers messages of many sessions. Sessions run concurrently up to the concurrency cap of
+    config file, messages of the same session run in their batch order. Failed items return an
+    error without failing the others.
+
+    Args:
+        items (List[dict]): Items with session_id, message and optional idempotency_key
+
+    Yields:
+        dict: Result of an item as soon as it finishes. Has index of the item in the batch
+    """
+    # Items grouped by session in batch order
+    sessions: Dict[str, List[Tuple[int, str, Optional[str]]]] = {}
+    for index, item in enumerate(items):
+        session_id = item.get("session_id") if isinstance(item, dict) else None
+        user_input = item.get("message") if isinstance(item, dict) else None
+        if not isinstance(session_id, str) or not session_id or not isinstance(user_input, str) or not user_input:
+            yield {"index": index, "session_id": session_id, "error": "session_id and message parameters are required."}
+            continue
+        sessions.setdefault(session_id, []).append((index, user_input, item.get("idempotency_key")))
+
+    if not sessions:
+        return
+
+    results = queue.Queue()
+    cancelled = Event()
+
+    def run_session(session_id: str, entries: List[Tuple[int, str, Optional[str]]]):
+        for index, user_input, idempotency_key in entries:
+            if cancelled.is_set():
+                return
+            try:
+                agent_name, answer = chat_turn(session_id, user_input, idempotency_key)
+                results.put({"index": index, "session_id": session_id, "agent_name": agent_name, "response": answer})
+            except CallPolicyError as e:
+                print(f"LLM call given up: {str(e)}")
+                results.put({"index": index, "session_id": session_id, "error": f"LLM unavailable: {str(e)}"})
+            except Exception as e:
+                print(f"Error occurred: {str(e)}")
+                results.put({"index": index, "session_id": session_id, "error": f"Internal server error: {str(e)}"})
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(config["BATCH_CHAT"]["concurrency"], len(sessions)), thread_name_prefix="batch-chat"
+    )
+    try:
+        for session_id, entries in sessions.items():
+            executor.submit(run_session, session_id, entries)
+        for _ in range(sum(len(entries) for entries in sessions.values())):
+            yield results.get()
+    finally:
+        # Client left before the batch finished. Items not started yet are skipped
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
 
 @app.route('/api/chat', methods=['POST'])
 def fitness_chat():
@@ -18,28 +165,113 @@ def fitness_chat():
         if not session_id or not user_input:
             return jsonify({"error": "session_id and message parameters are required."}), 400
 
-        # Create or retrieve PersonaChatbot instance for the session
-        if session_id not in persona_chatbots:
-            persona_chatbots[session_id] = PersonaChatbot(f"Healty Diet Assistant")
+        # Clients retrying the same request send the same key, in the body or as a header
+        idempotency_key = request_json.get('idempotency_key') or request.headers.get('Idempotency-Key')
+        _, answer = chat_turn(session_id, user_input, idempotency_key)
 
-        persona_chatbot = persona_chatbots[session_id]
+        response = jsonify({"response": answer})
+        response.headers.add('Access-Control-Allow-Origin', '*')
 
-        # Set the user input for the chat session
-        persona_chatbot.user_input = user_input
+        return response, 200
+    except IdempotencyKeyError as e:
+        return jsonify({"error": str(e)}), 422
+    except CallPolicyError as e:
+        print(f"LLM call given up: {str(e)}")
+        return jsonify({"error": f"LLM unavailable: {str(e)}"}), policy_error_status(e)
+    except Exception as e:
+        print(f"Error occurred: {str(e)}")
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
-        # Choose the next agent for the session
-        _, agent_name = persona_chatbot.choose_next_agent()
 
-        # Get response from the chosen agent
-        answer = persona_chatbot.run_agent_by_name(agent_name=agent_name)
+@app.route('/api/chat/batch', methods=['POST'])
+def fitness_chat_batch():
+    request_json = request.get_json(silent=True)
+    items = request_json.get("items") if isinstance(request_json, dict) else None
 
-        response = jsonify({"response": answer})
-        response.headers.add('Access-Control-Allow-Origin', '*')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items parameter is required."}), 400
+    if len(items) > config["BATCH_CHAT"]["max_items"]:
+        return jsonify({"error": f"Batch can have at most {config['BATCH_CHAT']['max_items']} items."}), 400
 
-        return response, 200
+    # NDJSON streams results as they finish, otherwise all results are returned in batch order
+    if request_json.get("ndjson") or "application/x-ndjson" in request.headers.get("Accept", ""):
+        def generate():
+            for result in run_batch(items):
+                yield ujson.dumps(result) + "\n"
+
+        response = Response(generate(), mimetype="application/x-ndjson")
+        response.headers["X-Accel-Buffering"] = "no"
+    else:
+        results = sorted(run_batch(items), key=lambda result: result["index"])
+        response = jsonify({"results": results})
+    response.headers.add('Access-Control-Allow-Origin', '*')
+
+    return response
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+def fitness_chat_stream():
+    try:
+        request_json = request.get_json()
+
+        session_id = request_json.get('session_id')
+        user_input = request_json.get('message')
+
+        if not session_id or not user_input:
+            return jsonify({"error": "session_id and message parameters are required."}), 400
     except Exception as e:
         print(f"Error occurred: {str(e)}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+    # Session lock is held until the stream ends. Streams are not coalesced, their parts can
+    # not be shared with a repeated request
+    session_lock = ExitStack()
+    session_lock.enter_context(session_turns.session_lock(session_id))
+    try:
+        persona_chatbot = get_persona_chatbot(session_id)
+
+        # Set the user input for the chat session
+        persona_chatbot.user_input = user_input
+
+        # Choose the next agent before the stream starts, so routing errors still return 500
+        with turn_deadline():
+            _, agent_name = persona_chatbot.choose_next_agent()
+    except CallPolicyError as e:
+        session_lock.close()
+        print(f"LLM call given up: {str(e)}")
+        return jsonify({"error": f"LLM unavailable: {str(e)}"}), policy_error_status(e)
+    except Exception as e:
+        session_lock.close()
+        print(f"Error occurred: {str(e)}")
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
+    def generate():
+        # Answer is added to memory by the chatbot when this generator finishes or is closed
+        parts = []
+        tokens = persona_chatbot.stream_agent_by_name(agent_name=agent_name)
+        try:
+            for token in tokens:
+                parts.append(token)
+                yield sse_event({"token": token})
+            # Done event has the answer as stored in memory
+            yield sse_event({"agent_name": agent_name, "response": "".join(parts).strip()}, event="done")
+        except Exception as e:
+            print(f"Error occurred: {str(e)}")
+            yield sse_event({"error": f"Internal server error: {str(e)}"}, event="error")
+        finally:
+            tokens.close()
+            save_persona_chatbot(session_id)
+            session_lock.close()
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    # Generators closed before their first part do not run their finally block
+    response.call_on_close(session_lock.close)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers.add('Access-Control-Allow-Origin', '*')
+
+    return response
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0")
\ No newline at end of file
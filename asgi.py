@@ -0,0 +1,153 @@
+"""ASGI entry point serving the same /api/chat contract as app.py with the asyncio pipeline.
+A single worker keeps hundreds of conversations in flight while they wait for the LLM.
+
+Run with:
+    uvicorn asgi:app --host 127.0.0.1 --port 8083
+"""
+import asyncio
+import os
+from typing import List, Optional, Tuple
+
+import ujson
+
+from Model.CallPolicy.CallPolicy import CallPolicyError, DeadlineExceededError, turn_deadline
+from Model.Chain.Chain import compile_all_chains
+from Model.Config.Config import config
+from Model.Metrics.Collectors import register_stats_collectors
+from Model.Metrics.Metrics import metrics
+from Model.Session.Session import get_persona_chatbot, save_persona_chatbot
+from Model.Session.SessionTurns import IdempotencyKeyError, session_turns
+from Model.Tokens.Tokens import load_tokenizer
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-allow-methods", b"POST, OPTIONS"),
+]
+
+
+async def read_body(receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+def server_timing_headers(token) -> List[Tuple[bytes, bytes]]:
+    server_timing = metrics.end_request(token)
+    if not config["METRICS"]["server_timing"] or not server_timing:
+        return []
+    return [(b"server-timing", server_timing.encode())]
+
+
+async def send_response(send, status: int, payload=None, headers: List[Tuple[bytes, bytes]] = None):
+    body = ujson.dumps(payload).encode() if payload is not None else b""
+    response_headers = [(b"content-type", b"application/json"), *CORS_HEADERS, *(headers or [])]
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+def header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope["headers"]:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def fitness_chat(scope, receive, send):
+    token = metrics.start_request()
+    try:
+        try:
+            request_json = ujson.loads(await read_body(receive))
+        except ValueError:
+            request_json = None
+
+        if not isinstance(request_json, dict):
+            return await send_response(send, 400, {"error": "Request body must be a JSON object."})
+
+        session_id = request_json.get('session_id')
+        user_input = request_json.get('message')
+
+        if not session_id or not user_input:
+            return await send_response(send, 400, {"error": "session_id and message parameters are required."})
+
+        async def turn() -> Tuple[str, str]:
+            # Session store calls may block, they run in a thread
+            persona_chatbot = await asyncio.to_thread(get_persona_chatbot, session_id)
+
+            # Set the user input for the chat session
+            persona_chatbot.user_input = user_input
+
+            # Choose the next agent for the session and get response from it within the turn deadline
+            with turn_deadline():
+                agent_name, answer = await persona_chatbot.arun_next_agent()
+            await asyncio.to_thread(save_persona_chatbot, session_id)
+            return agent_name, answer
+
+        # Turns of a session run one at a time, repeated requests get the answer of the turn they repeat
+        idempotency_key = request_json.get('idempotency_key') or header(scope, b"idempotency-key")
+        _, answer = await session_turns.arun(session_id, user_input, turn, idempotency_key=idempotency_key)
+
+        return await send_response(send, 200, {"response": answer}, headers=server_timing_headers(token))
+    except IdempotencyKeyError as e:
+        return await send_response(send, 422, {"error": str(e)}, headers=server_timing_headers(token))
+    except CallPolicyError as e:
+        print(f"LLM call given up: {str(e)}")
+        # Passed deadlines are gateway timeouts, failing providers make the service unavailable
+        return await send_response(
+            send,
+            504 if isinstance(e, DeadlineExceededError) else 503,
+            {"error": f"LLM unavailable: {str(e)}"},
+            headers=server_timing_headers(token),
+        )
+    except Exception as e:
+        print(f"Error occurred: {str(e)}")
+        return await send_response(
+            send, 500, {"error": f"Internal server error: {str(e)}"}, headers=server_timing_headers(token)
+        )
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Prompt templates, parsers and the tokenizer are built once per worker
+            compile_all_chains()
+            load_tokenizer()
+            register_stats_collectors()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    method = scope["method"]
+    path = scope["path"]
+
+    if method == "OPTIONS":
+        return await send_response(send, 204)
+    if path == "/api/health":
+        return await send_response(send, 200, {"status": "ok", "pid": os.getpid()})
+    if path == "/metrics":
+        body = metrics.render().encode()
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/plain; version=0.0.4")],
+        })
+        return await send({"type": "http.response.body", "body": body})
+    if path == "/api/chat":
+        if method != "POST":
+            return await send_response(send, 405, {"error": "Method not allowed."})
+        return await fitness_chat(scope, receive, send)
+
+    return await send_response(send, 404, {"error": "Not found."})
@@ -0,0 +1,59 @@
+"""Transcript rendering cost per turn for sessions with 10, 100 and 1000 turns.
+
+"rebuild" joins the whole transcript on every access like the old BaseMemory.__str__.
+"incremental" uses the append-only buffer of BaseMemory. Every turn appends a user and an
+AI message and renders the transcript twice (GuidanceChain and ConversationChain), plus a
+last-1000-token tail.
+
+Usage:
+    python -m benchmarks.bench_memory_render [--sizes 10 100 1000]
+"""
+import argparse
+from time import perf_counter
+
+from Model.Memory.Memory import BaseMemory, MEMORY_SEPARATOR
+
+USER_MESSAGE = "What should I eat for breakfast if I want more protein but no eggs?"
+AI_MESSAGE = (
+    "Greek yogurt with berries and nuts, cottage cheese on whole grain toast or a tofu scramble "
+    "are great choices. And don't forget a glass of water!"
+)
+
+
+def rebuild(memory: BaseMemory) -> str:
+    # Old BaseMemory.__str__
+    return MEMORY_SEPARATOR.join(
+        [f"{item.by}: {item.message}\n" for item in memory.memory_array]
+    ) + MEMORY_SEPARATOR
+
+
+def run_session(turns: int, mode: str) -> float:
+    memory = BaseMemory()
+    start = perf_counter()
+    for _ in range(turns):
+        memory.append(by="User", message=USER_MESSAGE)
+        memory.append(by="Healty Diet Assistant", message=AI_MESSAGE, agent_name="ConversationAgent")
+        if mode == "rebuild":
+            rebuild(memory)
+            rebuild(memory)
+        else:
+            str(memory)
+            str(memory)
+            memory.render(max_tokens=1000)
+    return (perf_counter() - start) / turns * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    print(f"{'turns':>8}{'rebuild us/turn':>18}{'incremental us/turn':>22}{'speedup':>10}")
+    for turns in args.sizes:
+        rebuild_time = run_session(turns, "rebuild")
+        incremental_time = run_session(turns, "incremental")
+        print(f"{turns:>8}{rebuild_time:>18.1f}{incremental_time:>22.1f}{rebuild_time / incremental_time:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
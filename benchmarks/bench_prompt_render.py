@@ -0,0 +1,93 @@
+"""Prompt render time per turn, before and after compiled chains.
+
+"before" rebuilds prompt templates and output parser for every chain call like the old
+BaseChain.runChain did. "after" formats the cached compiled prompt only.
+
+Usage:
+    python -m benchmarks.bench_prompt_render [--turns 2000]
+"""
+import argparse
+from time import perf_counter
+
+from langchain.output_parsers import PydanticOutputParser
+from langchain.prompts.chat import (
+    ChatPromptTemplate,
+    SystemMessagePromptTemplate,
+    HumanMessagePromptTemplate,
+)
+
+from Model.Chain.Chain import compile_chain
+from Model.Config.Config import config
+from Model.Memory.Memory import BaseMemory
+from Model.Parsers.Parsers import GuidanceChainParser
+from Model.Persona.Persona import Persona
+
+
+def build_prompt(chain_name: str) -> ChatPromptTemplate:
+    # Per-request prompt construction of the old code path
+    chain_config = config["chains"][chain_name]
+    messages = [
+        SystemMessagePromptTemplate.from_template(
+            chain_config["prompt_template"]["system_prompt_template"]
+        ),
+        HumanMessagePromptTemplate.from_template(
+            chain_config["prompt_template"]["human_prompt_template"]
+        ),
+    ]
+    if chain_config["use_parser"]:
+        parser = PydanticOutputParser(pydantic_object=GuidanceChainParser)
+        return ChatPromptTemplate(
+            messages=messages,
+            input_variables=chain_config["prompt_inputs"],
+            output_parser=parser,
+            partial_variables={"format_instructions": parser.get_format_instructions()},
+        )
+    return ChatPromptTemplate(messages=messages, input_variables=chain_config["prompt_inputs"])
+
+
+def chain_inputs(chain_name: str, memory: BaseMemory) -> dict:
+    persona = Persona()
+    values = {
+        "ai_name": "Healty Diet Assistant",
+        "memory": str(memory),
+        "text": "What should I eat for breakfast?",
+        "persona_description": persona.description,
+        "persona_attributes": persona.attributes,
+        "summary": "",
+        "messages": str(memory),
+    }
+    return {name: values[name] for name in config["chains"][chain_name]["prompt_inputs"]}
+
+
+def run(turns: int):
+    memory = BaseMemory()
+    for i in range(10):
+        memory.append(by="User", message=f"Message number {i} from the user")
+        memory.append(by="Healty Diet Assistant", message=f"Answer number {i}", agent_name="ConversationAgent")
+
+    chain_names = list(config["chains"])
+    inputs = {chain_name: chain_inputs(chain_name, memory) for chain_name in chain_names}
+
+    results = {}
+    for mode in ("before", "after"):
+        start = perf_counter()
+        for _ in range(turns):
+            # One turn runs every chain once (GuidanceChain and ConversationChain)
+            for chain_name in chain_names:
+                if mode == "before":
+                    prompt = build_prompt(chain_name)
+                else:
+                    prompt = compile_chain(chain_name, config["chains"][chain_name]["use_parser"]).prompt
+                prompt.format_prompt(**inputs[chain_name])
+        results[mode] = (perf_counter() - start) / turns * 1e6
+
+    print(f"turns: {turns}")
+    for mode, microseconds in results.items():
+        print(f"{mode:>6}: {microseconds:8.1f} us/turn")
+    print(f"speedup: {results['before'] / results['after']:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=2000)
+    run(parser.parse_args().turns)
@@ -0,0 +1,102 @@
+"""Session log write throughput and restore latency.
+
+Writes turns of many sessions from concurrent threads with every fsync policy, and reports turns
+per second and records per group commit. Then restores sessions of 100, 1000 and 5000 messages
+from a new SessionLog, as a restarted worker does, with snapshots and with the whole log
+replayed. Restore time includes BaseMemory.restore and replay.
+
+Usage:
+    python -m benchmarks.bench_session_log [--threads 16] [--turns 200] [--sizes 100 1000 5000]
+"""
+import argparse
+import shutil
+import tempfile
+from threading import Thread
+from time import perf_counter
+
+from Model.Memory.Memory import BaseMemory
+from Model.Session.SessionLog import FSYNC_POLICIES, SessionLog
+
+USER_MESSAGE = "What should I eat before a morning run?"
+AI_MESSAGE = "A banana with peanut butter an hour before, and drink water!"
+
+
+def run_turn(session_log: SessionLog, session_id: str, memory: BaseMemory, i: int):
+    memory.append(by="User", message=f"Message {i}: {USER_MESSAGE}")
+    memory.append(by="Healty Diet Assistant", message=f"Answer {i}: {AI_MESSAGE}", agent_name="ConversationAgent")
+    session_log.commit(session_id, memory)
+
+
+def bench_writes(fsync: str, threads: int, turns: int):
+    directory = tempfile.mkdtemp()
+    session_log = SessionLog(directory, fsync=fsync, fsync_interval=1.0, snapshot_every=50)
+
+    def worker(n: int):
+        session_id = f"session-{n}"
+        memory = BaseMemory(journal=session_log.journal(session_id))
+        for i in range(turns):
+            run_turn(session_log, session_id, memory, i)
+
+    workers = [Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    session_log.flush()
+    seconds = perf_counter() - start
+    session_log.close()
+
+    stats = session_log.stats()
+    shutil.rmtree(directory)
+    return threads * turns / seconds, stats["records"] / max(stats["batches"], 1), stats["fsyncs"]
+
+
+def bench_restore(messages: int, snapshot_every: int, repeat: int):
+    directory = tempfile.mkdtemp()
+    session_log = SessionLog(directory, fsync="never", snapshot_every=snapshot_every)
+    memory = BaseMemory(journal=session_log.journal("bench-session"))
+    for i in range(messages // 2):
+        run_turn(session_log, "bench-session", memory, i)
+    session_log.close()
+
+    # Index is built once per worker, restores after the first one read only the session
+    restored_log = SessionLog(directory)
+    start = perf_counter()
+    restored_log.restore("bench-session", BaseMemory())
+    first = perf_counter() - start
+
+    start = perf_counter()
+    for _ in range(repeat):
+        restored = BaseMemory()
+        restored_log.restore("bench-session", restored)
+    seconds = (perf_counter() - start) / repeat
+
+    assert str(restored) == str(memory)
+    shutil.rmtree(directory)
+    return first, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--turns", type=int, default=200, help="Turns per thread")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'fsync':<10}{'turns/s':>12}{'records/group':>16}{'fsyncs':>10}")
+    for fsync in FSYNC_POLICIES:
+        turns_per_second, group, fsyncs = bench_writes(fsync, args.threads, args.turns)
+        print(f"{fsync:<10}{turns_per_second:>12.0f}{group:>16.1f}{fsyncs:>10}")
+
+    print()
+    print(f"{'messages':>10}{'snapshots':>12}{'first ms':>12}{'restore ms':>12}")
+    for messages in args.sizes:
+        for snapshot_every, name in ((50, "every 50"), (10 ** 9, "none")):
+            first, seconds = bench_restore(messages, snapshot_every, args.repeat)
+            print(f"{messages:>10}{name:>12}{first * 1e3:>12.3f}{seconds * 1e3:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
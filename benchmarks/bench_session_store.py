@@ -0,0 +1,78 @@
+"""Session store load/save latency against history length.
+
+Saves and loads a BaseMemory with 10, 100 and 1000 messages on every backend. Redis runs
+against the local stand-in server of benchmarks/resp_server.py unless --redis-url is given.
+Load time includes BaseMemory.restore, save time includes BaseMemory.dumps.
+
+Usage:
+    python -m benchmarks.bench_session_store [--sizes 10 100 1000] [--repeat 50] [--redis-url URL]
+"""
+import argparse
+import os
+import tempfile
+from time import perf_counter
+
+from benchmarks.resp_server import start_resp_server
+from Model.Memory.Memory import BaseMemory
+from Model.Session.SessionStore import InMemorySessionStore, RedisSessionStore, SQLiteSessionStore
+
+
+def build_memory(messages: int) -> BaseMemory:
+    memory = BaseMemory()
+    for i in range(messages // 2):
+        memory.append(by="User", message=f"Message {i}: what should I eat before a morning run?")
+        memory.append(
+            by="Healty Diet Assistant",
+            message=f"Answer {i}: a banana with peanut butter an hour before, and drink water!",
+            agent_name="ConversationAgent",
+        )
+    return memory
+
+
+def bench(store, memory: BaseMemory, repeat: int):
+    start = perf_counter()
+    for _ in range(repeat):
+        store.save("bench-session", memory.dumps())
+    save_time = (perf_counter() - start) / repeat
+
+    restored = BaseMemory()
+    start = perf_counter()
+    for _ in range(repeat):
+        store.version("bench-session")
+        _, data = store.load("bench-session")
+        restored.restore(data)
+    load_time = (perf_counter() - start) / repeat
+
+    assert str(restored) == str(memory)
+    return save_time, load_time, len(memory.dumps())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--redis-url", default=None)
+    args = parser.parse_args()
+
+    redis_url = args.redis_url
+    if redis_url is None:
+        server = start_resp_server()
+        redis_url = f"redis://127.0.0.1:{server.server_address[1]}/0"
+
+    directory = tempfile.mkdtemp()
+    stores = {
+        "memory": InMemorySessionStore(),
+        "sqlite": SQLiteSessionStore(os.path.join(directory, "sessions.sqlite3")),
+        "redis": RedisSessionStore(redis_url),
+    }
+
+    print(f"{'backend':<10}{'messages':>10}{'bytes':>10}{'save ms':>10}{'load ms':>10}")
+    for messages in args.sizes:
+        memory = build_memory(messages)
+        for name, store in stores.items():
+            save_time, load_time, size = bench(store, memory, args.repeat)
+            print(f"{name:<10}{messages:>10}{size:>10}{save_time * 1e3:>10.3f}{load_time * 1e3:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Local stand-in of the OpenAI chat completions API for load tests.
+Answers after a configurable latency, produces tokens at a configurable rate, supports
+streaming and injects errors at a configurable rate. Prompts asking for the GuidanceChain
+format get a valid routing answer, every other prompt gets a canned answer.
+
+Usage:
+    python -m benchmarks.fake_openai [--port 8090] [--latency 0.5] [--token-rate 50] [--error-rate 0.0]
+"""
+import argparse
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Tuple
+
+import ujson
+
+# Answer of routing prompts. Index 1 is ConversationAgent in AGENTS_NAMES
+ROUTING_ANSWER = ujson.dumps({
+    "agent_index": 1,
+    "agent_name": "ConversationAgent",
+    "reason": "The user is having a conversation",
+})
+ANSWER_WORDS = (
+    "Greek yogurt with berries and nuts is a great high protein breakfast and do not forget "
+    "to drink a glass of water before your morning run"
+).split()
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Request logs would dominate the benchmark output
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        body = ujson.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        server: FakeOpenAIServer = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        request = ujson.loads(self.rfile.read(length) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            return self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+        if random.random() < server.error_rate:
+            server.count("errors")
+            return self._send_json(
+                server.error_status, {"error": {"message": "Injected error", "type": "server_error"}}
+            )
+        server.count("requests")
+
+        messages = request.get("messages", [])
+        prompt = " ".join(str(message.get("content", "")) for message in messages)
+        if "agent_index" in prompt:
+            tokens = [ROUTING_ANSWER]
+        else:
+            count = min(server.answer_tokens, request.get("max_tokens") or server.answer_tokens)
+            tokens = [f"{ANSWER_WORDS[i % len(ANSWER_WORDS)]} " for i in range(count)]
+
+        completion_id = f"chatcmpl-fake-{int(time() * 1e6)}"
+        usage = {
+            "prompt_tokens": len(prompt.split()),
+            "completion_tokens": len(tokens),
+            "total_tokens": len(prompt.split()) + len(tokens),
+        }
+        model = request.get("model", "fake")
+
+        sleep(server.latency)
+        if not request.get("stream"):
+            sleep(len(tokens) / server.token_rate)
+            return self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens).strip()},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for index, token in enumerate(tokens + [None]):
+            delta = {"content": token} if token is not None else {}
+            if index == 0:
+                delta["role"] = "assistant"
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None if token is not None else "stop"}],
+            }
+            self._write_chunk(f"data: {ujson.dumps(chunk)}\n\n".encode())
+            if token is not None:
+                sleep(1 / server.token_rate)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], **kwargs):
+        """Constructor of FakeOpenAIServer class
+
+        Args:
+            address (Tuple[str, int]): Host and port to listen
+            **kwargs (dict): Keyword arguments. See below
+
+            Keyword arguments:
+                latency (float): Seconds before the first token. Defaults to 0.5
+                token_rate (float): Tokens generated per second. Defaults to 50
+                answer_tokens (int): Tokens of non-routing answers. Defaults to 40
+                error_rate (float): Share of requests failed on purpose. Defaults to 0
+                error_status (int): HTTP status of injected errors. Defaults to 500
+        """
+        super().__init__(address, FakeOpenAIHandler)
+        self.latency = kwargs.get("latency", 0.5)
+        self.token_rate = kwargs.get("token_rate", 50.0)
+        self.answer_tokens = kwargs.get("answer_tokens", 40)
+        self.error_rate = kwargs.get("error_rate", 0.0)
+        self.error_status = kwargs.get("error_status", 500)
+
+        self._lock = Lock()
+        self.counters = {"requests": 0, "errors": 0}
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+
+def start_fake_openai(port: int = 0, **kwargs) -> FakeOpenAIServer:
+    """Starts the stand-in server in a background thread
+
+    Args:
+        port (int, optional): Port to listen. Defaults to 0, a free port
+        **kwargs (dict): Keyword arguments of FakeOpenAIServer
+
+    Returns:
+        FakeOpenAIServer: Running server. Its port is server_address[1]
+    """
+    server = FakeOpenAIServer(("127.0.0.1", port), **kwargs)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args()
+    FakeOpenAIServer(
+        ("127.0.0.1", args.port),
+        latency=args.latency,
+        token_rate=args.token_rate,
+        answer_tokens=args.answer_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    ).serve_forever()
@@ -0,0 +1,272 @@
+"""End-to-end load test of /api/chat against the local stand-in OpenAI server.
+
+Starts benchmarks/fake_openai.py and the application with the gunicorn + gevent settings of
+runServer, pointed to the stand-in server. Every session is first filled with its history
+length of messages at zero LLM latency, then all sessions send their measured messages at the
+same time. Reports p50/p95/p99 latency per history length, requests per second and RSS growth
+of the gunicorn processes as JSON.
+
+Usage:
+    python -m benchmarks.loadtest [--sessions 50] [--history 0 10 50] [--messages 5] [--workers 8]
+        [--latency 0.5] [--token-rate 50] [--error-rate 0.0] [--output loadtest.json]
+    python -m benchmarks.loadtest --target http://127.0.0.1:8083 ...   # running server, no RSS
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+from threading import Thread
+from time import perf_counter, sleep, time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from uuid import uuid4
+
+import ujson
+
+from benchmarks.fake_openai import start_fake_openai
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MESSAGES = [
+    "What should I eat for breakfast if I want more protein?",
+    "I am training for a half marathon, how many carbs do I need?",
+    "Is it fine to drink coffee before a workout?",
+    "Can you suggest a vegan dinner?",
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(port: int, workers: int, api_base: str) -> subprocess.Popen:
+    """Starts the application with the gunicorn options of runServer
+
+    Args:
+        port (int): Port to listen
+        workers (int): Number of gevent workers
+        api_base (str): Base url of the stand-in OpenAI server
+
+    Returns:
+        subprocess.Popen: gunicorn master process
+    """
+    env = {
+        **os.environ,
+        "OPEN_AI_API_KEY": "sk-loadtest",
+        "OPEN_AI_API_BASE": api_base,
+        "GUNICORN_BIND": f"127.0.0.1:{port}",
+        "GUNICORN_WORKERS": str(workers),
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=ROOT,
+        env=env,
+    )
+
+
+def wait_ready(host: str, port: int, timeout: float = 60.0):
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=5)
+            connection.request("GET", "/api/health")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        sleep(0.2)
+    raise TimeoutError(f"Server on {host}:{port} did not start in {timeout} seconds")
+
+
+def process_tree(pid: int) -> List[int]:
+    # Master and its workers, from /proc on Linux
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def post_chat(connection: http.client.HTTPConnection, session_id: str, message: str) -> Tuple[int, float]:
+    body = ujson.dumps({"session_id": session_id, "message": message})
+    start = perf_counter()
+    connection.request("POST", "/api/chat", body=body, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    response.read()
+    return response.status, perf_counter() - start
+
+
+def turn_message(session_id: str, turn: int) -> str:
+    # Unique per session and turn, so routing cache, response cache and dedupe of repeated
+    # messages do not answer measured turns without the LLM
+    return f"{MESSAGES[turn % len(MESSAGES)]} ({session_id}, turn {turn})"
+
+
+def run_session(
+        host: str,
+        port: int,
+        session_id: str,
+        messages: int,
+        results: List[Tuple[int, float]],
+        first_turn: int = 0,
+):
+    connection = http.client.HTTPConnection(host, port, timeout=300)
+    for turn in range(first_turn, first_turn + messages):
+        try:
+            results.append(post_chat(connection, session_id, turn_message(session_id, turn)))
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=300)
+            results.append((0, 0.0))
+    connection.close()
+
+
+def run_parallel(
+        host: str, port: int, sessions: Dict[str, int], first_turns: Optional[Dict[str, int]] = None
+) -> Dict[str, List[Tuple[int, float]]]:
+    results = {session_id: [] for session_id in sessions}
+    first_turns = first_turns or {}
+    threads = [
+        Thread(
+            target=run_session,
+            args=(host, port, session_id, messages, results[session_id], first_turns.get(session_id, 0)),
+        )
+        for session_id, messages in sessions.items()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def summarize(results: List[Tuple[int, float]]) -> Dict[str, float]:
+    latencies = [latency for status, latency in results if status == 200]
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1e3,
+        "p95_ms": percentile(latencies, 0.95) * 1e3,
+        "p99_ms": percentile(latencies, 0.99) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50, help="Concurrent sessions")
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 10, 50],
+                        help="History lengths in user messages, assigned to sessions round-robin")
+    parser.add_argument("--messages", type=int, default=5, help="Measured messages per session")
+    parser.add_argument("--workers", type=int, default=8, help="gunicorn workers")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before the first LLM token")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="LLM tokens per second")
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of failed LLM calls")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--target", default=None, help="Running server url. Its LLM calls are not faked")
+    parser.add_argument("--output", default=None, help="JSON results file. Printed if not given")
+    args = parser.parse_args()
+
+    fake_openai = None
+    gunicorn: Optional[subprocess.Popen] = None
+    if args.target:
+        parsed = urlparse(args.target)
+        host, port = parsed.hostname, parsed.port or 80
+    else:
+        # Session histories are filled without LLM latency
+        fake_openai = start_fake_openai(
+            latency=0.0,
+            token_rate=1e9,
+            answer_tokens=args.answer_tokens,
+            error_status=args.error_status,
+        )
+        host, port = "127.0.0.1", free_port()
+        gunicorn = start_gunicorn(port, args.workers, f"http://127.0.0.1:{fake_openai.server_address[1]}/v1")
+
+    try:
+        wait_ready(host, port)
+
+        run_id = uuid4().hex[:8]
+        history = {
+            f"loadtest-{run_id}-{i}": args.history[i % len(args.history)] for i in range(args.sessions)
+        }
+        run_parallel(host, port, {session_id: length for session_id, length in history.items() if length})
+
+        if fake_openai is not None:
+            fake_openai.latency = args.latency
+            fake_openai.token_rate = args.token_rate
+            fake_openai.error_rate = args.error_rate
+
+        pids = process_tree(gunicorn.pid) if gunicorn is not None else []
+        rss_before = {pid: rss_bytes(pid) for pid in pids}
+
+        start = perf_counter()
+        # Measured turns continue after the history turns of the session
+        results = run_parallel(host, port, {session_id: args.messages for session_id in history}, history)
+        seconds = perf_counter() - start
+
+        rss_after = {pid: rss_bytes(pid) for pid in pids}
+    finally:
+        if gunicorn is not None:
+            gunicorn.terminate()
+            gunicorn.wait(timeout=30)
+        if fake_openai is not None:
+            fake_openai.shutdown()
+
+    all_results = [result for session_results in results.values() for result in session_results]
+    by_history = {
+        str(length): summarize([
+            result for session_id, session_results in results.items()
+            if history[session_id] == length for result in session_results
+        ])
+        for length in args.history
+    }
+    report = {
+        "config": vars(args),
+        "seconds": seconds,
+        "requests_per_second": sum(status == 200 for status, _ in all_results) / seconds,
+        "overall": summarize(all_results),
+        "by_history": by_history,
+        "rss": {
+            "before_bytes": sum(rss_before.values()),
+            "after_bytes": sum(rss_after.values()),
+            "growth_bytes": sum(rss_after.values()) - sum(rss_before.values()),
+            "per_process": {
+                str(pid): {"before_bytes": rss_before[pid], "after_bytes": rss_after.get(pid, 0)} for pid in pids
+            },
+        },
+        "llm": dict(fake_openai.counters) if fake_openai is not None else None,
+    }
+
+    text = ujson.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
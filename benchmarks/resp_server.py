@@ -0,0 +1,88 @@
+"""Minimal Redis protocol stand-in for local runs of RedisSessionStore.
+Supports PING, AUTH, SELECT, GET, SET (EX is ignored), GETRANGE, DEL and FLUSHDB.
+
+Usage:
+    python -m benchmarks.resp_server [--port 6379]
+"""
+import argparse
+import socketserver
+from threading import Lock, Thread
+from typing import Dict, Tuple
+
+
+class RESPHandler(socketserver.StreamRequestHandler):
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _bulk(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def handle(self):
+        data: Dict[bytes, bytes] = self.server.data
+        lock: Lock = self.server.lock
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            command = args[0].upper()
+            with lock:
+                if command in (b"PING", b"AUTH", b"SELECT"):
+                    reply = b"+OK\r\n" if command != b"PING" else b"+PONG\r\n"
+                elif command == b"GET":
+                    reply = self._bulk(data.get(args[1]))
+                elif command == b"SET":
+                    data[args[1]] = args[2]
+                    reply = b"+OK\r\n"
+                elif command == b"GETRANGE":
+                    value = data.get(args[1], b"")
+                    start, end = int(args[2]), int(args[3])
+                    reply = self._bulk(value[start:end + 1 if end >= 0 else len(value) + end + 1])
+                elif command == b"DEL":
+                    reply = b":%d\r\n" % (data.pop(args[1], None) is not None)
+                elif command == b"FLUSHDB":
+                    data.clear()
+                    reply = b"+OK\r\n"
+                else:
+                    reply = b"-ERR unknown command\r\n"
+            self.wfile.write(reply)
+            self.wfile.flush()
+
+
+class RESPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int]):
+        super().__init__(address, RESPHandler)
+        self.data: Dict[bytes, bytes] = {}
+        self.lock = Lock()
+
+
+def start_resp_server(port: int = 0) -> RESPServer:
+    """Starts the stand-in server in a background thread
+
+    Args:
+        port (int, optional): Port to listen. Defaults to 0, a free port
+
+    Returns:
+        RESPServer: Running server. Its port is server_address[1]
+    """
+    server = RESPServer(("127.0.0.1", port))
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=6379)
+    RESPServer(("127.0.0.1", parser.parse_args().port)).serve_forever()
@@ -0,0 +1,161 @@
+"""Startup benchmark of the gunicorn workers, with and without preloading.
+
+Starts gunicorn with gunicorn.conf.py and polls /api/health over new connections from many
+threads until every worker has answered. Reports the time from launch to the first request
+served by each worker, and memory of the master and workers once all of them serve. Pss
+counts pages shared by n processes as 1/n per process, so it shows the copy-on-write sharing
+of preloading, while Rss counts them in every process.
+
+Usage:
+    python -m benchmarks.startup [--workers 8] [--runs 3] [--mode preload fork] [--output startup.json]
+"""
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+from typing import Dict, List
+
+import ujson
+
+from benchmarks.loadtest import ROOT, free_port, percentile, process_tree, rss_bytes
+
+
+def pss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def poll_workers(
+        gunicorn: subprocess.Popen, port: int, workers: int, start: float, timeout: float, pollers: int = 16
+) -> Dict[int, float]:
+    """Polls /api/health until every worker answered
+
+    Args:
+        gunicorn (subprocess.Popen): gunicorn master process. Polling stops if it exits
+        port (int): Port of gunicorn
+        workers (int): Number of workers
+        start (float): perf_counter of the launch
+        timeout (float): Seconds to wait
+        pollers (int, optional): Polling threads. Defaults to 16
+
+    Returns:
+        Dict[int, float]: Seconds from launch to the first answer per worker pid
+    """
+    first_served: Dict[int, float] = {}
+    lock = Lock()
+    done = Event()
+
+    def poll():
+        while not done.is_set() and perf_counter() - start < timeout and gunicorn.poll() is None:
+            try:
+                # New connection per request, so the next accept may go to another worker
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+                connection.request("GET", "/api/health", headers={"Connection": "close"})
+                response = connection.getresponse()
+                body = response.read()
+                connection.close()
+            except (OSError, http.client.HTTPException):
+                sleep(0.01)
+                continue
+            if response.status != 200:
+                continue
+            seconds = perf_counter() - start
+            pid = ujson.loads(body)["pid"]
+            with lock:
+                first_served.setdefault(pid, seconds)
+                if len(first_served) >= workers:
+                    done.set()
+
+    threads = [Thread(target=poll, daemon=True) for _ in range(pollers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return first_served
+
+
+def run_once(preload: bool, workers: int, timeout: float) -> dict:
+    port = free_port()
+    env = {
+        **os.environ,
+        "OPEN_AI_API_KEY": os.getenv("OPEN_AI_API_KEY", "sk-startup"),
+        "GUNICORN_BIND": f"127.0.0.1:{port}",
+        "GUNICORN_WORKERS": str(workers),
+        "GUNICORN_PRELOAD": "1" if preload else "0",
+    }
+    start = perf_counter()
+    gunicorn = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        first_served = poll_workers(gunicorn, port, workers, start, timeout)
+        pids = process_tree(gunicorn.pid)
+        memory = {
+            "rss_bytes": sum(rss_bytes(pid) for pid in pids),
+            "pss_bytes": sum(pss_bytes(pid) for pid in pids),
+            "master_rss_bytes": rss_bytes(gunicorn.pid),
+            "worker_pss_bytes": [pss_bytes(pid) for pid in pids if pid != gunicorn.pid],
+        }
+    finally:
+        gunicorn.terminate()
+        gunicorn.wait(timeout=30)
+
+    seconds = sorted(first_served.values())
+    return {
+        "workers_served": len(seconds),
+        "first_worker_seconds": seconds[0] if seconds else None,
+        "all_workers_seconds": seconds[-1] if len(seconds) >= workers else None,
+        "per_worker_seconds": seconds,
+        **memory,
+    }
+
+
+def summarize(runs: List[dict]) -> dict:
+    def values(key: str) -> List[float]:
+        return [run[key] for run in runs if run[key] is not None]
+
+    return {
+        "first_worker_p50_seconds": percentile(values("first_worker_seconds"), 0.5),
+        "all_workers_p50_seconds": percentile(values("all_workers_seconds"), 0.5),
+        "pss_p50_bytes": percentile(values("pss_bytes"), 0.5),
+        "rss_p50_bytes": percentile(values("rss_bytes"), 0.5),
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=8, help="gunicorn workers")
+    parser.add_argument("--runs", type=int, default=3, help="Launches per mode")
+    parser.add_argument("--mode", nargs="+", choices=["preload", "fork"], default=["preload", "fork"],
+                        help="preload imports the application in the master, fork in every worker")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds to wait for all workers")
+    parser.add_argument("--output", default=None, help="JSON results file. Printed if not given")
+    args = parser.parse_args()
+
+    report = {"config": vars(args)}
+    for mode in args.mode:
+        report[mode] = summarize([run_once(mode == "preload", args.workers, args.timeout) for _ in range(args.runs)])
+
+    text = ujson.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""gunicorn settings of runServer.
+
+With preloading (default), the master imports the application once: langchain, the config, the
+persona attributes, compiled chains and the tokenizer. Workers are forked from it and share
+these pages copy-on-write instead of importing and building them again, so workers start in
+milliseconds. Connections, locks and metrics of the master are replaced in every worker by the
+os.register_at_fork hooks of the LLM pool, the session store and the metrics registry.
+
+Usage:
+    gunicorn -c gunicorn.conf.py app:app
+    GUNICORN_PRELOAD=0 gunicorn -c gunicorn.conf.py app:app   # every worker imports the application
+"""
+import gc
+import os
+
+bind = os.getenv("GUNICORN_BIND", "127.0.0.1:8083")
+workers = int(os.getenv("GUNICORN_WORKERS", 8))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 300))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+if preload_app:
+    if worker_class == "gevent":
+        # Application is imported before the workers patch the standard library, so its
+        # module level locks and sockets must already be gevent's
+        from gevent import monkey
+
+        monkey.patch_all()
+
+    # Garbage collection in the master would leave freed holes in pages shared with workers
+    gc.disable()
+
+
+def on_starting(server):
+    # Metrics snapshots of workers of a previous run are not reported
+    from Model.Metrics.Metrics import metrics
+
+    metrics.clear_multiprocess_dir()
+
+
+def when_ready(server):
+    # Application is loaded. Objects of the master are moved out of the collected generations,
+    # so collections in the workers do not write to shared pages
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        gc.enable()
+
+
+def child_exit(server, worker):
+    # Totals of the exited worker are kept in one file of exited workers
+    from Model.Metrics.Metrics import metrics
+
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,38 @@
+"""Shared fixtures of the tests.
+
+LLM calls go to benchmarks/fake_openai.py, a local stand-in of the OpenAI chat completions API.
+
+Usage:
+    python -m pytest -q
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("OPEN_AI_API_KEY", "sk-test")
+
+from benchmarks.fake_openai import start_fake_openai  # noqa: E402
+
+
+@pytest.fixture
+def fake_openai():
+    """Stand-in OpenAI server answering at once. Tests change its error_rate and error_status"""
+    server = start_fake_openai(latency=0.0, token_rate=1e9, answer_tokens=5)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def openai_client(fake_openai):
+    """OpenAI client of the stand-in server. Retries are left to CallPolicy"""
+    import openai
+
+    client = openai.OpenAI(
+        api_key="sk-test", base_url=f"http://127.0.0.1:{fake_openai.server_address[1]}/v1", max_retries=0
+    )
+    yield client
+    client.close()
@@ -0,0 +1,153 @@
+from time import sleep
+from uuid import uuid4
+
+import openai
+import pytest
+
+from Model.CallPolicy.CallPolicy import (
+    CallPolicy,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceededError,
+    LLMUnavailableError,
+    circuit_breaker,
+    turn_deadline,
+)
+from Model.Config.Config import config
+
+
+@pytest.fixture(autouse=True)
+def fast_policy(monkeypatch):
+    policy_config = config["CALL_POLICY"]
+    monkeypatch.setitem(policy_config, "max_attempts", 3)
+    monkeypatch.setitem(policy_config, "backoff_multiplier", 0.001)
+    monkeypatch.setitem(policy_config, "backoff_max", 0.01)
+    monkeypatch.setitem(policy_config, "breaker_failures", 5)
+    monkeypatch.setitem(policy_config, "breaker_reset_timeout", 30.0)
+
+
+@pytest.fixture
+def model_name():
+    # Circuit breakers are shared per model name in the process
+    return f"test-model-{uuid4().hex[:8]}"
+
+
+def complete(openai_client):
+    def attempt(timeout):
+        completion = openai_client.chat.completions.create(
+            model="gpt-3.5-turbo", messages=[{"role": "user", "content": "hello"}], timeout=timeout
+        )
+        return completion.choices[0].message.content
+    return attempt
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("model", failure_threshold=3, reset_timeout=30.0)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == "closed"
+
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.stats() == {"open": 1, "failures": 3, "opened": 1, "rejected": 1}
+
+
+def test_breaker_lets_one_trial_through_after_reset_timeout():
+    breaker = CircuitBreaker("model", failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    sleep(0.06)
+
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    # Only one trial call at a time
+    assert not breaker.allow()
+
+    breaker.success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_failed_trial_opens_the_breaker_again():
+    breaker = CircuitBreaker("model", failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    sleep(0.06)
+    assert breaker.allow()
+
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.stats()["opened"] == 2
+
+
+def test_released_trial_lets_the_next_call_try():
+    breaker = CircuitBreaker("model", failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    sleep(0.06)
+    assert breaker.allow()
+
+    breaker.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_call_succeeds(openai_client, fake_openai, model_name):
+    answer = CallPolicy("ConversationChain").call(model_name, complete(openai_client))
+
+    assert answer.startswith("Greek yogurt")
+    assert fake_openai.counters["requests"] == 1
+    assert circuit_breaker(model_name).state == "closed"
+
+
+def test_server_errors_are_retried_then_given_up(openai_client, fake_openai, model_name):
+    fake_openai.error_rate = 1.0
+
+    with pytest.raises(LLMUnavailableError):
+        CallPolicy("ConversationChain").call(model_name, complete(openai_client))
+    assert fake_openai.counters["errors"] == 3
+    assert circuit_breaker(model_name).stats()["failures"] == 3
+
+
+def test_client_errors_are_not_retried(openai_client, fake_openai, model_name):
+    fake_openai.error_rate = 1.0
+    fake_openai.error_status = 400
+
+    with pytest.raises(openai.BadRequestError):
+        CallPolicy("ConversationChain").call(model_name, complete(openai_client))
+    assert fake_openai.counters["errors"] == 1
+    # Answers of a working provider do not count against its circuit
+    assert circuit_breaker(model_name).stats()["failures"] == 0
+
+
+def test_open_circuit_fails_calls_fast(openai_client, fake_openai, model_name, monkeypatch):
+    monkeypatch.setitem(config["CALL_POLICY"], "breaker_failures", 2)
+    fake_openai.error_rate = 1.0
+    policy = CallPolicy("ConversationChain")
+
+    # Retries stop once the circuit opens
+    with pytest.raises(CircuitOpenError):
+        policy.call(model_name, complete(openai_client))
+    assert fake_openai.counters["errors"] == 2
+
+    with pytest.raises(CircuitOpenError):
+        policy.call(model_name, complete(openai_client))
+    assert fake_openai.counters["errors"] == 2
+    assert circuit_breaker(model_name).stats()["rejected"] >= 2
+
+
+def test_passed_deadline_fails_before_calling(openai_client, fake_openai, model_name):
+    with turn_deadline(0.0):
+        with pytest.raises(DeadlineExceededError):
+            CallPolicy("ConversationChain").call(model_name, complete(openai_client))
+    assert fake_openai.counters["requests"] == 0
+
+
+def test_attempt_timeout_is_cut_to_the_deadline():
+    policy = CallPolicy("ConversationChain")
+    with turn_deadline(1.0):
+        assert 0 < policy.attempt_timeout() <= 1.0
+    with turn_deadline(1000.0):
+        assert policy.attempt_timeout() <= 1000.0
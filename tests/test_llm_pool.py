@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from Model.LLM.LLM import LLMClientPool
+
+
+@pytest.fixture
+def pool():
+    pool = LLMClientPool()
+    yield pool
+    pool.close()
+
+
+def test_same_key_gets_the_same_client(pool):
+    llm = pool.get("gpt-3.5-turbo", 0.7, api_key="sk-a")
+
+    assert pool.get("gpt-3.5-turbo", 0.7, api_key="sk-a") is llm
+    assert pool.stats() == {"hits": 1, "misses": 1, "clients": 1}
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"model_name": "gpt-4-1106-preview", "temperature": 0.7, "api_key": "sk-a"},
+    {"model_name": "gpt-3.5-turbo", "temperature": 0.2, "api_key": "sk-a"},
+    {"model_name": "gpt-3.5-turbo", "temperature": 0.7, "api_key": "sk-b"},
+    {"model_name": "gpt-3.5-turbo", "temperature": 0.7, "api_key": "sk-a", "max_tokens": 100},
+])
+def test_different_key_is_a_miss(pool, kwargs):
+    llm = pool.get("gpt-3.5-turbo", 0.7, api_key="sk-a")
+
+    assert pool.get(**kwargs) is not llm
+    assert pool.stats() == {"hits": 0, "misses": 2, "clients": 2}
+
+
+def test_clients_share_the_pooled_connections(pool):
+    first = pool.get("gpt-3.5-turbo", 0.7, api_key="sk-a")
+    second = pool.get("gpt-4-1106-preview", 0.2, api_key="sk-b")
+
+    assert first.client._client._client is second.client._client._client
+    assert first.async_client._client._client is second.async_client._client._client
+    assert first.client._client.max_retries == pool._max_retries
+
+
+def test_reset_after_fork_empties_the_pool(pool):
+    llm = pool.get("gpt-3.5-turbo", 0.7, api_key="sk-a")
+    read, write = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        # Child: the registered fork hook of the shared pool is not used by this pool
+        pool.reset()
+        fresh = pool.get("gpt-3.5-turbo", 0.7, api_key="sk-a")
+        os.write(write, b"1" if fresh is not llm and pool.stats()["clients"] == 1 else b"0")
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b"1"
+    os.close(read)
+    os.close(write)
+    # Parent keeps its clients
+    assert pool.get("gpt-3.5-turbo", 0.7, api_key="sk-a") is llm
+
+
+def test_fork_hook_resets_the_shared_pool():
+    from Model.LLM.LLM import llm_client_pool
+
+    llm_client_pool.get("gpt-3.5-turbo", 0.7, api_key="sk-a")
+    read, write = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.write(write, b"1" if llm_client_pool.stats()["clients"] == 0 else b"0")
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b"1"
+    os.close(read)
+    os.close(write)
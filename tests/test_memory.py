@@ -0,0 +1,180 @@
+from threading import Event
+
+from Model.Memory.Memory import BaseMemory
+
+
+def fill(memory: BaseMemory, count: int):
+    for i in range(count):
+        if i % 2:
+            memory.append(by="Healty Diet Assistant", message=f"answer {i}", agent_name="ConversationAgent")
+        else:
+            memory.append(by="User", message=f"question {i}")
+
+
+def wait_for_summary(memory: BaseMemory):
+    if memory._summary_future is not None:
+        memory._summary_future.result(timeout=10)
+
+
+def test_render_without_window_returns_whole_transcript():
+    memory = BaseMemory()
+    fill(memory, 6)
+
+    assert memory.render() == str(memory)
+    assert memory.render_with_tokens() == (str(memory), memory.tokens())
+
+
+def test_window_without_summary_keeps_last_memories():
+    memory = BaseMemory()
+    fill(memory, 6)
+
+    text, tokens = memory.render_with_tokens(window_size=2, use_summary=False)
+    assert text == BaseMemory._render_memories(memory.memory_array[-2:])
+    assert tokens == memory.tokens(4)
+    assert "question 2" not in text
+
+
+def test_window_keeps_unsummarized_memories_while_there_is_no_summary():
+    memory = BaseMemory()
+    fill(memory, 6)
+
+    # Nothing is folded into a summary, so no memory may be left out
+    assert memory.render(window_size=2) == str(memory)
+
+
+def test_window_with_summary_replaces_summarized_memories():
+    calls = []
+
+    def summarizer(summary: str, messages: str) -> str:
+        calls.append(messages)
+        return "user asked six questions"
+
+    memory = BaseMemory(window_size=2, summarizer=summarizer, summary_batch=2)
+    fill(memory, 6)
+    wait_for_summary(memory)
+
+    assert calls and "question 0" in calls[0]
+    assert memory.summary == "user asked six questions"
+    text, tokens = memory.render_with_tokens(window_size=2)
+    assert text.startswith("Summary of earlier conversation: user asked six questions")
+    assert "question 0" not in text
+    assert text.endswith(BaseMemory._render_memories(memory.memory_array[memory.summarized_count:]))
+    assert tokens > memory.tokens(memory.summarized_count)
+
+    # Summary is left out when not asked for
+    assert "Summary" not in memory.render(window_size=2, use_summary=False)
+
+
+def test_failed_summary_keeps_memories_verbatim():
+    def summarizer(summary: str, messages: str) -> str:
+        raise RuntimeError("LLM unavailable")
+
+    memory = BaseMemory(window_size=2, summarizer=summarizer, summary_batch=2)
+    fill(memory, 6)
+    wait_for_summary(memory)
+
+    assert memory.summary == ""
+    assert memory.render(window_size=2) == str(memory)
+
+
+def test_max_tokens_leaves_out_oldest_memories():
+    memory = BaseMemory()
+    fill(memory, 10)
+
+    budget = memory.tokens(7)
+    text, tokens = memory.render_with_tokens(max_tokens=budget)
+    assert tokens <= budget
+    assert text == BaseMemory._render_memories(memory.memory_array[7:])
+
+
+def test_journal_replay_restores_memories_and_summary():
+    entries = []
+    memory = BaseMemory(
+        window_size=2, summarizer=lambda summary, messages: "short summary", summary_batch=2, journal=entries.append
+    )
+    fill(memory, 6)
+    wait_for_summary(memory)
+    del memory.memory_array
+
+    restored = BaseMemory()
+    restored.replay(entries)
+    assert str(restored) == str(memory)
+    assert restored.summary == memory.summary
+    assert restored.summarized_count == memory.summarized_count
+
+
+def test_append_after_pop_renders_the_new_memory():
+    memory = BaseMemory()
+    memory.append(by="User", message="question")
+    memory.append(by="Healty Diet Assistant", message="answer-A", agent_name="ConversationAgent")
+    assert "answer-A" in str(memory)
+
+    del memory.memory_array
+    memory.append(by="Healty Diet Assistant", message="answer-B", agent_name="ConversationAgent")
+
+    assert "answer-A" not in str(memory)
+    assert "answer-B" in memory.render()
+    assert str(memory) == BaseMemory._render_memories(memory.memory_array)
+
+
+def test_replayed_pop_renders_the_new_memory():
+    entries = []
+    memory = BaseMemory(journal=entries.append)
+    memory.append(by="User", message="question")
+    memory.append(by="Healty Diet Assistant", message="answer-A", agent_name="ConversationAgent")
+
+    restored = BaseMemory()
+    restored.replay(entries)
+    str(restored)
+    del memory.memory_array
+    memory.append(by="Healty Diet Assistant", message="answer-B", agent_name="ConversationAgent")
+    restored.replay(entries[2:])
+
+    assert str(restored) == str(memory)
+
+
+def test_summary_of_removed_memories_is_dropped():
+    release = Event()
+
+    def summarizer(summary: str, messages: str) -> str:
+        release.wait(timeout=10)
+        return "summary of removed memories"
+
+    memory = BaseMemory(window_size=2, summarizer=summarizer, summary_batch=2)
+    fill(memory, 4)
+    # Summary job of the first 2 memories is running. 3 memories are replaced meanwhile
+    for _ in range(3):
+        del memory.memory_array
+    fill(memory, 3)
+    release.set()
+    wait_for_summary(memory)
+
+    assert memory.summary == ""
+    assert memory.summarized_count == 0
+
+
+def test_summary_is_kept_when_only_window_memories_are_removed():
+    release = Event()
+
+    def summarizer(summary: str, messages: str) -> str:
+        release.wait(timeout=10)
+        return "summary of first memories"
+
+    memory = BaseMemory(window_size=2, summarizer=summarizer, summary_batch=2)
+    fill(memory, 4)
+    del memory.memory_array
+    release.set()
+    wait_for_summary(memory)
+
+    assert memory.summary == "summary of first memories"
+    assert memory.summarized_count == 2
+
+
+def test_dumps_and_restore():
+    memory = BaseMemory()
+    fill(memory, 4)
+
+    restored = BaseMemory()
+    restored.restore(memory.dumps())
+    assert str(restored) == str(memory)
+    assert restored.tokens() == memory.tokens()
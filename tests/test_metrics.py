@@ -0,0 +1,68 @@
+import os
+from threading import Thread
+from time import sleep
+
+from Model.Metrics.Metrics import MetricsRegistry
+
+
+def test_observe_does_not_write_snapshots(tmp_path):
+    collected = []
+    metrics = MetricsRegistry(multiprocess_dir=str(tmp_path), flush_interval=60.0)
+    metrics.register_collector("sessions", lambda: collected.append(1) or {"live_sessions": 1})
+
+    metrics.observe("llm", 0.1, chain="ConversationChain")
+    assert collected == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_background_flusher_writes_snapshots(tmp_path):
+    metrics = MetricsRegistry(multiprocess_dir=str(tmp_path), flush_interval=0.01)
+    metrics.observe("llm", 0.1, chain="ConversationChain")
+
+    for _ in range(500):
+        if os.listdir(tmp_path):
+            break
+        sleep(0.01)
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".json")]
+
+
+def test_concurrent_flushes_do_not_fail(tmp_path):
+    metrics = MetricsRegistry(multiprocess_dir=str(tmp_path), flush_interval=60.0)
+    errors = []
+
+    def flush():
+        try:
+            for _ in range(100):
+                metrics.flush()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=flush) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_nested_collectors_get_their_label(tmp_path):
+    metrics = MetricsRegistry(multiprocess_dir=None)
+    metrics.register_collector("tokens", lambda: {"chains": {"ConversationChain": {"calls": 3}}}, label="chain")
+    metrics.register_collector("local_router", lambda: {"routed": {"ConversationAgent": 2}}, label="agent")
+
+    text = metrics.render()
+    assert f'persona_tokens_calls{{pid="{os.getpid()}",chain="ConversationChain"}} 3' in text
+    assert f'persona_local_router_routed{{pid="{os.getpid()}",agent="ConversationAgent"}} 2' in text
+
+
+def test_exited_worker_is_folded_into_one_file(tmp_path):
+    worker = MetricsRegistry(multiprocess_dir=str(tmp_path))
+    worker.observe("llm", 0.1)
+    worker.flush(final=True)
+
+    master = MetricsRegistry(multiprocess_dir=str(tmp_path))
+    master.mark_process_dead(os.getpid())
+    assert os.listdir(tmp_path) == ["metrics-exited.json"]
+    assert 'persona_stage_duration_seconds_count{stage="llm"} 1' in master.render()
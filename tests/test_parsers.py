@@ -0,0 +1,78 @@
+import pytest
+from langchain.schema import OutputParserException
+
+from Model.Parsers.Parsers import GuidanceOutputParser, resolve_agent_index
+
+
+def parse_path(text: str):
+    result, path = GuidanceOutputParser().parse_local(text)
+    return (result.agent_name if result is not None else None), path
+
+
+def test_strict_answer():
+    text = '{"agent_index": 1, "agent_name": "ConversationAgent", "reason": "small talk"}'
+    assert parse_path(text) == ("ConversationAgent", "strict")
+
+
+@pytest.mark.parametrize("text", [
+    'Sure!\n```json\n{"agent_index": 1, "reason": "small talk"}\n```',
+    "{'agent_name': 'Conversation Agent', 'reason': 'small talk'}",
+    '{agent_index: 1, reason: "small talk",}',
+    'I choose {"agent": "ConversationAgent"} for this message',
+])
+def test_lenient_json_answers(text):
+    assert parse_path(text) == ("ConversationAgent", "lenient_json")
+
+
+@pytest.mark.parametrize("text", [
+    "The ConversationAgent should answer this.",
+    "A",
+    "1.",
+    "Answer: A",
+])
+def test_mapping_answers(text):
+    assert parse_path(text) == ("ConversationAgent", "mapping")
+
+
+def test_strict_answer_with_unknown_index_is_parsed_leniently():
+    text = '{"agent_index": 7, "agent_name": "ConversationAgent", "reason": "small talk"}'
+    assert parse_path(text) == ("ConversationAgent", "lenient_json")
+
+
+def test_unparseable_answer():
+    assert parse_path("I am not sure which one to pick") == (None, None)
+
+
+@pytest.mark.parametrize("value, index", [
+    (1, 1), ("1", 1), ("A", 1), ("conversation agent", 1), ("'ConversationAgent'.", 1),
+    (True, None), (9, None), ("Z", None), (None, None),
+])
+def test_resolve_agent_index(value, index):
+    assert resolve_agent_index(value) == index
+
+
+def test_repair_asks_the_llm_only_when_local_parsing_fails(openai_client, fake_openai):
+    parser = GuidanceOutputParser()
+
+    def repair(text: str) -> str:
+        completion = openai_client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": f"Answer with agent_index and agent_name JSON: {text}"}],
+        )
+        return completion.choices[0].message.content
+
+    assert parser.parse("ConversationAgent", repair=repair).agent_name == "ConversationAgent"
+    assert fake_openai.counters["requests"] == 0
+
+    assert parser.parse("no idea", repair=repair).agent_name == "ConversationAgent"
+    assert fake_openai.counters["requests"] == 1
+    assert parser.stats()["mapping"] == 1
+    assert parser.stats()["repair"] == 1
+
+
+def test_failed_answer_raises_and_is_counted():
+    parser = GuidanceOutputParser()
+
+    with pytest.raises(OutputParserException):
+        parser.parse("no idea", repair=lambda text: "still no idea")
+    assert parser.stats()["failed"] == 1
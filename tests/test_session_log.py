@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+from Model.Memory.Memory import BaseMemory
+from Model.Session.SessionLog import SessionLog
+
+
+def run_turns(session_log: SessionLog, session_id: str, memory: BaseMemory, turns: int, name: str = "turn"):
+    for i in range(turns):
+        memory.append(by="User", message=f"{name} {i}")
+        memory.append(by="Healty Diet Assistant", message=f"answer {i}", agent_name="ConversationAgent")
+        session_log.commit(session_id, memory)
+
+
+@pytest.fixture
+def log_directory(tmp_path):
+    return str(tmp_path / "session_log")
+
+
+def test_restore_replays_appended_records(log_directory):
+    session_log = SessionLog(log_directory, fsync="always", snapshot_every=1000)
+    memory = BaseMemory(journal=session_log.journal("s1"))
+    run_turns(session_log, "s1", memory, 5)
+    del memory.memory_array
+    session_log.close()
+
+    restored = BaseMemory()
+    assert SessionLog(log_directory).restore("s1", restored)
+    assert str(restored) == str(memory)
+    assert restored.number_of_memories == 9
+
+
+def test_unknown_session_is_not_restored(log_directory):
+    assert not SessionLog(log_directory).restore("missing", BaseMemory())
+
+
+def test_restore_from_snapshot_and_records_after_it(log_directory):
+    session_log = SessionLog(log_directory, fsync="never", snapshot_every=4)
+    memory = BaseMemory(journal=session_log.journal("s1"))
+    run_turns(session_log, "s1", memory, 7)
+    session_log.close()
+    assert session_log.stats()["snapshots"] == 3
+
+    restored_log = SessionLog(log_directory)
+    restored = BaseMemory()
+    assert restored_log.restore("s1", restored)
+    assert str(restored) == str(memory)
+
+
+def test_torn_record_at_the_end_is_ignored(log_directory):
+    session_log = SessionLog(log_directory, fsync="always", snapshot_every=1000)
+    memory = BaseMemory(journal=session_log.journal("s1"))
+    run_turns(session_log, "s1", memory, 3)
+    session_log.close()
+
+    # Crash during a write leaves half a record
+    with open(session_log.segments()[-1], "ab") as f:
+        f.write(b"\x00\x00\x01\x00partial")
+
+    restored = BaseMemory()
+    assert SessionLog(log_directory).restore("s1", restored)
+    assert str(restored) == str(memory)
+
+
+def test_compact_deletes_finished_segments(log_directory):
+    # Every turn is written on its own, so segments fill up one turn at a time
+    session_log = SessionLog(log_directory, fsync="always", snapshot_every=1000, segment_bytes=512)
+    memories = {}
+    for session_id in ("s1", "s2"):
+        memories[session_id] = BaseMemory(journal=session_log.journal(session_id))
+        run_turns(session_log, session_id, memories[session_id], 10)
+    session_log.close()
+    assert len(session_log.segments()) > 1
+
+    result = SessionLog(log_directory).compact()
+    assert result["segments_after"] == 0
+    assert result["sessions_snapshotted"] == 2
+
+    for session_id, memory in memories.items():
+        restored = BaseMemory()
+        assert SessionLog(log_directory).restore(session_id, restored)
+        assert str(restored) == str(memory)
+
+
+def test_records_of_other_writers_get_distinct_sequences(log_directory):
+    first, second = SessionLog(log_directory, fsync="never"), SessionLog(log_directory, fsync="never")
+    first_memory = BaseMemory(journal=first.journal("s1"))
+    second_memory = BaseMemory(journal=second.journal("s1"))
+    for i in range(5):
+        run_turns(first, "s1", first_memory, 1, name=f"first {i}")
+        first.flush()
+        run_turns(second, "s1", second_memory, 1, name=f"second {i}")
+        second.flush()
+    first.close()
+    second.close()
+
+    reader = SessionLog(log_directory)
+    assert len(reader.segments()) == 2
+    reader.restore("s1", BaseMemory())
+    sequences = sorted(position[2] for position in reader._index["s1"])
+    assert sequences == list(range(1, 21))
+
+
+def test_records_written_after_the_index_was_built_are_restored(log_directory):
+    reader = SessionLog(log_directory)
+    assert not reader.restore("s1", BaseMemory())
+
+    session_log = SessionLog(log_directory, fsync="never")
+    memory = BaseMemory(journal=session_log.journal("s1"))
+    run_turns(session_log, "s1", memory, 3)
+    session_log.close()
+
+    restored = BaseMemory()
+    assert reader.restore("s1", restored)
+    assert str(restored) == str(memory)
+
+
+def test_session_ids(log_directory):
+    session_log = SessionLog(log_directory, fsync="never")
+    for session_id in ("s1", "s2"):
+        run_turns(session_log, session_id, BaseMemory(journal=session_log.journal(session_id)), 1)
+    session_log.close()
+
+    assert sorted(SessionLog(log_directory).sessions()) == ["s1", "s2"]
+    assert os.path.isdir(os.path.join(log_directory, "snapshots"))
@@ -0,0 +1,141 @@
+import asyncio
+from threading import Event, Thread
+from time import sleep
+
+import pytest
+
+from Model.Session.SessionTurns import IdempotencyKeyError, SessionTurns
+
+
+def wait_until(condition, timeout: float = 5.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        sleep(0.01)
+    raise TimeoutError("Condition not met")
+
+
+def test_idempotency_key_replays_finished_turn():
+    turns = SessionTurns(dedupe_window=0)
+    calls = []
+
+    def turn():
+        calls.append(1)
+        return f"answer {len(calls)}"
+
+    assert turns.run("s1", "hello", turn, idempotency_key="k1") == "answer 1"
+    assert turns.run("s1", "hello", turn, idempotency_key="k1") == "answer 1"
+    assert turns.run("s1", "hello", turn, idempotency_key="k2") == "answer 2"
+    assert len(calls) == 2
+    assert turns.stats()["replayed"] == 1
+
+
+def test_idempotency_key_with_another_message_is_rejected():
+    turns = SessionTurns(dedupe_window=0)
+    turns.run("s1", "hello", lambda: "answer", idempotency_key="k1")
+
+    with pytest.raises(IdempotencyKeyError):
+        turns.run("s1", "goodbye", lambda: "answer", idempotency_key="k1")
+
+
+def test_failed_turn_runs_again():
+    turns = SessionTurns(dedupe_window=0)
+
+    def failing():
+        raise RuntimeError("LLM unavailable")
+
+    with pytest.raises(RuntimeError):
+        turns.run("s1", "hello", failing, idempotency_key="k1")
+    assert turns.run("s1", "hello", lambda: "answer", idempotency_key="k1") == "answer"
+
+
+def test_repeated_message_is_a_new_turn_by_default():
+    turns = SessionTurns()
+    calls = []
+
+    def turn():
+        calls.append(1)
+        return len(calls)
+
+    assert turns.run("s1", "ok", turn) == 1
+    assert turns.run("s1", "ok", turn) == 2
+
+
+def test_message_repeated_after_a_finished_turn_is_a_new_turn():
+    turns = SessionTurns(dedupe_window=10)
+    calls = []
+
+    def turn():
+        calls.append(1)
+        return len(calls)
+
+    # Conversation changed after the first turn, so the same message is asked again
+    assert turns.run("s1", "ok", turn) == 1
+    assert turns.run("s1", "ok", turn) == 2
+    assert turns.run("s2", "ok", turn) == 3
+
+
+def test_concurrent_duplicate_is_attached_to_running_turn():
+    turns = SessionTurns(dedupe_window=10)
+    started, release = Event(), Event()
+    calls = []
+    results = []
+
+    def turn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "answer"
+
+    first = Thread(target=lambda: results.append(turns.run("s1", "hello", turn)))
+    first.start()
+    started.wait(5)
+    duplicate = Thread(target=lambda: results.append(turns.run("s1", "hello", turn)))
+    duplicate.start()
+    wait_until(lambda: turns.stats()["coalesced"] == 1)
+    release.set()
+    first.join(5)
+    duplicate.join(5)
+
+    assert results == ["answer", "answer"]
+    assert len(calls) == 1
+
+
+def test_turns_of_a_session_run_one_at_a_time():
+    turns = SessionTurns(dedupe_window=0)
+    running, overlaps = [], []
+
+    def turn():
+        running.append(1)
+        overlaps.append(len(running))
+        sleep(0.01)
+        running.pop()
+
+    threads = [Thread(target=turns.run, args=("s1", f"message {i}", turn)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert overlaps == [1] * 5
+    assert turns.stats()["turns"] == 5
+
+
+def test_async_duplicate_is_attached_to_running_turn():
+    turns = SessionTurns(dedupe_window=0)
+    calls = []
+
+    async def turn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def main():
+        return await asyncio.gather(
+            turns.arun("s1", "hello", turn, idempotency_key="k1"),
+            turns.arun("s1", "hello", turn, idempotency_key="k1"),
+        )
+
+    assert asyncio.run(main()) == ["answer", "answer"]
+    assert len(calls) == 1
+    assert turns.stats()["coalesced"] == 1
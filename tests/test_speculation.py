@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+from Model.PersonaChatbot.PersonaChatbot import SpeculationStats
+
+
+def test_sync_speculation_stops_below_hit_rate_and_probes():
+    stats = SpeculationStats(min_hit_rate=0.7, hit_rate_window=10, min_samples=4, probe_every=3)
+
+    assert stats.sync_speculation_allowed()
+    for _ in range(4):
+        stats.miss()
+
+    assert [stats.sync_speculation_allowed() for _ in range(6)] == [False, False, True, False, False, True]
+    assert stats.stats()["below_hit_rate"] == 6
+
+
+def test_sync_speculation_resumes_when_hit_rate_recovers():
+    stats = SpeculationStats(min_hit_rate=0.7, hit_rate_window=4, min_samples=4, probe_every=3)
+    for _ in range(4):
+        stats.miss()
+    assert not stats.sync_speculation_allowed()
+
+    for _ in range(4):
+        stats.hit(0.1)
+    assert stats.sync_speculation_allowed()
+    assert stats.stats()["recent_hit_rate"] == 1.0
+
+
+def test_running_miss_is_counted_as_wasted():
+    stats = SpeculationStats()
+    started, release = Event(), Event()
+
+    def agent():
+        started.set()
+        release.wait()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(agent)
+        started.wait()
+        assert not future.cancel()
+        future.add_done_callback(lambda _: stats.waste(0.5))
+        release.set()
+
+    assert stats.stats()["wasted"] == 1
+    assert stats.stats()["wasted_seconds"] == 0.5
@@ -0,0 +1,46 @@
+import os
+
+import ujson
+
+from Model.Tokens.Tokens import TokenLedger
+
+
+def test_ledger_keeps_its_file_open(tmp_path):
+    path = str(tmp_path / "tokens.jsonl")
+    ledger = TokenLedger(path)
+
+    ledger.record("ConversationChain", "gpt-3.5-turbo", 120, 30, max_input_tokens=100)
+    handle = ledger._file
+    ledger.record("ConversationChain", "gpt-3.5-turbo", 80, 20, max_input_tokens=100)
+    assert ledger._file is handle
+
+    with open(path) as f:
+        lines = [ujson.loads(line) for line in f]
+    assert [line["over_budget"] for line in lines] == [True, False]
+    assert ledger.stats()["ConversationChain"]["calls"] == 2
+    ledger.close()
+
+
+def test_forked_worker_opens_the_file_again(tmp_path):
+    path = str(tmp_path / "tokens.jsonl")
+    ledger = TokenLedger(path)
+    ledger.record("GuidanceChain", "gpt-3.5-turbo", 10, 2)
+    read, write = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        inherited = ledger._file
+        ledger.after_fork()
+        ledger.record("GuidanceChain", "gpt-3.5-turbo", 10, 2)
+        os.write(write, b"1" if ledger._file is not inherited else b"0")
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b"1"
+    os.close(read)
+    os.close(write)
+
+    ledger.record("GuidanceChain", "gpt-3.5-turbo", 10, 2)
+    ledger.close()
+    with open(path) as f:
+        assert len(f.readlines()) == 3